@@ -0,0 +1,80 @@
+"""
+  Micro-benchmarks of the bracket-and-interpolate functions in processing/interp:
+the scalar finders (find_closestAges, find_closestMasses, find_closestFeHs and
+linear_interp, called once per query value) against the array API
+(find_brackets and interp_brackets, called once for all query values).
+
+Usage:
+    python benchmarks/bench_interp.py [number of query values]
+
+The grids are synthetic and sized like a MIST run: 13 metallicities, 107
+isochrone ages (and a full age column of 1500 models), and 600 masses on an
+isochrone.
+"""
+import sys
+import time
+import numpy as np
+from cmdfit.processing import interp
+
+def best_of(func, repeat = 3):
+
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    return min(times)
+
+def report(name, nvalues, scalar, array):
+
+    print('{:<10s} scalar: {:9.2f} us/value   array: {:9.4f} us/value   speed-up: {:8.1f}x'.format(
+          name, 1e6 * scalar / nvalues, 1e6 * array / nvalues, scalar / array))
+
+def main(argv):
+
+    nvalues = int(argv[1]) if len(argv) > 1 else 2000
+    np.random.seed(0)
+
+    FeHs = np.linspace(-0.6, 0.6, 13)
+    ages = np.round(np.arange(5.0, 10.3, 0.05), 2)
+    age_column = np.repeat(ages[-30:], 50)
+    masses = np.cumsum(np.random.uniform(1e-4, 1e-2, 600)) + 0.1
+    mags = np.column_stack((-2.5*np.log10(masses), -2.4*np.log10(masses)))
+
+    # Query values strictly inside the grids, where the scalar finders are valid:
+    FeH_values = np.random.uniform(FeHs[0] + 1e-3, FeHs[-1] - 1e-3, nvalues)
+    age_values = np.random.uniform(age_column[0] + 1e-3, age_column[-1] - 1e-3, nvalues)
+    mass_values = np.random.uniform(masses[0] + 1e-3, masses[-1] - 1e-3, nvalues)
+
+    # find_closestFeHs:
+    scalar = best_of(lambda: [interp.find_closestFeHs(x, FeHs) for x in FeH_values])
+    array = best_of(lambda: interp.find_brackets(FeH_values, FeHs))
+    report('[Fe/H]', nvalues, scalar, array)
+
+    # find_closestAges (on a cmdset's full age column, as the old isochrone code did):
+    scalar = best_of(lambda: [interp.find_closestAges(x, age_column) for x in age_values])
+    array = best_of(lambda: interp.find_brackets(age_values, ages))
+    report('age', nvalues, scalar, array)
+
+    # find_closestMasses plus linear_interp in one band, against interpolating all bands:
+    def scalar_masses():
+        for x in mass_values:
+            big, lil, big_index, lil_index = interp.find_closestMasses(x, masses)
+            interp.linear_interp(x, (lil, mags[lil_index, 0]), (big, mags[big_index, 0]))
+
+    def array_masses():
+        index, weight, inside = interp.find_brackets(mass_values, masses)
+        interp.interp_brackets(index, weight, mags)
+
+    scalar = best_of(scalar_masses, repeat = 1)
+    array = best_of(array_masses)
+    report('mass', nvalues, scalar, array)
+
+    # Both agree:
+    index, weight, inside = interp.find_brackets(mass_values, masses)
+    expected = np.interp(mass_values, masses, mags[:, 0])
+    assert np.allclose(interp.interp_brackets(index, weight, mags)[:, 0], expected)
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,62 @@
+"""
+  Per-call latency of isochrone extraction from a model cmdset: the row-by-row
+search over the whole table (np.where over every model's age) against the age
+index (cmdset.isoages/isooffsets: a binary search and a slice view).
+
+Usage:
+    python benchmarks/bench_isochrone.py [model_file] [column indices...]
+
+Defaults to the package's default model file and the 2MASS J and H columns.
+"""
+import sys
+import time
+import numpy as np
+from cmdfit import data
+from cmdfit.isochrone import isochrone
+
+def per_call(func, ages, repeat = 3):
+
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        for age in ages:
+            func(age)
+        times.append(time.perf_counter() - start)
+
+    return min(times) / len(ages)
+
+def main(argv):
+
+    model_file = argv[1] if len(argv) > 1 else data.getdefault_modelfile()
+    columns = [int(c) for c in argv[2:]] if len(argv) > 2 else [12, 13]
+
+    modelset = data.cmdset('model', 8.0, model_file, columns, cache=False)
+    print('Model file: {:s} ({:d} models, {:d} isochrones)'.format(model_file, len(modelset.ages), len(modelset.isoages)))
+
+    # Ages on and between the model isochrones:
+    np.random.seed(0)
+    ages = np.random.uniform(modelset.isoages[0], modelset.isoages[-1], 200)
+    ages[::2] = np.random.choice(modelset.isoages, 100)
+
+    indexed = per_call(lambda age: isochrone(modelset, age, silent=True), ages)
+
+    # Without the age index, isochrone() falls back to searching every row:
+    isoages, isooffsets = modelset.isoages, modelset.isooffsets
+    modelset.isoages = None
+    scanned = per_call(lambda age: isochrone(modelset, age, silent=True), ages)
+    modelset.isoages = isoages
+
+    # Both give the same isochrone:
+    for age in ages[:10]:
+        a = isochrone(modelset, age, silent=True)
+        modelset.isoages = None
+        b = isochrone(modelset, age, silent=True)
+        modelset.isoages = isoages
+        assert np.array_equal(a.magnitudes.values, b.magnitudes.values)
+
+    print('row search:  {:10.1f} us/call'.format(1e6 * scanned))
+    print('age index:   {:10.1f} us/call'.format(1e6 * indexed))
+    print('speed-up:    {:10.1f}x'.format(scanned / indexed))
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,121 @@
+"""
+  Posterior calls per second for the cluster fit (mode 'all'): the band-by-band
+likelihood (band_lnLikelihood() once per band, each re-interpolating the
+isochrone and giving every star its own mass in each band) against the joint
+likelihood (allband_lnLikelihood(): the isochrone interpolated once, all stars
+in all bands in one expression, one mass per star). Then the cost of one emcee
+step: lnposterior() once per walker against walkers_lnposterior() once for all
+walkers (emcee's vectorize mode), in modes 'all' and 'single'.
+
+Usage:
+    python benchmarks/bench_likelihood.py [model_run_dir] [number of stars] [number of walkers]
+
+Without a model run directory, a synthetic run is written to a temporary
+directory (see cmdfit/tests/mockmodels.py). Stars are drawn from the models'
+own isochrone at [Fe/H] = 0.05, log10 age = 8.6, with 0.03 mag of noise.
+"""
+import sys
+import time
+import shutil
+import tempfile
+import io
+import contextlib
+import numpy as np
+from cmdfit import data
+from cmdfit.statistics import MCMC, likelihood
+from cmdfit.tests import mockmodels
+
+def calls_per_second(func, thetas, mintime = 1.0):
+
+    ncalls = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < mintime:
+        for theta in thetas:
+            func(theta)
+        ncalls += len(thetas)
+
+    return ncalls / (time.perf_counter() - start)
+
+def per_step(func, nsteps, mintime = 1.0):
+
+    steps = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < mintime:
+        for i in range(nsteps):
+            func(i)
+        steps += nsteps
+
+    return (time.perf_counter() - start) / steps
+
+def bandbyband_lnLikelihood(theta, data_cmdset, grid):
+
+    # What allband_lnLikelihood() did before: one band_lnLikelihood() per band.
+    total = 0.0
+    for i in range(data_cmdset.numbands):
+        band = data_cmdset.makeBand(i)
+        total += likelihood.band_lnLikelihood(theta, band[0], band[1], i, grid, grid.FeHs)
+
+    return total
+
+def main(argv):
+
+    tmp_dir = None
+    if len(argv) > 1:
+        run_dir = argv[1]
+    else:
+        tmp_dir = tempfile.mkdtemp()
+        run_dir = tmp_dir
+        mockmodels.write_mockrun(run_dir)
+
+    nstars = int(argv[2]) if len(argv) > 2 else 200
+    nwalkers = int(argv[3]) if len(argv) > 3 else 32
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        grid = data.all_modelcmdsets(8.0, usecol=(12, 13, 14), cache=False, model_dir=run_dir, asgrid=True)
+    grid.eepgrid()
+
+    # A data cmdset of stars drawn from the models:
+    np.random.seed(0)
+    masses = np.random.uniform(0.5, 1.5, nstars)
+    magnitudes = grid.getmags(0.05, 8.6, masses) + 0.03*np.random.randn(nstars, grid.numbands)
+    data_cmdset = data.cmdset.__new__(data.cmdset)
+    data_cmdset.kind = 'data'
+    data_cmdset.numbands = grid.numbands
+    data_cmdset.magnitudes = data.pd.DataFrame(magnitudes, columns=grid.bandnames)
+    data_cmdset.uncertainties = data.pd.DataFrame(np.full(magnitudes.shape, 0.03), columns=grid.bandnames)
+
+    FeH_range = (grid.FeHs[0], grid.FeHs[-1])
+    age_range = (grid.ages[0], grid.ages[-1])
+    thetas = np.column_stack((np.random.uniform(-0.05, 0.1, 50), np.random.uniform(8.4, 8.8, 50)))
+
+    print('{:d} stars in {:d} bands, {:d} [Fe/H]s x {:d} ages'.format(nstars, grid.numbands, len(grid.FeHs), len(grid.ages)))
+
+    old = calls_per_second(lambda theta: bandbyband_lnLikelihood(theta, data_cmdset, grid), thetas)
+    new = calls_per_second(lambda theta: MCMC.lnposterior(theta, data_cmdset, grid, grid.FeHs, FeH_range, age_range), thetas)
+
+    print('band by band:  {:10.1f} posterior calls/s'.format(old))
+    print('joint:         {:10.1f} posterior calls/s'.format(new))
+    print('speed-up:      {:10.1f}x'.format(new / old))
+
+    # One emcee step: every walker's posterior, one call at a time or all at once:
+    print('\n{:d} walkers per step'.format(nwalkers))
+    steps = [np.column_stack((np.random.uniform(-0.05, 0.1, nwalkers), np.random.uniform(8.4, 8.8, nwalkers),
+                              np.random.uniform(0.5, 1.5, nwalkers), np.random.uniform(0.0, 0.5, nwalkers),
+                              np.random.uniform(0.0, 1.0, nwalkers))) for i in range(10)]
+
+    for mode, ndim in (('all', 2), ('single', 5)):
+        args = (data_cmdset, grid, grid.FeHs, FeH_range, age_range, mode, 0)
+        looped = per_step(lambda i: [MCMC.lnposterior(theta, *args) for theta in steps[i][:, :ndim]], len(steps))
+        vectorized = per_step(lambda i: MCMC.walkers_lnposterior(steps[i][:, :ndim], *args), len(steps))
+
+        # Both give the same posterior:
+        assert np.allclose([MCMC.lnposterior(theta, *args) for theta in steps[0][:, :ndim]], MCMC.walkers_lnposterior(steps[0][:, :ndim], *args))
+
+        print('mode {:<7s} per walker: {:9.2f} ms/step   vectorized: {:9.2f} ms/step   speed-up: {:6.1f}x'.format(
+              mode, 1e3 * looped, 1e3 * vectorized, looped / vectorized))
+
+    if tmp_dir != None:
+        shutil.rmtree(tmp_dir)
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,91 @@
+"""
+  Burn-in with and without the optimizer pre-stage (getsamples(map_init=True)):
+the same fits started from the default guesses ([0.15, 8.6] for the cluster,
+[0.10, 8.5, 1.0] for a single star) and from a ball around the MAP found by
+the multi-start optimizer (MCMC.find_map()). Stars are drawn from the models
+at [Fe/H] = -0.05, log10 age = 9.3, away from the default guesses.
+
+For each start, reports the posterior evaluations and time the optimizer
+took, the steps until the walkers' median log-posterior first comes within 1
+of its median over the second half of the chain (the burn-in seen in the
+trace), and the burn-in cut from the autocorrelation time (see
+statistics.diagnostics), as medians over several seeds.
+
+Usage:
+    python benchmarks/bench_mapinit.py [model_run_dir] [number of seeds] [number of steps]
+
+Without a model run directory, a synthetic run is written to a temporary
+directory (see cmdfit/tests/mockmodels.py).
+"""
+import sys
+import time
+import shutil
+import tempfile
+import io
+import contextlib
+import numpy as np
+from cmdfit import data
+from cmdfit.statistics import MCMC, diagnostics
+from cmdfit.tests import mockmodels
+
+def equilibrium_step(lnposteriors):
+
+    # The first step at which the walkers' median log-posterior comes within 1 of its equilibrium value:
+    median = np.median(lnposteriors, axis=1)
+    settled = np.median(lnposteriors[len(lnposteriors) // 2:])
+
+    return int(np.argmax(median >= settled - 1.0))
+
+def main(argv):
+
+    tmp_dir = None
+    if len(argv) > 1:
+        run_dir = argv[1]
+    else:
+        tmp_dir = tempfile.mkdtemp()
+        run_dir = tmp_dir
+        mockmodels.write_mockrun(run_dir)
+
+    nseeds = int(argv[2]) if len(argv) > 2 else 5
+    nsteps = int(argv[3]) if len(argv) > 3 else 400
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        grid = data.all_modelcmdsets(8.0, usecol=(12, 13, 14), cache=False, model_dir=run_dir, asgrid=True)
+    grid.eepgrid()
+
+    np.random.seed(0)
+    masses = np.random.uniform(0.5, 1.2, 100)
+    magnitudes = grid.getmags(-0.05, 9.3, masses) + 0.03*np.random.randn(100, grid.numbands)
+    data_cmdset = data.cmdset.fromdataarrays(magnitudes, np.full(magnitudes.shape, 0.03), grid.bandnames)
+
+    print('{:d} steps, medians over {:d} seeds'.format(nsteps, nseeds))
+    print('{:<8s} {:<9s} {:>12s} {:>14s} {:>16s} {:>14s}'.format('mode', 'start', 'evaluations', 'optimizer (s)', 'trace burn-in', '2 tau burn-in'))
+
+    for mode, ndim, nwalkers in (('all', 2, 16), ('single', 3, 16)):
+        for map_init in (False, True):
+            evaluations, optimizer_times, trace_burnins, tau_burnins = [], [], [], []
+            for seed in range(nseeds):
+                np.random.seed(seed + 1)
+                start = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    sampler, nwalkers, nsteps = MCMC.getsamples(data_cmdset, grid, grid.FeHs, mode=mode, magindex=seed, ndim=ndim,
+                                                                nwalkers=nwalkers, nsteps=nsteps, vectorize=True, map_init=map_init)
+
+                if sampler.mapinit != None:
+                    evaluations.append(sampler.mapinit['evaluations'])
+                    # The optimizer's share of the time, from the cost of one posterior evaluation in the chain:
+                    optimizer_times.append(sampler.mapinit['evaluations'] * (time.perf_counter() - start) / (nsteps * nwalkers + evaluations[-1]))
+
+                trace_burnins.append(equilibrium_step(sampler.get_log_prob()))
+                tau_burnins.append(diagnostics.diagnose(sampler.get_chain())['burnin'])
+
+            print('{:<8s} {:<9s} {:>12s} {:>14s} {:>16.0f} {:>14.0f}'.format(mode, 'MAP' if map_init else 'default',
+                  '{:.0f}'.format(np.median(evaluations)) if evaluations else '-',
+                  '{:.2f}'.format(np.median(optimizer_times)) if optimizer_times else '-',
+                  np.median(trace_burnins), np.median(tau_burnins)))
+
+    if tmp_dir != None:
+        shutil.rmtree(tmp_dir)
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,58 @@
+"""
+  Per-file load time of a MIST .iso.cmd model file: the column-at-a-time reader
+(columnread.get_values, one pass over the file per band) against the single-pass
+reader (columnread.get_modelvalues).
+
+Usage:
+    python benchmarks/bench_modelread.py [model_file] [column indices...]
+
+Defaults to the package's default model file and the 2MASS J, H and Ks columns.
+"""
+import sys
+import time
+import numpy as np
+from cmdfit import data
+from cmdfit.processing import columnread as cread
+
+def best_of(func, repeat = 3):
+
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    return min(times)
+
+def load_percolumn(model_file, columns):
+
+    # What cmdset('model') used to do: one full read of the file per requested column.
+    values = [cread.get_values(model_file, columns[0], mode='model', model_extras=True)]
+    for col in columns[1:]:
+        values.append(cread.get_values(model_file, col, mode='model'))
+
+    return values
+
+def main(argv):
+
+    model_file = argv[1] if len(argv) > 1 else data.getdefault_modelfile()
+    columns = [int(c) for c in argv[2:]] if len(argv) > 2 else [12, 13, 14]
+
+    print('Model file: {:s}'.format(model_file))
+    print('Columns:    {}'.format(columns))
+
+    old = best_of(lambda: load_percolumn(model_file, columns))
+    new = best_of(lambda: cread.get_modelvalues(model_file, columns))
+
+    # Both paths should agree on the values they read:
+    oldvalues = load_percolumn(model_file, columns)
+    newmags, newages, newmasses, newmeta = cread.get_modelvalues(model_file, columns)
+    assert np.array_equal(oldvalues[0][0], newmags[:, 0])
+    assert np.array_equal(oldvalues[0][1], newages)
+
+    print('get_values per column:  {:8.3f} s'.format(old))
+    print('get_modelvalues:        {:8.3f} s'.format(new))
+    print('speed-up:               {:8.1f}x'.format(old / new))
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,125 @@
+"""
+  Strong scaling of the cluster fit (mode 'all') over worker processes: the
+same emcee run (fixed walkers, steps and data) with 1, 2, ... workers, each
+attached to one memory-mapped copy of the model grid (see
+cmdfit/statistics/parallel.py). Reports the wall time (pool start-up
+included), speed-up and parallel efficiency against one process, for walkers
+evaluated one at a time (emcee's pool) and in blocks (emcee's vectorize mode).
+
+The serial fallback of parallel.pool_workers() is switched off here (by
+pool_limits of no overhead and of as many CPUs as max workers), so that the
+pool itself is measured. The script then reports the overhead of a SamplerPool: the time one
+worker takes to evaluate a half-step of walkers, less the time the parent
+takes to evaluate them serially, per task. These are the per-task costs kept
+in parallel.default_pool_limits. With w workers, a
+task has to take more than w / (w - 1) times its overhead for the pool to
+pay.
+
+Usage:
+    python benchmarks/bench_scaling.py [model_run_dir] [max workers] [number of stars] [number of walkers] [number of steps]
+
+The maximum number of workers defaults to the number of CPUs. Without a model
+run directory, a synthetic run is written to a temporary directory (see
+cmdfit/tests/mockmodels.py).
+"""
+import sys
+import os
+import time
+import shutil
+import tempfile
+import io
+import contextlib
+import numpy as np
+from cmdfit import data
+from cmdfit.statistics import MCMC, parallel
+from cmdfit.tests import mockmodels
+
+def main(argv):
+
+    tmp_dir = None
+    if len(argv) > 1:
+        run_dir = argv[1]
+    else:
+        tmp_dir = tempfile.mkdtemp()
+        run_dir = tmp_dir
+        mockmodels.write_mockrun(run_dir)
+
+    maxworkers = int(argv[2]) if len(argv) > 2 else os.cpu_count()
+    nstars = int(argv[3]) if len(argv) > 3 else 200
+    nwalkers = int(argv[4]) if len(argv) > 4 else 32
+    nsteps = int(argv[5]) if len(argv) > 5 else 50
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        grid = data.all_modelcmdsets(8.0, usecol=(12, 13, 14), cache=False, model_dir=run_dir, asgrid=True)
+    grid.eepgrid()
+
+    # A data cmdset of stars drawn from the models:
+    np.random.seed(0)
+    masses = np.random.uniform(0.5, 1.5, nstars)
+    magnitudes = grid.getmags(0.05, 8.6, masses) + 0.03*np.random.randn(nstars, grid.numbands)
+    data_cmdset = data.cmdset.fromdataarrays(magnitudes, np.full(magnitudes.shape, 0.03), grid.bandnames)
+
+    FeH_range = (grid.FeHs[0], grid.FeHs[-1])
+    age_range = (grid.ages[0], grid.ages[-1])
+    args = (data_cmdset, grid, grid.FeHs, FeH_range, age_range, 'all', None, None)
+    starts = np.column_stack((np.random.uniform(-0.05, 0.1, nwalkers), np.random.uniform(8.4, 8.8, nwalkers)))
+
+    print('{:d} stars in {:d} bands, {:d} walkers x {:d} steps, {:d} CPUs'.format(nstars, grid.numbands, nwalkers, nsteps, os.cpu_count()))
+
+    # Measure the pool, not the decision whether to use it:
+    pool_limits = {'cpus': maxworkers, 'walker_overhead': 0.0, 'block_overhead': 0.0}
+
+    # A first run pays for imports and warming up the caches; it is not timed:
+    with contextlib.redirect_stdout(io.StringIO()):
+        MCMC.run_sampler(nwalkers, 2, starts, 2, args)
+        MCMC.run_sampler(nwalkers, 2, starts, 2, args, vectorize=True)
+
+    for vectorize in (False, True):
+        print('\n' + ('vectorized' if vectorize else 'per walker'))
+        print('{:>8s} {:>10s} {:>10s} {:>11s}'.format('workers', 'time (s)', 'speed-up', 'efficiency'))
+
+        serial = None
+        for workers in range(1, maxworkers + 1):
+            np.random.seed(1)
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                MCMC.run_sampler(nwalkers, 2, starts, nsteps, args, vectorize, workers, pool_limits=pool_limits)
+            elapsed = time.perf_counter() - start
+
+            serial = elapsed if serial == None else serial
+            print('{:8d} {:10.2f} {:10.2f} {:10.0%}'.format(workers, elapsed, serial / elapsed, serial / elapsed / workers))
+
+    # The overhead of the pool: one worker against the parent process, on the walkers of a half-step:
+    walkers = starts[:nwalkers // 2]
+    repeats = 20
+    start = time.perf_counter()
+    for i in range(repeats):
+        [MCMC.lnposterior(theta, *args) for theta in walkers]
+    serial_walker = (time.perf_counter() - start) / repeats
+    start = time.perf_counter()
+    for i in range(repeats):
+        MCMC.walkers_lnposterior(walkers, *args)
+    serial_block = (time.perf_counter() - start) / repeats
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        pool = parallel.SamplerPool(1, *args[:5])
+    pool.map(parallel.pool_lnposterior, walkers)
+    start = time.perf_counter()
+    for i in range(repeats):
+        pool.map(parallel.pool_lnposterior, walkers)
+    pooled_walker = (time.perf_counter() - start) / repeats
+    start = time.perf_counter()
+    for i in range(repeats):
+        pool.walkers_lnposterior(walkers)
+    pooled_block = (time.perf_counter() - start) / repeats
+    pool.close()
+
+    print('\npool overhead: {:.2f} ms per walker ({:.2f} ms of work), {:.2f} ms per block ({:.2f} ms of work)'.format(
+          1e3 * (pooled_walker - serial_walker) / len(walkers), 1e3 * serial_walker / len(walkers),
+          1e3 * (pooled_block - serial_block), 1e3 * serial_block))
+
+    if tmp_dir != None:
+        shutil.rmtree(tmp_dir)
+
+if __name__ == '__main__':
+    main(sys.argv)
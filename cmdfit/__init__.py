@@ -1,3 +1,3 @@
 from cmdfit.cmdfit import fitsingle, fitall
-from cmdfit.data import cmdset, all_modelcmdsets, getdefault_datafile, getdefault_modelfile
+from cmdfit.data import cmdset, ModelGrid, all_modelcmdsets, getdefault_datafile, getdefault_modelfile
 from cmdfit.isochrone import isochrone, isointerpmag, isoplotCMD, multiisoCMD
@@ -0,0 +1,482 @@
+import numpy as np
+import pandas as pd
+import argparse
+import json
+import time
+import os
+import sys
+import io
+import contextlib
+from . import data
+from cmdfit.statistics import MCMC, diagnostics
+from cmdfit.statistics.nodecache import NodeCache
+
+# Settings used for anything a run spec leaves out. A spec must at least give the data file, its columns,
+# the model run directory and the model columns; everything else falls back to these:
+default_spec = {'mode': 'single',           # 'single' (fit one star), 'all' (fit the cluster) or 'stars' (fit each star)
+                'data_file': None,          # observed data table
+                'data_columns': None,       # data columns, alternating magnitude and uncertainty
+                'maglim': None,             # (faintest, brightest) magnitudes kept, e.g. [4, 7]
+                'uncertlim': None,          # (lower, upper) uncertainties kept, e.g. [0, 0.5]
+                'nstars': None,             # mode 'all': fit a random sample of this many stars
+                'star_index': None,         # mode 'single': the star to fit (random if not given)
+                'stars': None,              # mode 'stars': indices of the stars to fit (all if not given)
+                'chunksize': None,          # mode 'stars': stars a worker takes at a time (see fitstars())
+                'model_dir': None,          # directory holding a run of model files
+                'model_columns': None,      # model magnitude columns; must match the data's bands
+                'agecut': 8.0,              # models younger than this log10 age are not loaded
+                'workers': None,            # worker processes used to load the model files and evaluate the posterior
+                'ndim': 3,
+                'nwalkers': 10,
+                'nsteps': 300,
+                'burnin': 0.5,              # steps discarded as burn-in: an int, a fraction of nsteps, or 'auto' (from the
+                                            # autocorrelation time, see statistics.diagnostics)
+                'convergence': None,        # stop once the chain converges (within nsteps); a dict of thresholds, {} for defaults
+                'map_init': False,          # start the walkers around the MAP found by an optimizer (needs scipy)
+                'vectorize': False,         # evaluate all walkers of a step in one posterior call
+                'method': 'mcmc',           # mode 'all': 'mcmc' (sample with emcee) or 'grid' (evaluate on a mesh)
+                'resolution': [101, 101],   # method 'grid': mesh points in [Fe/H] and log10 age
+                'nodecache_mb': None,       # mode 'all': cache the likelihood at the grid nodes, in up to this many MB (approximate:
+                                            # the likelihood is interpolated between nodes, see NodeCache)
+                'chain_dir': None,          # stream the chain to this directory as it is sampled, with checkpoints (mode
+                                            # 'stars': one subdirectory per star)
+                'resume': False,            # continue the chain in chain_dir from its last checkpoint
+                'seed': None,
+                'output_dir': 'cmdfit_results'}
+
+required_keys = ['data_file', 'data_columns', 'model_dir', 'model_columns']
+
+param_names = ['[Fe/H]', 'log10 Age', 'Primary Mass', 'Secondary Mass', 'Pfield']
+
+quantiles = [0.16, 0.50, 0.84]
+
+# ==========================================================================================================================
+
+def load_spec(spec_file):
+
+    """
+      Reads a run spec from a .json file and fills in defaults for any settings it leaves out. Relative
+    paths in the spec are taken relative to the spec file's directory.
+    """
+
+    f = open(spec_file)
+    spec = json.load(f)
+    f.close()
+
+    spec_dir = os.path.dirname(os.path.abspath(spec_file))
+    for key in ['data_file', 'model_dir', 'output_dir', 'chain_dir']:
+        if key in spec and spec[key] != None:
+            spec[key] = os.path.join(spec_dir, os.path.expanduser(spec[key]))
+
+    return make_spec(spec)
+
+def make_spec(spec):
+
+    """
+      Returns a copy of the given run spec (a dict) with defaults filled in. Prints an error and returns
+    None if the spec is missing required settings or has unknown ones.
+    """
+
+    unknown = [key for key in spec if key not in default_spec]
+    if unknown:
+        print("ERROR: Unknown setting(s) {} in run spec.".format(unknown))
+        return None
+
+    full_spec = dict(default_spec)
+    full_spec.update(spec)
+
+    missing = [key for key in required_keys if full_spec[key] == None]
+    if missing:
+        print("ERROR: Run spec is missing the required setting(s) {}.".format(missing))
+        return None
+
+    if full_spec['mode'] not in ['single', 'all', 'stars']:
+        print("ERROR: Run spec mode must be 'single', 'all' or 'stars'; got {}.".format(full_spec['mode']))
+        return None
+
+    if full_spec['method'] not in ['mcmc', 'grid'] or (full_spec['method'] == 'grid' and full_spec['mode'] != 'all'):
+        print("ERROR: Run spec method must be 'mcmc', or 'grid' in mode 'all'; got {}.".format(full_spec['method']))
+        return None
+
+    if full_spec['nodecache_mb'] != None and full_spec['mode'] != 'all':
+        print("ERROR: Run spec nodecache_mb only applies in mode 'all'; got mode {}.".format(full_spec['mode']))
+        return None
+
+    if isinstance(full_spec['burnin'], str) and full_spec['burnin'] != 'auto':
+        print("ERROR: Run spec burnin must be a number of steps, a fraction, or 'auto'; got {}.".format(full_spec['burnin']))
+        return None
+
+    if len(full_spec['data_columns']) != 2*len(full_spec['model_columns']):
+        print("ERROR: The data columns (magnitude, uncertainty pairs) do not match the number of model columns.")
+        return None
+
+    return full_spec
+
+def chain_diagnostics(sampler, convergence):
+
+    # The chain's convergence diagnostics, worked out while sampling if it was monitored (see MCMC.run_sampler()):
+    if convergence != None:
+        return sampler.diagnostics
+
+    # Otherwise the whole chain is judged at once, with its first half standing in for an earlier check of
+    # the autocorrelation time (see diagnostics.chain_converged()):
+    chain = sampler.get_chain()
+    diagnosed = diagnostics.diagnose(chain)
+    diagnosed['converged'] = diagnostics.chain_converged(chain, diagnosed)
+
+    return diagnosed
+
+def burnin_steps(burnin, nsteps):
+
+    """
+      Turns a burn-in policy into a number of steps: integers are taken as a step count and floats in [0, 1)
+    as the fraction of the chain to discard.
+    """
+
+    if isinstance(burnin, float) and 0 <= burnin < 1:
+        return int(burnin * nsteps)
+
+    return min(int(burnin), nsteps - 1)
+
+def make_paramsamples(chain, burnin):
+
+    """
+      Flattens a (walkers, steps, parameters) chain into a DataFrame of samples after the burn-in cut.
+    """
+
+    ndim = chain.shape[2]
+    traces = chain[:, burnin:, :].reshape(-1, ndim).T
+
+    return pd.DataFrame({param_names[i]: traces[i] for i in range(ndim)}, columns=param_names[:ndim])
+
+# ==========================================================================================================================
+
+def run(spec):
+
+    """
+      Runs a fit from start to finish as described by a run spec (a dict, or the path of a .json spec file),
+    without asking for any input, and writes the results to the spec's output directory:
+
+        chain.npy, lnprobability.npy  --  the full sampler chain and log-posterior values
+        samples.csv                   --  the samples kept after the burn-in cut
+        quantiles.csv                 --  the 16, 50 and 84% quantiles of each parameter
+        summary.json                  --  the full spec used, the burn-in cut, acceptance fraction, timing,
+                                          node cache counters and convergence diagnostics
+
+    With method 'grid', the posterior is evaluated on a mesh instead (see MCMC.gridposterior()), and
+    surface.csv (the normalized posterior, a row for each [Fe/H] and a column for each log10 age),
+    quantiles.csv and summary.json are written. In mode 'stars', each selected star is fitted on its own
+    (see fitstars()), and stars.csv (a row of quantiles and diagnostics per star) and summary.json are written.
+
+    Returns the parameter samples, their quantiles and the sampler; or with method 'grid', the posterior
+    surface, its quantiles and None; or in mode 'stars', the table of results and two Nones (or None if the
+    spec is invalid).
+    """
+
+    if isinstance(spec, str):
+        spec = load_spec(spec)
+    else:
+        spec = make_spec(spec)
+
+    if spec == None:
+        return None
+
+    start = time.time()
+
+    if spec['seed'] != None:
+        np.random.seed(spec['seed'])
+
+    # Load the observed data, keeping stars within the magnitude and uncertainty limits:
+    data_cmdset = data.cmdset('data', data_file=spec['data_file'], usecol=spec['data_columns'],
+                              maglim=spec['maglim'], uncertlim=spec['uncertlim'])
+
+    if spec['mode'] == 'all':
+        ndim = 2
+        star_index = None
+        if spec['nstars'] != None:
+            data_cmdset.randsamp(spec['nstars'])
+    elif spec['mode'] == 'stars':
+        ndim = spec['ndim']
+        star_index = None
+    else:
+        ndim = spec['ndim']
+        star_index = spec['star_index']
+        if star_index == None:
+            star_index = np.random.randint(len(data_cmdset.magnitudes))
+
+    # Load the models into a grid, in ascending order of [Fe/H]:
+    allmodel_cmdsets = data.all_modelcmdsets(agecut=spec['agecut'], usecol=spec['model_columns'],
+                                             model_dir=spec['model_dir'], workers=spec['workers'], asgrid=True)
+    sortedFeH_list = allmodel_cmdsets.FeHs
+
+    loaded = time.time()
+
+    nodecache = None
+    if spec['mode'] == 'all' and spec['nodecache_mb'] != None:
+        nodecache = NodeCache(allmodel_cmdsets, maxbytes=int(spec['nodecache_mb'] * 2**20))
+
+    info = {'star_index': None if star_index == None else int(star_index), 'nstars': len(data_cmdset.magnitudes)}
+
+    if spec['mode'] == 'stars':
+        if not os.path.isdir(spec['output_dir']):
+            os.makedirs(spec['output_dir'])
+
+        table = fitstars(data_cmdset, allmodel_cmdsets, stars=spec['stars'], ndim=ndim, nwalkers=spec['nwalkers'], nsteps=spec['nsteps'],
+                         burnin=spec['burnin'], convergence=spec['convergence'], map_init=spec['map_init'], vectorize=spec['vectorize'],
+                         chain_dir=spec['chain_dir'], resume=spec['resume'], seed=spec['seed'], workers=spec['workers'],
+                         chunksize=spec['chunksize'], results_file=os.path.join(spec['output_dir'], 'stars.csv'))
+
+        fit_time = time.time() - loaded
+        info.update({'load_time': loaded - start, 'sample_time': fit_time, 'stars_fitted': len(table),
+                     'stars_per_second': len(table) / fit_time})
+        write_summary(spec, info)
+
+        print('Results written to ' + spec['output_dir'])
+
+        return table, None, None
+
+    if spec['method'] == 'grid':
+        result = MCMC.gridposterior(data_cmdset, allmodel_cmdsets, sortedFeH_list, resolution=spec['resolution'],
+                                    workers=spec['workers'], nodecache=nodecache)
+        if result == None:
+            return None
+
+        surface, marginals, q = result
+        info.update({'load_time': loaded - start, 'sample_time': time.time() - loaded,
+                     'nodecache': None if nodecache == None else nodecache.stats()})
+        write_gridresults(spec, surface, q, info)
+
+        print('\nMAP Values:')
+        print(q)
+        print('Results written to ' + spec['output_dir'])
+
+        return surface, q, None
+
+    sampler, nwalkers, nsteps = MCMC.getsamples(data_cmdset, allmodel_cmdsets, sortedFeH_list, mode=spec['mode'],
+                                                magindex=star_index, ndim=ndim, nwalkers=spec['nwalkers'], nsteps=spec['nsteps'],
+                                                vectorize=spec['vectorize'], nodecache=nodecache, workers=spec['workers'],
+                                                chain_dir=spec['chain_dir'], resume=spec['resume'], convergence=spec['convergence'],
+                                                map_init=spec['map_init'])
+
+    sampled = time.time()
+
+    diagnosed = chain_diagnostics(sampler, spec['convergence'])
+    burnin = diagnosed['burnin'] if spec['burnin'] == 'auto' else burnin_steps(spec['burnin'], nsteps)
+    param_samples = make_paramsamples(sampler.chain, burnin)
+    q = param_samples.quantile(quantiles, axis=0)
+
+    info.update({'load_time': loaded - start, 'sample_time': sampled - loaded,
+                 'nodecache': None if nodecache == None else nodecache.stats(), 'diagnostics': diagnosed,
+                 'mapinit': sampler.mapinit})
+    write_results(spec, sampler, param_samples, q, burnin, info)
+
+    print('\nMAP Values:')
+    print(q)
+    print('Results written to ' + spec['output_dir'])
+
+    return param_samples, q, sampler
+
+def write_results(spec, sampler, param_samples, q, burnin, info):
+
+    output_dir = spec['output_dir']
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    np.save(os.path.join(output_dir, 'chain.npy'), sampler.chain)
+    np.save(os.path.join(output_dir, 'lnprobability.npy'), sampler.lnprobability)
+    param_samples.to_csv(os.path.join(output_dir, 'samples.csv'), index=False)
+    q.to_csv(os.path.join(output_dir, 'quantiles.csv'), index_label='quantile')
+
+    summary = {'spec': spec, 'burnin': burnin, 'acceptance_fraction': float(np.mean(sampler.acceptance_fraction))}
+    summary.update(info)
+
+    f = open(os.path.join(output_dir, 'summary.json'), 'w')
+    json.dump(summary, f, indent=2)
+    f.close()
+
+def write_gridresults(spec, surface, q, info):
+
+    output_dir = spec['output_dir']
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    surface.to_csv(os.path.join(output_dir, 'surface.csv'))
+    q.to_csv(os.path.join(output_dir, 'quantiles.csv'), index_label='quantile')
+
+    write_summary(spec, info)
+
+def write_summary(spec, info):
+
+    summary = {'spec': spec}
+    summary.update(info)
+
+    f = open(os.path.join(spec['output_dir'], 'summary.json'), 'w')
+    json.dump(summary, f, indent=2)
+    f.close()
+
+# ==========================================================================================================================
+
+def fitstar(star_index, data_cmdset, allmodel_cmdsets, settings):
+
+    """
+      Fits one star of data_cmdset on its own (mode 'single', as in fitsingle()), without printing, and
+    returns its row of results: the star's index, the quantiles of each parameter, and the chain's length,
+    burn-in, acceptance fraction and convergence diagnostics (the longest autocorrelation time, the largest
+    split R-hat and the smallest effective sample size). settings holds ndim, nwalkers, nsteps, burnin,
+    convergence, map_init, vectorize, chain_dir, resume and seed. With a chain_dir, the star's chain is
+    streamed to its own subdirectory of it (see star_chaindir()), which resume continues.
+
+      With a seed, the star's walkers are seeded with seed + star_index, so its fit does not depend on which
+    process runs it. Without one, the random state is seeded afresh from the operating system for each
+    star, so that stars fitted by worker processes forked with the same state do not share their random
+    numbers.
+    """
+
+    start = time.time()
+
+    np.random.seed(None if settings['seed'] == None else (settings['seed'] + star_index) % 2**32)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        sampler, nwalkers, nsteps = MCMC.getsamples(data_cmdset, allmodel_cmdsets, allmodel_cmdsets.FeHs, mode='single', magindex=star_index,
+                                                    ndim=settings['ndim'], nwalkers=settings['nwalkers'], nsteps=settings['nsteps'],
+                                                    vectorize=settings['vectorize'], chain_dir=star_chaindir(settings['chain_dir'], star_index),
+                                                    resume=settings['resume'], convergence=settings['convergence'], map_init=settings['map_init'])
+
+    diagnosed = chain_diagnostics(sampler, settings['convergence'])
+    burnin = diagnosed['burnin'] if settings['burnin'] == 'auto' else burnin_steps(settings['burnin'], nsteps)
+    q = make_paramsamples(sampler.chain, burnin).quantile(quantiles, axis=0)
+
+    row = {'star': int(star_index)}
+    for name in q.columns:
+        for quantile in quantiles:
+            row['{} {:.2f}'.format(name, quantile)] = q.loc[quantile, name]
+
+    row.update({'steps': int(nsteps), 'burnin': int(burnin), 'acceptance_fraction': float(np.mean(sampler.acceptance_fraction)),
+                'tau': max(diagnosed['tau']), 'rhat': max(diagnosed['rhat']), 'ess': min(diagnosed['ess']),
+                'converged': bool(diagnosed['converged']), 'map_evaluations': None if sampler.mapinit == None else sampler.mapinit['evaluations'],
+                'fit_time': time.time() - start})
+
+    return row
+
+def star_chaindir(chain_dir, star_index):
+
+    # The subdirectory of chain_dir that holds one star's chain in mode 'stars' (None without a chain_dir):
+    if chain_dir == None:
+        return None
+
+    return os.path.join(chain_dir, 'star_{:05d}'.format(int(star_index)))
+
+def fitstars(data_cmdset, allmodel_cmdsets, stars = None, ndim = 3, nwalkers = 10, nsteps = 300, burnin = 0.5, convergence = None,
+             map_init = False, vectorize = False, chain_dir = None, resume = False, seed = None, workers = None, chunksize = None,
+             results_file = None, pool_limits = None):
+
+    """
+      Fits every star of data_cmdset (or those whose indices are given as stars) on its own, with the models
+    loaded once (a ModelGrid), and returns a table of one row of results per star, in order of star index
+    (see fitstar()). burnin, convergence, map_init, vectorize, chain_dir and resume are as in a run spec;
+    each star's chain goes to its own subdirectory of chain_dir.
+
+      With workers > 1 (and more than one CPU, see parallel.pool_workers(), whose limits pool_limits changes),
+    the fits are shared out to a SamplerPool (see statistics.parallel), whose workers attach to one
+    memory-mapped copy of the grid and data. An idle worker takes the next chunksize stars, so workers that
+    get quick fits take more of them (by default, chunks of up to 8 stars, and at least four chunks per
+    worker). Progress and throughput are printed as fits finish. If results_file is given, each row is
+    appended to it (a .csv file) as soon as its fit is done, and the whole table is written to it at the end.
+    """
+
+    if not isinstance(allmodel_cmdsets, data.ModelGrid):
+        allmodel_cmdsets = data.ModelGrid.fromcmdsets(allmodel_cmdsets)
+
+    if isinstance(stars, type(None)):
+        stars = range(len(data_cmdset.magnitudes))
+
+    settings = {'ndim': ndim, 'nwalkers': nwalkers, 'nsteps': nsteps, 'burnin': burnin, 'convergence': convergence, 'map_init': map_init,
+                'vectorize': vectorize, 'chain_dir': chain_dir, 'resume': resume, 'seed': seed}
+    tasks = [(int(star_index), settings) for star_index in stars]
+    nstars = len(tasks)
+
+    if nstars == 0:
+        print('WARNING: No stars to fit.')
+        return pd.DataFrame()
+
+    pool = None
+    if workers != None and workers > 1:
+        from cmdfit.statistics.parallel import pool_workers
+        workers = pool_workers(workers, nstars, limits=pool_limits)
+
+    if workers != None:
+        from cmdfit.statistics.parallel import SamplerPool, pool_fitstar
+
+        if chunksize == None:
+            chunksize = max(1, min(8, nstars // (4 * workers)))
+
+        FeH_range = (allmodel_cmdsets.FeHs[0], allmodel_cmdsets.FeHs[-1])
+        age_range = (allmodel_cmdsets.ages[0], allmodel_cmdsets.ages[-1])
+        pool = SamplerPool(workers, data_cmdset, allmodel_cmdsets, allmodel_cmdsets.FeHs, FeH_range, age_range, mode='single')
+        results = pool.imap_unordered(pool_fitstar, tasks, chunksize)
+    else:
+        results = (fitstar(star_index, data_cmdset, allmodel_cmdsets, settings) for star_index, settings in tasks)
+
+    print('\nFitting {:d} stars...\n'.format(nstars))
+
+    rows = []
+    report_every = max(1, nstars // 20)
+    start = time.time()
+    f = None if results_file == None else open(results_file, 'w')
+    try:
+        for row in results:
+            rows.append(row)
+
+            if f != None:
+                pd.DataFrame([row]).to_csv(f, header=(len(rows) == 1), index=False)
+                f.flush()
+
+            if len(rows) % report_every == 0 or len(rows) == nstars:
+                elapsed = time.time() - start
+                rate = len(rows) / elapsed
+                print('{:d}/{:d} stars fitted ({:.2f} stars/s, {:.0f} s to go)'.format(len(rows), nstars, rate, (nstars - len(rows)) / rate))
+    finally:
+        if f != None:
+            f.close()
+        if pool != None:
+            pool.close()
+
+    print('DONE: {:d} stars in {:.1f} s\n'.format(nstars, time.time() - start))
+
+    table = pd.DataFrame(rows).sort_values('star').reset_index(drop=True)
+    if results_file != None:
+        table.to_csv(results_file, index=False)
+
+    return table
+
+# ==========================================================================================================================
+
+def main(argv = None):
+
+    parser = argparse.ArgumentParser(prog='python -m cmdfit.batch', description='Run cmdfit fits from .json run specs, without prompts.')
+    parser.add_argument('specs', nargs='+', help='run spec (.json) files; each is run in turn')
+    parser.add_argument('--output-dir', help='write results here instead of the output_dir in the spec (one subdirectory per spec)')
+    parser.add_argument('--resume', action='store_true', help="continue each spec's chain_dir chain from its last checkpoint")
+    args = parser.parse_args(argv)
+
+    failed = 0
+    for spec_file in args.specs:
+        spec = load_spec(spec_file)
+        if spec == None:
+            failed += 1
+            continue
+
+        if args.output_dir != None:
+            name = os.path.splitext(os.path.basename(spec_file))[0]
+            spec['output_dir'] = os.path.join(args.output_dir, name)
+
+        if args.resume:
+            spec['resume'] = True
+
+        if run(spec) == None:
+            failed += 1
+
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
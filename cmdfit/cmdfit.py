@@ -1,15 +1,15 @@
 import numpy as np
 from . import data
-import emcee
 import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
-import corner
 from cmdfit.statistics import MCMC
+from cmdfit.statistics.nodecache import NodeCache
 from cmdfit.processing import interp
+from cmdfit.processing import magcorrections as magcorr
 from . import isochrone as iso
 
-def fitall(mode = 'data', test_age = 9.0, nwalkers=10, nsteps=300, data_file = None, datausecol=None, modelusecol=None, default=False, test=False):
+def fitall(mode = 'data', test_age = 9.0, nwalkers=10, nsteps=300, data_file = None, datausecol=None, modelusecol=None, default=False, test=False,
+           nodecache_mb = None, method = 'mcmc', resolution = (101, 101), workers = None, chain_dir = None, resume = False,
+           convergence = None, map_init = False):
 
     """
     This function determines the likelihood of the data being produced by a
@@ -19,8 +19,31 @@ def fitall(mode = 'data', test_age = 9.0, nwalkers=10, nsteps=300, data_file = N
 
     Input:
 
+        method = 'mcmc' samples the posterior of [Fe/H] and log10 age with emcee; method = 'grid' evaluates
+        it on a mesh of resolution = (number of [Fe/H]s, number of ages) points over the model grid instead,
+        with workers processes (see MCMC.gridposterior()). With method = 'mcmc', workers processes evaluate
+        the walkers (see MCMC.run_sampler()).
+
+        chain_dir streams the chain to that directory as it is sampled; with resume = True, a run stopped
+        part of the way through continues from its last checkpoint there (see MCMC.getsamples()).
+
+        convergence (a dict of thresholds, see statistics.diagnostics; {} for the defaults) makes nsteps a
+        maximum: sampling stops once the chain has converged, and the burn-in is cut from its autocorrelation
+        time rather than asked for. The diagnostics are kept as sampler.diagnostics.
+
+        nodecache_mb caches each star's likelihood at the nodes of the model grid (in up to that many MB)
+        and interpolates it between them (see statistics.nodecache.NodeCache). This is faster, but only
+        approximate: between nodes the likelihood is interpolated rather than the isochrones, so the
+        posterior sampled is not quite the one sampled without the cache.
+
+        map_init = True starts the walkers around the posterior's highest mode, found by a multi-start
+        optimizer (needs scipy), instead of around [0.15, 8.6] (see MCMC.map_walkers()).
+
     Output:
 
+        param_samples and the sampler (method = 'mcmc'), or the posterior surface, its marginals and their
+        quantiles (method = 'grid').
+
     WIP...
     
     """
@@ -37,25 +60,52 @@ def fitall(mode = 'data', test_age = 9.0, nwalkers=10, nsteps=300, data_file = N
         data_cmdset = iso.isochrone(data_cmdset, test_age)
         data_cmdset.isorandsamp(2)
     
-    # Load a set of model cmds; the user will select which directory to load from:
-    allmodel_cmdsets = data.all_modelcmdsets(agecut=8.0, usecol=modelusecol, default=default)
-    
-    # Arranging cmds in ascending order according to metallicity; this is necesary
-    # for the finding function in interp.py to work...
-    FeH_list = [cmdset.FeH for cmdset in allmodel_cmdsets]
-    sortedFeH_list = np.array(sorted(FeH_list))    
-
-    # Sort models into ascending order in [Fe/H]:
-    allmodel_cmdsets.sort(key=lambda model: model.FeH)
+    # Load a set of model cmds; the user will select which directory to load from. They are packed
+    # into a ModelGrid (in ascending order of metallicity), which interpolates the model magnitudes:
+    allmodel_cmdsets = data.all_modelcmdsets(agecut=8.0, usecol=modelusecol, default=default, asgrid=True)
+    sortedFeH_list = allmodel_cmdsets.FeHs
 
     ndim = 2
 
+    # Optionally, cache the likelihood at the grid nodes (up to nodecache_mb megabytes) and interpolate it
+    # between them:
+    nodecache = None
+    if nodecache_mb != None:
+        nodecache = NodeCache(allmodel_cmdsets, maxbytes=int(nodecache_mb * 2**20))
+
+    # With only [Fe/H] and age to fit, the posterior can be evaluated everywhere on the model grid:
+    if method == 'grid':
+        result = MCMC.gridposterior(data_cmdset, allmodel_cmdsets, sortedFeH_list, resolution=resolution, workers=workers, nodecache=nodecache)
+        if test or isinstance(result, type(None)):
+            return result
+
+        surface, marginals, q = result
+        print(q)
+        print()
+
+        import matplotlib.pyplot as plt
+
+        plot_foundisos(q, sortedFeH_list, data_cmdset, allmodel_cmdsets, ndim, random_index = None)
+
+        plt.contourf(surface.columns, surface.index, surface.values, 20)
+        plt.xlabel('log10 Age')
+        plt.ylabel('[Fe/H]')
+        plt.show()
+
+        return surface, marginals, q
+
     # Run MCMC with the supplied models and observed data:
-    sampler, nwalkers, nsteps = MCMC.getsamples(data_cmdset, allmodel_cmdsets, sortedFeH_list, mode = 'all', ndim=ndim, nwalkers=nwalkers, nsteps=nsteps)
+    sampler, nwalkers, nsteps = MCMC.getsamples(data_cmdset, allmodel_cmdsets, sortedFeH_list, mode = 'all', ndim=ndim, nwalkers=nwalkers, nsteps=nsteps,
+                                                nodecache=nodecache, workers=workers, chain_dir=chain_dir, resume=resume,
+                                                convergence=convergence, map_init=map_init)
 
     if test:
         return sampler
 
+    # Plotting libraries are only loaded once there is something to plot:
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
     fig, (ax_feh, ax_age) = plt.subplots(2)
     ax_feh.set(ylabel='[Fe/H]')
     ax_age.set(ylabel='log10 Age')
@@ -71,7 +121,12 @@ def fitall(mode = 'data', test_age = 9.0, nwalkers=10, nsteps=300, data_file = N
     
     sns.plt.show()
 
-    burnin_cut = eval(input("Enter an integer for where to cutoff the burn-in period: "))    
+    # With convergence monitoring, the burn-in comes from the chain's autocorrelation time:
+    if convergence != None:
+        burnin_cut = sampler.diagnostics['burnin']
+        print('Burn-in cut from the autocorrelation time: {:d} steps'.format(burnin_cut))
+    else:
+        burnin_cut = eval(input("Enter an integer for where to cutoff the burn-in period: "))    
 
     samples = sampler.chain[:,burnin_cut:,:]
     traces = samples.reshape(-1,2).T
@@ -91,7 +146,8 @@ def fitall(mode = 'data', test_age = 9.0, nwalkers=10, nsteps=300, data_file = N
 
     return param_samples, sampler
 
-def fitsingle(mode, ndim = 3, nwalkers=10, nsteps=300, data_file = None, datausecol=None, modelusecol=None, default=False, test=False):
+def fitsingle(mode, ndim = 3, nwalkers=10, nsteps=300, data_file = None, datausecol=None, modelusecol=None, default=False, test=False,
+              chain_dir = None, resume = False, convergence = None, map_init = False):
 
     if mode == 'data':
         # load an observed cmd:
@@ -111,31 +167,33 @@ def fitsingle(mode, ndim = 3, nwalkers=10, nsteps=300, data_file = None, datause
         random_index = 20450
 
     # Load a set of model cmds; the user will select which directory to load from
-    # and cut models with ages below log 10 age = 8.0:
-    allmodel_cmdsets = data.all_modelcmdsets(agecut = 8.0, usecol=modelusecol, default=default)
+    # and cut models with ages below log 10 age = 8.0. They are packed into a ModelGrid 
+    # (in ascending order of metallicity), which interpolates the model magnitudes:
+    allmodel_cmdsets = data.all_modelcmdsets(agecut = 8.0, usecol=modelusecol, default=default, asgrid=True)
     print('\nMODELS LOADED...')
 
-    # Arranging cmds in ascending order according to metallicity; this is necesary
-    # for the finding function in interp.py to work...
-
-    # Make a list of available FeH values in ascending order:
-    FeH_list = [cmdset.FeH for cmdset in allmodel_cmdsets]
-    sortedFeH_list = np.array(sorted(FeH_list))    
-    
-    # Sort the models in ascending order of FeH:
-    allmodel_cmdsets.sort(key=lambda model: model.FeH)
+    # The available FeH values in ascending order:
+    sortedFeH_list = allmodel_cmdsets.FeHs
 
     # Run MCMC with the supplied models and observed data (should make magindex selectable):
     if mode == 'modeltest':
         sampler, nwalkers, nsteps, model_params = MCMC.getsamples(data_cmdset, allmodel_cmdsets, sortedFeH_list,
-                                                                    mode='single', magindex= random_index,ndim= ndim, nwalkers=nwalkers, nsteps=nsteps)
+                                                                    mode='single', magindex= random_index,ndim= ndim, nwalkers=nwalkers, nsteps=nsteps,
+                                                                    chain_dir=chain_dir, resume=resume, convergence=convergence,
+                                                                    map_init=map_init)
     else:
         sampler, nwalkers, nsteps = MCMC.getsamples(data_cmdset, allmodel_cmdsets, sortedFeH_list, 
-                                                      mode='single', magindex= random_index,ndim= ndim, nwalkers=nwalkers, nsteps=nsteps)
+                                                      mode='single', magindex= random_index,ndim= ndim, nwalkers=nwalkers, nsteps=nsteps,
+                                                      chain_dir=chain_dir, resume=resume, convergence=convergence,
+                                                      map_init=map_init)
 
     if test:
         return sampler
 
+    # Plotting libraries are only loaded once there is something to plot:
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
     if ndim == 3:
         fig, (ax_feh, ax_age, ax_M1) = plt.subplots(ndim)
         ax_feh.set(ylabel='[Fe/H]')
@@ -172,7 +230,12 @@ def fitsingle(mode, ndim = 3, nwalkers=10, nsteps=300, data_file = None, datause
                 sns.tsplot(sampler.chain[i,:,4], ax=ax_Pf)
 
     sns.plt.show()
-    burnin_cut = eval(input("Enter an integer for where to cut off the burn-in period: "))    
+    # With convergence monitoring, the burn-in comes from the chain's autocorrelation time:
+    if convergence != None:
+        burnin_cut = sampler.diagnostics['burnin']
+        print('Burn-in cut from the autocorrelation time: {:d} steps'.format(burnin_cut))
+    else:
+        burnin_cut = eval(input("Enter an integer for where to cut off the burn-in period: "))    
 
     samples = sampler.chain[:,burnin_cut:,:]
     traces = samples.reshape(-1, ndim).T
@@ -200,6 +263,8 @@ def fitsingle(mode, ndim = 3, nwalkers=10, nsteps=300, data_file = None, datause
         print(model_params)
         print()
 
+        import corner
+
         if ndim == 3:
             fig = corner.corner(samples.reshape(-1, ndim), labels=["$[Fe/H]$", "$log_{10} Age$", "$M_1$"], truths=model_params)
         if ndim == 4:
@@ -217,6 +282,7 @@ def fitsingle(mode, ndim = 3, nwalkers=10, nsteps=300, data_file = None, datause
 
 def plot_foundisos(q, sortedFeH_list, data_cmdset, allmodel_cmdsets, ndim, random_index = None):
 
+    import matplotlib.pyplot as plt
 
     # Right now this stuff tries to plot the star input with the MAP isochrone found.
     # Its not done in a great way right now, need to interpolate to be more accurate maybe.
@@ -234,14 +300,14 @@ def plot_foundisos(q, sortedFeH_list, data_cmdset, allmodel_cmdsets, ndim, rando
   
         # If plotting fitting a single data point, find the stars the MAP values are suggesting and show them too:
         if random_index != None:
-            foundstar_mags = [isofound.isogetmag(q['Primary Mass'][rev_quant[j]], i) for i in range(modelset.numbands)]
+            foundstar_mags = isofound.getmags(q['Primary Mass'][rev_quant[j]])[0]
 
             # If available, plot the secondary mass' magnitude too:
             if ndim == 4:
                 # Get partner's magnitudes:
-                foundstar2_mags = [isofound.isogetmag(q['Secondary Mass'][rev_quant[j]], i) for i in range(modelset.numbands)]
+                foundstar2_mags = isofound.getmags(q['Secondary Mass'][rev_quant[j]])[0]
                 # Combine primary and secondary magnitudes:
-                fullmag = [-2.5 * np.log10(10**(-foundstar_mags[i]/2.5) + 10**(-foundstar2_mags[i]/2.5)) for i in range(modelset.numbands)]
+                fullmag = magcorr.combine_mags(foundstar_mags, foundstar2_mags)
                 if np.isfinite(fullmag[0]) and np.isfinite(fullmag[1]):
                     plt.errorbar(foundstar2_mags[0] - foundstar2_mags[1], foundstar2_mags[1], color = 'b', fmt = 'o', label='Model Star {:d}'.format(j))
                     # Plot the full, combined magnitude point:
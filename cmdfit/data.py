@@ -2,15 +2,17 @@
 import numpy as np
 import pandas as pd
 import os
-import matplotlib.pyplot as plt
 from cmdfit.processing import columnread as cread
 from cmdfit.processing import userinteract as user
 from cmdfit.processing import interp as interp
+from cmdfit.processing import magcorrections as magcorr
+from cmdfit.processing import modelcache
 from . import isochrone as iso
 
 class cmdset(object):
     
-    def __init__(self, kind = 'data', agecut = 0, data_file = None, usecol = None):
+    def __init__(self, kind = 'data', agecut = 0, data_file = None, usecol = None, cache = True, agemax = None, massrange = None,
+                   maglim = None, uncertlim = None, chunksize = 100000):
 
         def loadData(readmode='data', data_file = None, usecol = None):
 
@@ -128,7 +130,7 @@ class cmdset(object):
                     dataMatrix.append(masses)
                     dataNames.append('Initial Mass')
                     # In MIST model files, FeH is the 3rd entry in the metadata line.
-                    self.FeH = eval(metadata[2])
+                    self.FeH = float(metadata[2])
                 
                 # Store magnitudes in the data matrix, for models these columns will follow age and mass columns:
                 print(usecol)
@@ -183,25 +185,91 @@ class cmdset(object):
             # For models return age, mass, and magnitudes:
             return loadedData
 
-        # === Attributes ===: 
+        def loadModel(data_file = None, usecol = None):
+
+            # Model files are read in a single pass, so the magnitude columns are selected
+            # up front and then all read out of the same buffer.
+            modelfile_skippedcols = 7
+
+            if data_file == None:
+                selected_run_path = select_pathtofile('model')
+                data_file = user.select_a_dir(selected_run_path, type_flag = 2)
+
+            if isinstance(usecol, type(None)):
+                # Have the user select columns; header_select_col() skips the non-magnitude
+                # columns, so the index offset is applied here:
+                usecol = []
+                keepgoing = True
+                while keepgoing:
+                    usecol.append(cread.header_select_col(data_file, 'model', silent=len(usecol) > 0) + modelfile_skippedcols)
+                    response = user.ask_for_specific_input('\n================================\nWould you like to enter another filter as data? ', 'y', 'n')
+                    keepgoing = response == 'y'
+                # Report magnitude correction and header info on the first model:
+                silent_flag = False
+            else:
+                # If loading in subsequent models via all_modelcmdsets(), suppress notifications:
+                silent_flag = True
+
+            self.usedcolumns = np.array(usecol)
+            self.numbands = len(self.usedcolumns)
+
+            # Rows outside of the age and mass cuts are skipped while the file is read:
+            self.FeH, self.eeps, loadedData = read_modelfile(data_file, self.usedcolumns, cache=cache, silent=silent_flag,
+                                                               agecut=agecut if 5.0 <= agecut <= 10.0 else None,
+                                                                 agemax=agemax, massrange=massrange)
+
+            return loadedData
+
+        def loadCatalog(data_file = None, usecol = None):
+
+            # With the columns given, a data table is streamed through in chunks and the 
+            # magnitude/uncertainty cuts are applied as it is read.
+            if data_file == None:
+                specific_data_dir = select_pathtofile('data')
+                data_file = user.select_a_dir(specific_data_dir, 2)
+
+            # Given columns alternate between magnitudes and their uncertainties:
+            self.usedcolumns = np.array(usecol)
+            mag_columns = self.usedcolumns[0::2]
+            uncert_columns = self.usedcolumns[1::2]
+            self.numbands = len(mag_columns)
+
+            hlist = cread.get_header(data_file, 'data')
+            dataNames = [hlist[col] for col in mag_columns]
+            uncertNames = [hlist[col] for col in uncert_columns]
+
+            print('------------------------------------------------------------------------')
+            print('ASSIGNING {:s}...'.format(', '.join(dataNames + uncertNames)) + 'for ' + data_file.split('/')[-1])
+
+            magnitudes, uncertainties = cread.stream_datacolumns(data_file, mag_columns, uncert_columns, maglims=maglim, 
+                                                                   uncertlims=uncertlim, chunksize=chunksize)
+
+            return pd.DataFrame(magnitudes, columns = dataNames), pd.DataFrame(uncertainties, columns = uncertNames), data_file
+
+        # === Attributes ===:
         if kind == 'data':
-            self.magnitudes, self.uncertainties, filename = loadData(readmode = 'data', data_file=data_file, usecol=usecol)
+            if isinstance(usecol, type(None)):
+                self.magnitudes, self.uncertainties, filename = loadData(readmode = 'data', data_file=data_file, usecol=usecol)
+                if maglim is not None:
+                    self.datacutmags(*maglim)
+                if uncertlim is not None:
+                    self.cutuncert(*uncertlim)
+            else:
+                self.magnitudes, self.uncertainties, filename = loadCatalog(data_file=data_file, usecol=usecol)
             self.filename = filename.split('/')[-1]
         
         elif kind == 'model':
+            # Age and mass cuts are applied while the model file is read, so the loaded frame 
+            # only ever holds the selected models:
+            self.fullframe = loadModel(data_file=data_file, usecol=usecol)
             if 5.0 <= agecut <= 10.0:
-                self.fullframe = loadData(readmode = 'model', data_file=data_file, usecol=usecol)
-                indices = np.where(self.fullframe['log10 age'].values >= agecut)[0]
-                self.cutframe = self.fullframe.ix[indices,:].reset_index(drop=True)
-                self.ages = self.cutframe.ix[:, 'log10 age']
-                self.initmasses = self.cutframe.ix[:, 'Initial Mass']
-                self.magnitudes = self.cutframe.ix[:, 2:]
-            else:
-                self.fullframe = loadData(readmode = 'model', data_file=data_file, usecol=usecol)
-                self.ages = self.fullframe.ix[:, 'log10 age']
-                self.initmasses = self.fullframe.ix[:, 'Initial Mass']
-                self.magnitudes = self.fullframe.ix[:, 2:]
-                # Also load info on other params...
+                self.cutframe = self.fullframe
+            self.ages = self.fullframe.loc[:, 'log10 age']
+            self.initmasses = self.fullframe.loc[:, 'Initial Mass']
+            self.magnitudes = self.fullframe.iloc[:, 2:]
+            # Index the rows of each isochrone for fast lookups:
+            self.makeageindex()
+            # Also load info on other params...
 
         elif kind == 'modeltest':
             if 5.0 <= agecut <= 10.0:
@@ -230,7 +298,7 @@ class cmdset(object):
             print('\nERROR: This is a model cmdset and makeBands() will only operate on data sets.\n')
             return
         
-        banddata = [self.magnitudes.ix[:, bandindex].values, self.uncertainties.ix[:, bandindex].values]
+        banddata = [self.magnitudes.iloc[:, bandindex].values, self.uncertainties.iloc[:, bandindex].values]
 
         return banddata
        
@@ -246,15 +314,15 @@ class cmdset(object):
         # between cmdsets needs to be done.
 
         # Available ages in the cmdset:
-        age_array = self.ages.values
-        age_max = np.amax(age_array)
-        age_min = np.amin(age_array)
+        age_array = self.isoages
+        age_max = age_array[-1]
+        age_min = age_array[0]
 
         # Check if the proposed age is within the valid range:
         if age_min < age < age_max:
 
             # If the age does not exist, but it is within range of valid values:
-            if age not in age_array:
+            if age_array[np.searchsorted(age_array, age)] != age:
 
                 mag = iso.isointerpmag(self, initmass, age, age_array, band)                
 
@@ -266,7 +334,7 @@ class cmdset(object):
             # invalid masses):
             else:
                 isoch = iso.isochrone(self, age)
-                return isoch.isogetmag(self, initmass, band)
+                return isoch.isogetmag(initmass, band)
 
         # Or else if the proposed age is invalid, return an infinite magnitude to
         # trigger 0 probability for this proposition:
@@ -276,61 +344,23 @@ class cmdset(object):
     # Confines a datasets magnitudes to a certain range:
     def datacutmags(self, lowerlim, upperlim):
 
+        # Keep the stars whose magnitudes lie within the limits in every band:
+        magnitudes = self.magnitudes.values[:, :self.numbands]
+        keep = np.all((magnitudes >= lowerlim) & (magnitudes <= upperlim), axis=1)
 
-        for i in range(self.numbands):
-            #l_indices_tocut = np.where(self.magnitudes.ix[:,i].values < lowerlim)[0]
-            u_indices_tocut = np.where(self.magnitudes.ix[:,i].values > upperlim)[0]
-            
-            if u_indices_tocut.size == 0:
-                pass
-            else:
-                self.magnitudes = self.magnitudes.drop(self.magnitudes.index[u_indices_tocut])
-                self.uncertainties = self.uncertainties.drop(self.uncertainties.index[u_indices_tocut])
-                self.magnitudes = self.magnitudes.reset_index(drop=True)
-                self.uncertainties = self.uncertainties.reset_index(drop=True)
-
-            l_indices_tocut = np.where(self.magnitudes.ix[:,i].values < lowerlim)[0]
-            
-            if l_indices_tocut.size == 0:
-                pass
-            else:
-                self.magnitudes = self.magnitudes.drop(self.magnitudes.index[l_indices_tocut])
-                self.uncertainties = self.uncertainties.drop(self.uncertainties.index[l_indices_tocut])
-                self.magnitudes = self.magnitudes.reset_index(drop=True)
-                self.uncertainties = self.uncertainties.reset_index(drop=True)
-
-        self.magnitudes = self.magnitudes.reset_index(drop=True)
-        self.uncertainties = self.uncertainties.reset_index(drop=True)
+        self.magnitudes = self.magnitudes[keep].reset_index(drop=True)
+        self.uncertainties = self.uncertainties[keep].reset_index(drop=True)
 
         return
 
     def cutuncert(self, lowerlim, upperlim):
 
+        # Keep the stars whose uncertainties lie within the limits in every band:
+        uncertainties = self.uncertainties.values[:, :self.numbands]
+        keep = np.all((uncertainties >= lowerlim) & (uncertainties <= upperlim), axis=1)
 
-        for i in range(self.numbands):
-            #l_indices_tocut = np.where(self.uncertainties.ix[:,i].values < lowerlim)[0]
-            u_indices_tocut = np.where(self.uncertainties.ix[:,i].values > upperlim)[0]
-            
-            if u_indices_tocut.size == 0:
-                pass
-            else:
-                self.uncertainties = self.uncertainties.drop(self.uncertainties.index[u_indices_tocut])
-                self.magnitudes = self.magnitudes.drop(self.magnitudes.index[u_indices_tocut])
-                self.magnitudes = self.magnitudes.reset_index(drop=True)
-                self.uncertainties = self.uncertainties.reset_index(drop=True)
-
-            l_indices_tocut = np.where(self.magnitudes.ix[:,i].values < lowerlim)[0]
-            
-            if l_indices_tocut.size == 0:
-                pass
-            else:
-                self.uncertainties = self.uncertainties.drop(self.uncertainties.index[l_indices_tocut])
-                self.magnitudes = self.magnitudes.drop(self.magnitudes.index[l_indices_tocut])
-                self.magnitudes = self.magnitudes.reset_index(drop=True)
-                self.uncertainties = self.uncertainties.reset_index(drop=True)
-
-        self.magnitudes = self.magnitudes.reset_index(drop=True)
-        self.uncertainties = self.uncertainties.reset_index(drop=True)
+        self.magnitudes = self.magnitudes[keep].reset_index(drop=True)
+        self.uncertainties = self.uncertainties[keep].reset_index(drop=True)
 
         return
 
@@ -349,89 +379,704 @@ class cmdset(object):
         
         return isoset
 
+    # Indexes where each isochrone lies in a model cmdset:
+    def makeageindex(self):
+
+        """
+          Finds the sorted unique ages of a model cmdset (isoages) and the (start, stop) rows of each age's
+        isochrone (isooffsets), so that an isochrone can be found by a binary search and taken as a slice.
+        Model files list their isochrones in order of age; if the rows are not in that order, they are
+        put in order (keeping the order within each isochrone) first.
+        """
+
+        age_array = self.ages.values
+
+        if np.any(np.diff(age_array) < 0):
+            order = np.argsort(age_array, kind='mergesort')
+            self.fullframe = self.fullframe.iloc[order].reset_index(drop=True)
+            if hasattr(self, 'eeps'):
+                self.eeps = self.eeps[order]
+            self.ages = self.fullframe.loc[:, 'log10 age']
+            self.initmasses = self.fullframe.loc[:, 'Initial Mass']
+            self.magnitudes = self.fullframe.iloc[:, 2:]
+            age_array = self.ages.values
+
+        self.isoages = np.unique(age_array)
+        self.isooffsets = np.column_stack((np.searchsorted(age_array, self.isoages, side='left'),
+                                           np.searchsorted(age_array, self.isoages, side='right')))
+
+        return
+
+    # All bands of a data cmdset at once:
+    def getbands(self):
+
+        """
+          Returns the magnitudes and their uncertainties as arrays of shape (number of stars, number of bands).
+        """
+
+        return self.magnitudes.values[:, :self.numbands], self.uncertainties.values[:, :self.numbands]
+
+    # Field star density in each band:
+    def getfieldlndensity(self):
+
+        """
+          Returns the log of the field star density in each band, log(1 / (max - min)) of the observed
+        magnitudes: field stars are taken to be spread uniformly over the range of the data. It is worked
+        out once and kept until the data's magnitudes change (e.g. are cut or resampled).
+        """
+
+        if getattr(self, '_fieldframe', None) is not self.magnitudes:
+            magnitudes = self.magnitudes.values[:, :self.numbands]
+            self._fieldlndensity = -np.log(np.amax(magnitudes, axis=0) - np.amin(magnitudes, axis=0))
+            self._fieldframe = self.magnitudes
+
+        return self._fieldlndensity
+
     # Random sampling of dataset:
     def randsamp(self, samplenum):
     
         if self.kind == 'data':
             self.magnitudes = self.magnitudes.sample(samplenum)
             indices = self.magnitudes.index
-            self.uncertainties = self.uncertainties.ix[indices].reset_index(drop=True)
+            self.uncertainties = self.uncertainties.loc[indices].reset_index(drop=True)
             self.magnitudes = self.magnitudes.reset_index(drop=True)
         
         return
-                
+
+    # Makes a model cmdset around arrays that have already been loaded (e.g. by a ModelGrid),
+    # without copying them:
+    @classmethod
+    def frommodelarrays(cls, FeH, eeps, table, bandnames, usedcolumns, isoages = None, isooffsets = None):
+
+        """
+          Creates a model cmdset from the given [Fe/H], EEPs and table, whose columns hold log10 age, 
+        initial mass and then the magnitudes named by bandnames. The data frames are views of table.
+        If the isochrone ages and row offsets are not given, they are worked out from the table.
+        """
+
+        modelset = cls.__new__(cls)
+        modelset.kind = 'model'
+        modelset.FeH = FeH
+        modelset.eeps = eeps
+        modelset.usedcolumns = np.array(usedcolumns)
+        modelset.numbands = len(bandnames)
+        modelset.fullframe = pd.DataFrame(table, columns = ['log10 age', 'Initial Mass'] + list(bandnames), copy = False)
+        modelset.ages = modelset.fullframe.loc[:, 'log10 age']
+        modelset.initmasses = modelset.fullframe.loc[:, 'Initial Mass']
+        modelset.magnitudes = modelset.fullframe.iloc[:, 2:]
+
+        if isinstance(isoages, type(None)):
+            modelset.makeageindex()
+        else:
+            modelset.isoages = isoages
+            modelset.isooffsets = isooffsets
+
+        return modelset
+
+    # Makes a data cmdset around arrays of magnitudes and uncertainties (e.g. memory-mapped ones):
+    @classmethod
+    def fromdataarrays(cls, magnitudes, uncertainties, bandnames, filename = None):
+
+        """
+          Creates a data cmdset from arrays of shape (number of stars, number of bands) holding the magnitudes
+        and their uncertainties in the bands named by bandnames.
+        """
+
+        dataset = cls.__new__(cls)
+        dataset.kind = 'data'
+        dataset.numbands = len(bandnames)
+        dataset.magnitudes = pd.DataFrame(magnitudes, columns = list(bandnames), copy = False)
+        dataset.uncertainties = pd.DataFrame(uncertainties, columns = [name + 'err' for name in bandnames], copy = False)
+        dataset.filename = filename
+
+        return dataset
+
 
 
 # For getting magnitudes across cmdsets:
 def getcmdsetsmag(allmodel_cmdsets, age, initmass, FeH, FeH_list, data_bandindex, secondarymass = None):
 
+    # A ModelGrid interpolates in [Fe/H], age and mass (and combines binaries) in one pass:
+    if isinstance(allmodel_cmdsets, ModelGrid):
+        return allmodel_cmdsets.getmags(FeH, age, initmass, secondarymass, bands=data_bandindex)[0, 0]
+
     # Here I should check on interpolating between metallicities; 
     # if necessary, getmag from two nearest cmdsets and interpolate 
     # a new magnitude at the given metallicity if the given metallicity 
     # does not exist. Check an input list of available metallicities:
-    FeH_max = np.amax(FeH_list)
-    FeH_min = np.amin(FeH_list)
-
-    # If the given metallicity was not found, but it is within valid range:
-    if (FeH not in FeH_list) and (FeH_min <= FeH <= FeH_max):
-        # Find cmdsets with closest FeH:
-        FeHrich, FeHpoor, FeHrich_index, FeHpoor_index = interp.find_closestFeHs(FeH, FeH_list)
-
-        # Calculate model magnitudes from each:
-        FeHrich_mag = allmodel_cmdsets[FeHrich_index].getmag(age, initmass, data_bandindex)
-        FeHpoor_mag = allmodel_cmdsets[FeHpoor_index].getmag(age, initmass, data_bandindex)
-
-        if secondarymass != None:
-            FeHrich_mag2 = allmodel_cmdsets[FeHrich_index].getmag(age, secondarymass, data_bandindex)
-            FeHpoor_mag2 = allmodel_cmdsets[FeHpoor_index].getmag(age, secondarymass, data_bandindex)
-
-        # If both interpolated magnitudes were produced from values within valid ranges of mass and age:
-            if np.isfinite(FeHpoor_mag) and np.isfinite(FeHrich_mag) and np.isfinite(FeHpoor_mag2) and np.isfinite(FeHrich_mag2):
-                # Finally interpolate using the closest FeHs and their magnitudes to get the magnitude at the given FeH:
-                model_mag = interp.linear_interp(FeH, (FeHpoor, FeHpoor_mag), (FeHrich, FeHrich_mag))
-                model_mag2 = interp.linear_interp(FeH, (FeHpoor, FeHpoor_mag2), (FeHrich, FeHrich_mag2))
-                # Combine magnitudes:
-                model_mag = -2.5 * np.log10(10**(-model_mag/2.5) + 10**(-model_mag2/2.5))
-            
-            else:
-                model_mag = np.inf
+    FeH_index, FeH_weight, FeH_inside = interp.find_brackets(FeH, FeH_list)
 
-        # If not using a secondary initial mass:
-        elif np.isfinite(FeHpoor_mag) and np.isfinite(FeHrich_mag):
-            model_mag = interp.linear_interp(FeH, (FeHpoor, FeHpoor_mag), (FeHrich, FeHrich_mag))
-        
-        # Or else if FeH interpolation could not be done, either because of invalid mass or age,
-        # can't interpolate between inf, so make the probability 0:
-        else:
-            model_mag = np.inf
+    # If FeH is not in the valid range, make probability zero:
+    if not FeH_inside:
+        return np.inf
 
-        return model_mag
+    # The cmdsets bracketing the given metallicity; if it exists in the models, only the first
+    # is used:
+    if FeH_weight == 0.0 or FeH_weight == 1.0:
+        cmdsets = [allmodel_cmdsets[int(FeH_index + FeH_weight)]]
+        weights = [1.0]
+    else:
+        cmdsets = [allmodel_cmdsets[int(FeH_index)], allmodel_cmdsets[int(FeH_index) + 1]]
+        weights = [1.0 - FeH_weight, FeH_weight]
 
-    # Or else if the metallicity already exists:
-    elif FeH_min <= FeH <= FeH_max:
+    # Calculate model magnitudes from each:
+    mags = np.array([modelset.getmag(age, initmass, data_bandindex) for modelset in cmdsets])
 
-        # Get the right index:
-        FeH_index = np.where(FeH_list == FeH)[0]
-        # Get the magnitude:
-        model_mag = allmodel_cmdsets[FeH_index].getmag(age, initmass, data_bandindex)
-        
-        # If necessary, get the secondary mass' magnitude too:
-        if secondarymass != None: 
-            model_mag2 = allmodel_cmdsets[FeH_index].getmag(age, secondarymass, data_bandindex)
-            # Combine magnitudes:
-            model_mag = -2.5 * np.log10(10**(-model_mag/2.5) + 10**(-model_mag2/2.5))
+    # If necessary, get the secondary mass' magnitude too:
+    if secondarymass != None:
+        mags2 = np.array([modelset.getmag(age, secondarymass, data_bandindex) for modelset in cmdsets])
+    else:
+        mags2 = np.zeros(len(cmdsets))
+
+    # If FeH interpolation could not be done, either because of invalid mass or age,
+    # can't interpolate between inf, so make the probability 0:
+    if not (np.all(np.isfinite(mags)) and np.all(np.isfinite(mags2))):
+        return np.inf
+
+    # Finally interpolate using the closest FeHs and their magnitudes to get the magnitude at the given FeH:
+    model_mag = np.dot(weights, mags)
+
+    if secondarymass != None:
+        # Combine magnitudes:
+        model_mag2 = np.dot(weights, mags2)
+        model_mag = magcorr.combine_mags(model_mag, model_mag2)
+
+    return model_mag
+
+
+# Reads the selected magnitude columns of one model file:
+def read_modelfile(data_file, usedcolumns, cache = True, silent = True, agecut = None, agemax = None, massrange = None):
+
+    """
+      Reads the given magnitude columns of a model file, along with the EEPs, ages and initial masses of
+    its model stars, in one pass (or from the binary cache, if caching is on and the file has been read
+    before). Returns the file's [Fe/H], the EEPs, and a data frame of log10 age, initial mass and the
+    corrected magnitudes.
+    Only models passing the age and mass cuts are read (see columnread.read_modeltable()).
+    """
+
+    modelfile_skippedcols = 7
+
+    hlist = cread.get_header(data_file, 'model')
+    dataNames = [hlist[col - modelfile_skippedcols] for col in usedcolumns]
+
+    print('------------------------------------------------------------------------')
+    print('ASSIGNING {:s}...'.format(', '.join(dataNames)) + 'for ' + data_file.split('/')[-1])
 
-        return model_mag
+    # EEPs are held in the 1st column of MIST model files and are read along with the magnitudes:
+    columns = [0] + list(usedcolumns)
 
-    # Or else if FeH is not in the valid range, make probability zero:
+    selection = {'agecut': agecut, 'agemax': agemax, 'massrange': None if massrange is None else [float(mass) for mass in massrange]}
+
+    # If caching is on (see modelcache.set_cache_dir()) and the file has been read before, the values come
+    # from the binary cache:
+    cached = modelcache.load(data_file, columns, **selection) if cache else None
+    if cached != None:
+        values, ages, masses, metadata = cached
     else:
-        return np.inf
+        values, ages, masses, metadata = cread.get_modelvalues(data_file, columns, agecut, agemax, massrange)
+        if cache:
+            modelcache.store(data_file, columns, values, ages, masses, metadata, **selection)
+
+    eeps = np.array(values[:, 0])
+    magnitudes = magcorr.ABtoVega(values[:, 1:], band_column=usedcolumns, silent=silent)
+
+    # In MIST model files, FeH is the 3rd entry in the metadata line.
+    FeH = float(metadata[2])
+
+    loadedData = pd.DataFrame(np.column_stack((ages, masses, magnitudes)), columns = ['log10 age', 'Initial Mass'] + dataNames)
+
+    return FeH, eeps, loadedData
+
+# The dense EEP grid of a ModelGrid (see ModelGrid.eepgrid()) is kept in single precision, which holds
+# magnitudes to a few micromag and masses to a part in 10^7 at half the memory; isochrones interpolated
+# from it are worked with in double precision. A dense grid that would take more than eepgrid_maxbytes is
+# not made:
+eepgrid_dtype = np.float32
+eepgrid_maxbytes = 2 * 2**30
+
+class ModelGrid(object):
+
+    """
+      All metallicities of a model run packed into one contiguous table. Rows hold the EEP, log10 age,
+    initial mass and magnitudes of every model star; they are ordered by [Fe/H], then age, then EEP. The
+    offsets table gives the (start, stop) rows of each ([Fe/H], age) isochrone, so that any isochrone is a
+    slice of the table.
+
+      A grid may be saved to a directory and loaded back memory-mapped, in which case many processes can 
+    share one read-only copy; pickling such a grid only passes its path.
+
+      The grid is also the interpolation engine used by the fits: getmags() returns the magnitudes of any
+    number of stars at a given [Fe/H] and age in one pass. Isochrones are interpolated in [Fe/H] and age
+    at fixed EEP, so that models at the same phase of evolution line up, and then in mass along the EEPs.
+    With fluxes on (the default), the grid also holds each model's linear fluxes, and the photometry of
+    unresolved binaries is made by adding interpolated fluxes and taking a single log.
+    """
+
+    def __init__(self, FeHs, ages, offsets, table, bandnames, usedcolumns, path = None, fluxes = True):
+
+        self.FeHs = np.asarray(FeHs)
+        self.ages = np.asarray(ages)
+        self.offsets = np.asarray(offsets)
+        self.table = table
+        self.bandnames = [str(name) for name in bandnames]
+        self.usedcolumns = np.array(usedcolumns)
+        self.numbands = len(self.bandnames)
+        self.path = path
+        self.fluxes = fluxes
+
+        # Made when first needed (see eepgrid() and cmdset()):
+        self.eepnodes = None
+        self._eepgrid = None
+        self._cmdsets = {}
+        self._sharedpath = None
+
+    @classmethod
+    def fromcmdsets(cls, model_cmdsets, fluxes = True):
+
+        """
+          Packs a list of model cmdsets (e.g. from all_modelcmdsets()) into a grid.
+        """
+
+        model_cmdsets = sorted(model_cmdsets, key=lambda model: model.FeH)
+
+        FeHs = np.array([model.FeH for model in model_cmdsets])
+        ages = np.unique(np.concatenate([model.ages.values for model in model_cmdsets]))
+        nrows = sum([len(model.ages.values) for model in model_cmdsets])
+        numbands = model_cmdsets[0].numbands
+
+        table = np.empty((nrows, 3 + numbands))
+        offsets = np.zeros((len(FeHs), len(ages), 2), dtype=np.int64)
+
+        row = 0
+        for i, model in enumerate(model_cmdsets):
+            # Isochrones in MIST files are already in order of age, but make sure; a stable sort keeps
+            # models in EEP order within each isochrone:
+            model_ages = model.ages.values
+            order = np.argsort(model_ages, kind='mergesort')
+            nmodels = len(order)
+
+            block = table[row:row + nmodels]
+            block[:, 0] = model.eeps[order]
+            block[:, 1] = model_ages[order]
+            block[:, 2] = model.initmasses.values[order]
+            block[:, 3:] = model.magnitudes.values[order]
+
+            # Ages missing from a file get empty (start == stop) isochrones:
+            offsets[i, :, 0] = row + np.searchsorted(block[:, 1], ages, side='left')
+            offsets[i, :, 1] = row + np.searchsorted(block[:, 1], ages, side='right')
+
+            row += nmodels
+
+        return cls(FeHs, ages, offsets, table, model_cmdsets[0].magnitudes.columns, model_cmdsets[0].usedcolumns, fluxes=fluxes)
+
+    def save(self, path, eepgrid = False):
+
+        """
+          Writes the grid to the directory path: the table as a .npy file and the index as a .npz file. If
+        eepgrid is True, the dense EEP grid used for interpolation (see eepgrid()) is written too, so that 
+        processes loading the grid can share it rather than each making their own.
+        """
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        np.save(os.path.join(path, 'table.npy'), self.table)
+        np.savez(os.path.join(path, 'index.npz'), FeHs=self.FeHs, ages=self.ages, offsets=self.offsets,
+                   bandnames=np.array(self.bandnames), usedcolumns=self.usedcolumns)
+
+        if eepgrid:
+            np.save(os.path.join(path, self.eepgridfile()), self.eepgrid())
+            np.save(os.path.join(path, 'eepnodes.npy'), self.eepnodes)
+
+        return path
+
+    def share(self):
+
+        """
+          Returns the directory of a saved copy of the grid, with its dense EEP grid, for other processes to
+        memory-map (see ModelGrid.load()): the grid's own directory if it was loaded from one with its EEP
+        grid, or else a temporary directory that is written the first time it is needed and removed when
+        the program exits, so that pools started one after another share one copy.
+        """
+
+        if self.path != None and os.path.isfile(os.path.join(self.path, self.eepgridfile())):
+            return self.path
 
-                 
-def all_modelcmdsets(agecut = 0, usecol = None, default = False):
+        if self._sharedpath == None or not os.path.isdir(self._sharedpath):
+            import atexit
+            import shutil
+            import tempfile
 
-    # Go to a desired directory and get all of the .cmd files there:
-    if default:
+            tmp_dir = tempfile.mkdtemp(prefix='cmdfit_grid_')
+            atexit.register(shutil.rmtree, tmp_dir, True)
+            self._sharedpath = self.save(os.path.join(tmp_dir, 'grid'), eepgrid=True)
+
+        return self._sharedpath
+
+    def eepgridfile(self):
+
+        # The dense grid holds fluxes or not, so the two are saved under different names:
+        return 'eepgrid_fluxes.npy' if self.fluxes else 'eepgrid.npy'
+
+    @classmethod
+    def load(cls, path, mmap_mode = 'r', fluxes = True):
+
+        """
+          Loads a grid saved with save(); by default the table (and dense EEP grid, if saved) is memory-mapped
+        read-only.
+        """
+
+        table = np.load(os.path.join(path, 'table.npy'), mmap_mode=mmap_mode)
+        index = np.load(os.path.join(path, 'index.npz'))
+
+        grid = cls(index['FeHs'], index['ages'], index['offsets'], table, index['bandnames'], index['usedcolumns'], path=path, fluxes=fluxes)
+
+        # A dense EEP grid saved with the grid is memory-mapped too:
+        eepgrid_file = os.path.join(path, grid.eepgridfile())
+        if os.path.isfile(eepgrid_file):
+            grid._eepgrid = np.load(eepgrid_file, mmap_mode=mmap_mode)
+            grid.eepnodes = np.load(os.path.join(path, 'eepnodes.npy'))
+
+        return grid
+
+    def __reduce__(self):
+
+        # A grid backed by files on disk is re-attached from them rather than pickled:
+        if self.path != None:
+            return (ModelGrid.load, (self.path, 'r', self.fluxes))
+
+        return (ModelGrid, (self.FeHs, self.ages, self.offsets, np.asarray(self.table), self.bandnames, self.usedcolumns, 
+                            None, self.fluxes))
+
+    def rows(self, FeH_index, age_index):
+
+        """
+          Returns the table rows of the isochrone at the given [Fe/H] and age indices (a view).
+        """
+
+        start, stop = self.offsets[FeH_index, age_index]
+
+        return self.table[start:stop]
+
+    def cmdset(self, FeH_index):
+
+        """
+          Returns a model cmdset for one metallicity of the grid; its data frames are views of the table.
+        """
+
+        if FeH_index < 0:
+            FeH_index += len(self.FeHs)
+
+        if FeH_index not in self._cmdsets:
+            self._cmdsets[FeH_index] = self.makecmdset(FeH_index)
+
+        return self._cmdsets[FeH_index]
+
+    def makecmdset(self, FeH_index):
+
+        start = self.offsets[FeH_index, 0, 0]
+        stop = self.offsets[FeH_index, -1, 1]
+
+        # The grid's offsets already index the isochrones; keep those present at this [Fe/H]:
+        offsets = self.offsets[FeH_index]
+        present = offsets[:, 1] > offsets[:, 0]
+
+        return cmdset.frommodelarrays(float(self.FeHs[FeH_index]), self.table[start:stop, 0], self.table[start:stop, 1:],
+                                        self.bandnames, self.usedcolumns, isoages=self.ages[present], 
+                                        isooffsets=offsets[present] - start)
+
+    def eepgrid_shape(self):
+
+        # The shape of the dense EEP grid; every EEP of the table is a node:
+        if isinstance(self.eepnodes, type(None)):
+            self.eepnodes = np.unique(self.table[:, 0])
+
+        return (len(self.FeHs), len(self.ages), len(self.eepnodes), 1 + (2 if self.fluxes else 1) * self.numbands)
+
+    def eepgrid_bytes(self):
+
+        """
+          The memory the dense EEP grid takes (see eepgrid()), in bytes: one eepgrid_dtype value for each
+        [Fe/H], age, EEP and column. A MIST run of 12 [Fe/H]s, 107 ages and 1710 EEPs in 3 bands, with
+        fluxes, takes 59 MB (118 MB in double precision).
+        """
+
+        return int(np.prod(self.eepgrid_shape())) * np.dtype(eepgrid_dtype).itemsize
+
+    def eepgrid(self):
+
+        """
+          Returns the grid as a dense array of shape ([Fe/H]s, ages, EEPs, columns) holding the initial
+        mass and magnitudes (followed by the fluxes in each band, if fluxes are on) of each isochrone's model
+        at every EEP in eepnodes (NaN where an isochrone has no model at that EEP), as eepgrid_dtype. It is
+        made from the table the first time it is needed; its size is checked against eepgrid_maxbytes first
+        (see eepgrid_bytes()).
+        """
+
+        if isinstance(self._eepgrid, type(None)):
+            shape = self.eepgrid_shape()
+            nbytes = self.eepgrid_bytes()
+            if nbytes > eepgrid_maxbytes:
+                raise MemoryError('The dense EEP grid of shape {} would take {:.0f} MB, more than eepgrid_maxbytes '
+                                  '({:.0f} MB).'.format(shape, nbytes / 2**20, eepgrid_maxbytes / 2**20))
+
+            dense = np.full(shape, np.nan, dtype=eepgrid_dtype)
+
+            # The [Fe/H] and age indices of every row, from the isochrones' offsets:
+            offsets = self.offsets.reshape(-1, 2)
+            rows = np.concatenate([np.arange(start, stop) for start, stop in offsets])
+            isochrone_index = np.repeat(np.arange(len(offsets)), offsets[:, 1] - offsets[:, 0])
+            FeH_index, age_index = np.unravel_index(isochrone_index, self.offsets.shape[:2])
+
+            table = self.table[rows]
+            eep_index = np.searchsorted(self.eepnodes, table[:, 0])
+            dense[FeH_index, age_index, eep_index, :1 + self.numbands] = table[:, 2:]
+            if self.fluxes:
+                dense[FeH_index, age_index, eep_index, 1 + self.numbands:] = magcorr.magtoflux(table[:, 3:])
+
+            self._eepgrid = dense
+
+        return self._eepgrid
+
+    def isomodel(self, FeH, age):
+
+        """
+          Interpolates an isochrone at the given [Fe/H] and age from the (up to) four isochrones around it,
+        EEP by EEP. Returns an array of the initial mass and magnitudes (and fluxes) at each EEP that all of
+        those isochrones have (in order of EEP, and so of mass), or None if FeH or age is outside of the grid.
+        """
+
+        FeH_index, FeH_weight, FeH_inside = interp.find_brackets(FeH, self.FeHs)
+        age_index, age_weight, age_inside = interp.find_brackets(age, self.ages)
+
+        if not (FeH_inside and age_inside):
+            return None
+
+        dense = self.eepgrid()
+
+        # Weighted sum of the bracketing isochrones; those with no weight are left out (their missing
+        # EEPs would otherwise spoil the sum):
+        model = 0.0
+        for i, FeH_w in ((FeH_index, 1.0 - FeH_weight), (FeH_index + 1, FeH_weight)):
+            for j, age_w in ((age_index, 1.0 - age_weight), (age_index + 1, age_weight)):
+                if FeH_w * age_w > 0:
+                    model = model + (FeH_w * age_w) * dense[i, j]
+
+        return model[np.isfinite(model[:, 0])]
+
+    def getmags(self, FeH, age, masses, secondary_masses = None, bands = None):
+
+        """
+          Returns the magnitudes of stars with the given initial masses at the given [Fe/H] and age, in 
+        the given bands (band indices; all bands by default), as an array of shape masses.shape + (number
+        of bands,); a single mass is taken as an array of one. Stars whose masses are outside of the 
+        interpolated isochrone, or whose [Fe/H] or age is outside of the grid, get infinite magnitudes.
+
+          If secondary masses are given, the magnitudes are those of the unresolved binaries. Secondary
+        masses broadcast against the primaries, so e.g. primaries of shape (n, 1) and secondaries of shape
+        (n, k) give the magnitudes of n stars at k mass ratios each. A secondary outside of the isochrone
+        makes its binary invalid too.
+        """
+
+        masses = np.atleast_1d(np.asarray(masses, dtype=float))
+        bands = np.arange(self.numbands) if isinstance(bands, type(None)) else np.atleast_1d(bands)
+
+        shape = masses.shape
+        if not isinstance(secondary_masses, type(None)):
+            secondary_masses = np.asarray(secondary_masses, dtype=float)
+            shape = np.broadcast_shapes(shape, secondary_masses.shape)
+
+        model = self.isomodel(FeH, age)
+        if isinstance(model, type(None)) or len(model) == 0:
+            return np.full(shape + (len(bands),), np.inf)
+
+        if isinstance(secondary_masses, type(None)):
+            mags = interp_model(model, masses, 1 + bands)
+
+        # Binaries are a sum of fluxes (if the grid holds them), with one log per result:
+        elif self.fluxes:
+            flux_columns = 1 + self.numbands + bands
+            mags = magcorr.fluxtomag(interp_model(model, masses, flux_columns) + interp_model(model, secondary_masses, flux_columns))
+
+        else:
+            mags = magcorr.combine_mags(interp_model(model, masses, 1 + bands), interp_model(model, secondary_masses, 1 + bands))
+
+        mags[np.isnan(mags)] = np.inf
+
+        return mags
+
+    def isocorners(self, FeHs, ages):
+
+        """
+          The bracketing isochrones of many ([Fe/H], age) pairs: returns a list of the four corners, each as
+        ([Fe/H] indices, age indices, weights), and whether each pair is inside the grid.
+        """
+
+        FeH_index, FeH_weight, FeH_inside = interp.find_brackets(FeHs, self.FeHs)
+        age_index, age_weight, age_inside = interp.find_brackets(ages, self.ages)
+
+        corners = []
+        for i, FeH_w in ((FeH_index, 1.0 - FeH_weight), (FeH_index + 1, FeH_weight)):
+            for j, age_w in ((age_index, 1.0 - age_weight), (age_index + 1, age_weight)):
+                corners.append((i, j, FeH_w * age_w))
+
+        return corners, FeH_inside & age_inside
+
+    def isomodels(self, FeHs, ages):
+
+        """
+          isomodel() for many ([Fe/H], age) pairs at once, e.g. the positions of all of a sampler's walkers.
+        Returns an array of shape (pairs, EEPs, columns): each pair's interpolated isochrone, in order of EEP,
+        followed by rows of NaN (the EEPs it does not have). Pairs outside of the grid are all NaN.
+        """
+
+        corners, inside = self.isocorners(FeHs, ages)
+        dense = self.eepgrid()
+
+        # Weighted sum of the bracketing isochrones; as in isomodel(), those with no weight are left out:
+        models = 0.0
+        for i, j, weight in corners:
+            weight = weight[:, np.newaxis, np.newaxis]
+            models = models + np.where(weight > 0, weight * dense[i, j], 0.0)
+
+        models[~inside] = np.nan
+
+        # Move each isochrone's models to the front, keeping them in EEP order:
+        order = np.argsort(~np.isfinite(models[:, :, 0]), axis=1, kind='stable')
+
+        return np.take_along_axis(models, order[:, :, np.newaxis], axis=1)
+
+    def getmags_each(self, FeHs, ages, masses, secondary_masses = None, bands = None):
+
+        """
+          getmags() for one star per ([Fe/H], age) pair, e.g. the star proposed by each of a sampler's walkers.
+        All arguments are arrays of the same length (secondary masses are optional); returns an array of
+        shape (stars, bands), with infinite magnitudes for stars outside of the grid or their isochrone.
+
+          Only the mass column of each interpolated isochrone is made in full; the other columns are
+        interpolated from the two models that bracket each star's mass.
+        """
+
+        masses = np.atleast_1d(np.asarray(masses, dtype=float))
+        bands = np.arange(self.numbands) if isinstance(bands, type(None)) else np.atleast_1d(bands)
+
+        corners, inside = self.isocorners(FeHs, ages)
+        dense = self.eepgrid()
+
+        # The initial masses along each star's isochrone (NaN at the EEPs it does not have):
+        node_masses = 0.0
+        for i, j, weight in corners:
+            node_masses = node_masses + np.where(weight[:, np.newaxis] > 0, weight[:, np.newaxis] * dense[i, j, :, 0], 0.0)
+        node_masses[~inside] = np.nan
+
+        def interpolate(masses, columns):
+
+            # The models at or below each mass (the last of them brackets it from below), and above it:
+            with np.errstate(invalid='ignore'):
+                below = node_masses <= masses[:, np.newaxis]
+                above = node_masses > masses[:, np.newaxis]
+
+            nnodes = node_masses.shape[1]
+            lower = nnodes - 1 - np.argmax(below[:, ::-1], axis=1)
+            upper = np.argmax(above, axis=1)
+
+            # A mass at the heaviest model is inside; it is that model:
+            rows = np.arange(len(masses))
+            top = ~np.any(above, axis=1)
+            upper[top] = lower[top]
+            valid = np.any(below, axis=1) & (np.any(above, axis=1) | (node_masses[rows, lower] == masses))
+
+            values = 0.0
+            lower_masses = node_masses[rows, lower]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                t = np.where(top, 0.0, (masses - lower_masses) / (node_masses[rows, upper] - lower_masses))
+
+            for i, j, weight in corners:
+                w = np.where(weight > 0, weight, 0.0)[:, np.newaxis]
+                lower_values = np.where(w > 0, dense[i, j, lower][:, columns], 0.0)
+                upper_values = np.where(w > 0, dense[i, j, upper][:, columns], 0.0)
+                values = values + w * (lower_values + t[:, np.newaxis] * (upper_values - lower_values))
+
+            values = np.array(values, dtype=float, ndmin=2)
+            values[~valid] = np.nan
+
+            return values
+
+        if isinstance(secondary_masses, type(None)):
+            mags = interpolate(masses, 1 + bands)
+
+        elif self.fluxes:
+            flux_columns = 1 + self.numbands + bands
+            mags = magcorr.fluxtomag(interpolate(masses, flux_columns) + interpolate(np.asarray(secondary_masses, dtype=float), flux_columns))
+
+        else:
+            mags = magcorr.combine_mags(interpolate(masses, 1 + bands), interpolate(np.asarray(secondary_masses, dtype=float), 1 + bands))
+
+        mags[np.isnan(mags)] = np.inf
+
+        return mags
+
+    # The grid acts as a list of model cmdsets in ascending order of [Fe/H]:
+    def __len__(self):
+        return len(self.FeHs)
+
+    def __getitem__(self, FeH_index):
+        if isinstance(FeH_index, np.ndarray):
+            FeH_index = int(FeH_index.ravel()[0])
+        return self.cmdset(FeH_index)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.cmdset(i)
+
+def interp_model(model, masses, columns):
+
+    """
+      Interpolates the given columns of an interpolated isochrone (from ModelGrid.isomodel()) at the given
+    masses. Returns an array of shape masses.shape + (number of columns,), with NaN for masses outside of
+    the isochrone.
+    """
+
+    values = np.full(masses.shape + (len(columns),), np.nan)
+
+    mass_index, weight, inside = interp.find_brackets(masses, model[:, 0])
+    values[inside] = interp.interp_brackets(mass_index[inside], weight[inside], model[:, columns])
+
+    return values
+
+def load_modelcmdset(data_file, agecut = 0, usecol = None, cache = True, agemax = None, massrange = None):
+
+    # Creates one model cmdset; this is what the worker processes of all_modelcmdsets() run.
+    print('\n======================================================================')
+    print('Creating model cmdset for ' + data_file.split('/')[-1] + '...')
+
+    return cmdset('model', agecut, data_file, usecol, cache=cache, agemax=agemax, massrange=massrange)
+
+def check_modelcolumns(model_cmdsets):
+
+    """
+      Checks that every model cmdset uses the same magnitude columns, with the same names, as the first one.
+    Issues a warning for each cmdset that does not and returns True if all of them match.
+    """
+
+    match = True
+    for i in range(1, len(model_cmdsets)):
+        same_columns = np.array_equal(model_cmdsets[i].usedcolumns, model_cmdsets[0].usedcolumns)
+        same_names = list(model_cmdsets[i].magnitudes.columns) == list(model_cmdsets[0].magnitudes.columns)
+        if not (same_columns and same_names):
+            print('WARNING: The usedcolumns do not match between cmdsets {:d} and 0. This will likely lead to errors.'.format(i))
+            match = False
+
+    return match
+
+def all_modelcmdsets(agecut = 0, usecol = None, default = False, cache = True, asgrid = False, workers = None, model_dir = None,
+                       agemax = None, massrange = None):
+
+    # Go to a desired directory (or the one given) and get all of the .cmd files there:
+    if model_dir != None:
+        selected_run_path = model_dir
+    elif default:
         selected_run_path = select_pathtofile('defaultmodel')
     else:
         selected_run_path = select_pathtofile('model')
@@ -445,24 +1090,36 @@ def all_modelcmdsets(agecut = 0, usecol = None, default = False):
     model_cmdsets = []
     usedcolumns = usecol
     print()
-    
-    # Loop through model files and create a cmdset from each:
-    for i in range( len(data_files) ):
+
+    # If the columns were not given, the user selects them while the first cmdset is created; 
+    # all other cmdsets then use the same columns:
+    if isinstance(usedcolumns, type(None)):
+        model_cmdsets.append(load_modelcmdset(data_files[0], agecut, usedcolumns, cache, agemax, massrange))
+        usedcolumns = model_cmdsets[0].usedcolumns
+        data_files = data_files[1:]
+
+    # Create a cmdset from each of the remaining model files, either in this process or 
+    # concurrently in a pool of worker processes:
+    if workers != None and workers > 1 and len(data_files) > 1:
+        from concurrent.futures import ProcessPoolExecutor
         
-        print('\n======================================================================')
-        print('Creating model cmdset #{:d} for '.format(i) + data_files[i].split('/')[-1] + '...')
+        nfiles = len(data_files)
+        with ProcessPoolExecutor(max_workers=min(workers, nfiles)) as pool:
+            model_cmdsets += list(pool.map(load_modelcmdset, data_files, [agecut]*nfiles, [usedcolumns]*nfiles, [cache]*nfiles,
+                                             [agemax]*nfiles, [massrange]*nfiles))
+    else:
+        for data_file in data_files:
+            model_cmdsets.append(load_modelcmdset(data_file, agecut, usedcolumns, cache, agemax, massrange))
 
-        model_cmdsets.append(cmdset('model', agecut, data_files[i], usedcolumns))
+    # Merge the cmdsets in ascending order of [Fe/H]:
+    model_cmdsets.sort(key=lambda model: model.FeH)
 
-        # On subsequent loops, use the user selected columns of the first model cmdset:
-        usedcolumns = model_cmdsets[i].usedcolumns
-        
-        if i > 1:
-            # Returns True if any of the columns do not match; issue a warning if this is the case:
-            usedcol_donot_match = any(model_cmdsets[i].usedcolumns - model_cmdsets[i-1].usedcolumns)
-            if usedcol_donot_match:
-                print('WARNING: The usedcolumns do not match between cmdsets {:d} and {:d}. This will likely lead to errors.'.format(i, i-1))
-        
+    # Every file should provide the same magnitude columns:
+    check_modelcolumns(model_cmdsets)
+
+    # Pack all metallicities into one contiguous grid if requested:
+    if asgrid:
+        return ModelGrid.fromcmdsets(model_cmdsets)
 
     return model_cmdsets
 
@@ -1,5 +1,5 @@
 import numpy as np
-import matplotlib.pyplot as plt
+import pandas as pd
 from cmdfit.processing import interp
 
 # WIP
@@ -7,90 +7,113 @@ class isochrone(object):
 
     def __init__(self, cmdset, age, silent=False):
         
-        # Pick out the relevent age block from the given cmdset:
-        age_array = cmdset.ages.values
-        age_max = np.amax(age_array)
-        age_min = np.amin(age_array)
+        # Model cmdsets carry the sorted unique ages of their isochrones and the rows each one spans
+        # (see cmdset.makeageindex()); other cmdsets are searched row by row:
+        isoages = getattr(cmdset, 'isoages', None)
+        if isinstance(isoages, type(None)):
+            isoages = np.unique(cmdset.ages.values)
+            isooffsets = None
+        else:
+            isooffsets = cmdset.isooffsets
+
+        age_min = isoages[0]
+        age_max = isoages[-1]
 
         # Check if the proposed age is within the valid range:
-        if (age_min <= age <= age_max) and (age not in age_array):
-         
-            isochrone_indexlist = np.where(age_array == age)[0]
-         
-            # If the age does not exist, but it is within range of valid values:
-            if not isochrone_indexlist:
-                # Determine the closest ages:
-                younger_Age, older_Age = interp.find_closestAges(age, age_array)
-                
-                # For now just default to the younger age found. Maybe later make this selectable:
-                if silent == False:
-                    print("log10 age = {:f} was found.".format(younger_Age))
-
-                age = younger_Age
-
-        elif not age_min <= age <= age_max:
+        if not age_min <= age <= age_max:
             print("isochrone init ERROR: Desired age outside of max/min range of {:.2f} to {:.2f} log10 age.".format(age_min, age_max))
             return
-         
-        # Now we have an age to work with; so get all models within its block:
-        isochrone_indexlist = np.where(age_array == age)[0]
-        self.magnitudes = cmdset.magnitudes.ix[isochrone_indexlist,:].reset_index(drop=True)
+
+        age_index = np.searchsorted(isoages, age)
+
+        # If the age does not exist, but it is within range of valid values, default to the
+        # closest younger age for now. Maybe later make this selectable:
+        if isoages[age_index] != age:
+            age_index -= 1
+            if silent == False:
+                print("log10 age = {:f} was found.".format(isoages[age_index]))
+
+        age = isoages[age_index]
+
+        # Now we have an age to work with; so get all models within its block. With an age index 
+        # the block is a slice, and the arrays here are views of the cmdset's values:
+        if isinstance(isooffsets, type(None)):
+            isochrone_indexlist = np.where(cmdset.ages.values == age)[0]
+        else:
+            start, stop = isooffsets[age_index]
+            isochrone_indexlist = slice(start, stop)
+
+        self.mag_array = cmdset.magnitudes.values[isochrone_indexlist]
+        self.mass_array = cmdset.initmasses.values[isochrone_indexlist]
+        self.bandnames = cmdset.magnitudes.columns
+        self._magnitudes = None
+        self._initmasses = None
         if cmdset.kind == 'modeltest':
-            self.uncertainties = cmdset.uncertainties.ix[isochrone_indexlist,:].reset_index(drop=True)
+            self.uncertainties = pd.DataFrame(cmdset.uncertainties.values[isochrone_indexlist], columns=cmdset.uncertainties.columns)
 
-        self.initmasses = cmdset.initmasses.ix[isochrone_indexlist].reset_index(drop=True)
         self.age = age
         self.FeH = cmdset.FeH
         self.kind = cmdset.kind
 
+    # The magnitudes and initial masses as data frames; these are only made (around the arrays
+    # above) when asked for, since the likelihood only needs the arrays:
+    @property
+    def magnitudes(self):
+        if isinstance(self._magnitudes, type(None)):
+            self._magnitudes = pd.DataFrame(self.mag_array, columns=self.bandnames, copy=False)
+        return self._magnitudes
+
+    @magnitudes.setter
+    def magnitudes(self, frame):
+        self._magnitudes = frame
+        self.mag_array = frame.values
+        self.bandnames = frame.columns
+
+    @property
+    def initmasses(self):
+        if isinstance(self._initmasses, type(None)):
+            self._initmasses = pd.Series(self.mass_array, name='Initial Mass', copy=False)
+        return self._initmasses
+
+    @initmasses.setter
+    def initmasses(self, series):
+        self._initmasses = series
+        self.mass_array = series.values
+
     # Given an isochrone and proposed initial mass, get the magnitude of the star with the proposed mass:
     def isogetmag(self, initmass, band):
 
-        # Magnitudes and masses of models in the isochrone:
-        mag_array = self.magnitudes.values[:, band]
-        mass_array = self.initmasses.values
-        max_mass = np.amax(mass_array)
-        min_mass = np.amin(mass_array)
-
-        # Check if the given mass is within bounds of the predicted masses for the isochrones found:
-        # (If within bounds, get the masses from the isochrone.)
-        if min_mass < initmass < max_mass:
-
-            mass_index = np.where(mass_array == initmass)[0]
-
-            # If the mass does not exist, need to find adjacent masses and prepare for interpolation.
-            if not mass_index:
-                # Find the closest masses in this isochrone:
-                bigMass, lilMass, bigMass_index, lilMass_index = interp.find_closestMasses(initmass, mass_array)
-
-                # Get corresponding magnitudes:
-                bigmag_val = mag_array[bigMass_index]
-                lilmag_val = mag_array[lilMass_index]
-                massinterp = True
-
-            # Or else the mass was found:
-            else:
-                mass_val = mass_array[older_mass_index]
-                mag_val = mag_array[older_mass_index]
-                result = (mag_val, mass_val)
-                massinterp = False
-
-        # If the given mass is outside of the bounds of the masses available in the isochrone, return infinity. 
-        # This lets the code know that the mass was invalid for the isochrone and could not be interpolated:
-        else:
-            mag_val = np.inf
-            massinterp = False
-
-        # If we need to interpolate between masses to get a magnitude closer to what would come from
-        # the proposed mass, then do so:
-        if massinterp:
-
-            interpmag = interp.linear_interp(initmass, (lilMass, lilmag_val), (bigMass, bigmag_val))
-            mag_val = interpmag
-  
         # This should be a number, and if it is infinite then it means a magnitude could not be found;
         # in this case, 0 probability should result, or else the magnitude should not be used.
-        return mag_val
+        return self.getmags(initmass, band)[0, 0]
+
+    # Given an isochrone and many proposed initial masses, get their magnitudes in many bands at once:
+    def getmags(self, masses, bands = None):
+
+        """
+          Interpolates the magnitudes of stars with the given initial masses from the isochrone's models,
+        in the given bands (band indices; all bands by default). Returns an array of shape (number of 
+        masses, number of bands). Masses outside of the isochrone's mass range get infinite magnitudes.
+
+          The models of an isochrone are in order of EEP, and so of increasing initial mass; each mass 
+        is bracketed by a binary search (see interp.find_brackets()).
+        """
+
+        masses = np.atleast_1d(np.asarray(masses, dtype=float))
+        mass_array = self.mass_array
+        mag_array = self.mag_array
+        if not isinstance(bands, type(None)):
+            mag_array = mag_array[:, np.atleast_1d(bands)]
+
+        mags = np.full((len(masses), mag_array.shape[1]), np.inf)
+        if len(mass_array) == 0:
+            return mags
+
+        # Each mass is bracketed by the models just below and above it:
+        mass_index, weight, inside = interp.find_brackets(masses, mass_array)
+        mags[inside] = interp.interp_brackets(mass_index[inside], weight[inside], mag_array)
+
+        return mags
 
     # Random sampling of isochrone:
     def isorandsamp(self, samplenum):
@@ -99,9 +122,9 @@ class isochrone(object):
         indices = self.magnitudes.index
 
         if self.kind == 'modeltest':
-            self.uncertainties = self.uncertainties.ix[indices].reset_index(drop=True)
+            self.uncertainties = self.uncertainties.loc[indices].reset_index(drop=True)
             
-        self.initmasses = self.initmasses.ix[indices].reset_index(drop=True)
+        self.initmasses = self.initmasses.loc[indices].reset_index(drop=True)
         self.magnitudes = self.magnitudes.reset_index(drop=True)
         
         return
@@ -110,14 +133,18 @@ class isochrone(object):
 # at the given mass:
 def isointerpmag(cmdset, initmass, age, age_array, band):
 
+    # The ages are in ascending order (e.g. the cmdset's isoages), so the closest ages are found by a
+    # binary search:
+    older_index = np.searchsorted(age_array, age)
+
     # if we actually don't need to interpolate, just return the magnitude at
     # the given mass:
-    if age in age_array:
+    if older_index < len(age_array) and age_array[older_index] == age:
         print('log10 age = {:f} exists; no need to interpolate!'.format(age))
         return isochrone(cmdset, age).isogetmag(initmass, band)
     
     # Determine the closest ages via interpolation:
-    younger_Age, older_Age = interp.find_closestAges(age, age_array)            
+    younger_Age, older_Age = age_array[older_index - 1], age_array[older_index]
 
     # Pick out their isochrones:
     younger_iso = isochrone(cmdset, younger_Age)
@@ -150,6 +177,9 @@ def isointerpmag(cmdset, initmass, age, age_array, band):
 # Plots a magnitude vs. a color for an isochrone, given two magnitude indices:
 def isoplotCMD(blue_index, red_index, isochrone=None, dataset = None, magindex=None, inverty = True, show=True, legend = True, repeat = False):
 
+    # matplotlib is loaded here rather than on import, so that the fitting code does not pull it in:
+    import matplotlib.pyplot as plt
+
     # If plotting a dataset (collection of stars):
     if magindex == None and dataset != None and repeat == False:
         dataset_bluemag = dataset.magnitudes.ix[:,blue_index].values
@@ -220,6 +250,8 @@ def isoplotCMD(blue_index, red_index, isochrone=None, dataset = None, magindex=N
 
 # Plots an array of isochrones.
 def multiisoCMD(isochrone_set, dataset = None, magindex = None):
+
+    import matplotlib.pyplot as plt
   
     numisos = len(isochrone_set)
 
@@ -1,41 +1,65 @@
 import numpy as np
 import re
 import os
+import operator
 from . import userinteract as user
 from . import magcorrections as magcorr
 
 # ==========================================================================================================================
 
-def get_header(data_file, mode = 'data'):
+# Parsed headers, keyed on the path of each file along with its size and modification time:
+header_cache = {}
+
+def read_header(data_file):
 
     """
-        Extracts the header of a data file.
+      Reads the leading comment lines of a file, stopping at the first data line, and returns the full 
+    list of column names (taken from the last of these comments) and the metadata values held on the 
+    sixth line of MIST model files (None if that line does not hold numbers). Results are cached per 
+    file, so repeated calls do not touch the file again unless it changes.
     """
 
-    # Assumes that the files comments include '#' in them
+    stat = os.stat(data_file)
+    key = (os.path.abspath(data_file), stat.st_size, stat.st_mtime_ns)
 
-    f = open(data_file)
-
-    lines = f.readlines()
-    f.close()
+    if key in header_cache:
+        return header_cache[key]
 
+    # Assumes that the files comments include '#' in them
     comments = []
 
-    for string in lines:
-        if '#' in string:
-            comments.append(string)
+    f = open(data_file)
+    for string in f:
         # Break if we've gone past top most comments:
         if '#' not in string:
             break
+        comments.append(string)
+    f.close()
 
     # Assumes that the header is contained in the last set of comments:
-    header_str = comments[-1]
-    # Clean the header:
-    hlist = (header_str.split('#')[1]).split()
+    hlist = (comments[-1].split('#')[1]).split()
+
+    # metadata exists on the sixth line in MIST model files:
+    try:
+        meta_data = np.array(comments[5].split('#')[-1].split(), dtype=np.float64)
+    except (IndexError, ValueError):
+        meta_data = None
+
+    header_cache[key] = (hlist, meta_data)
+
+    return hlist, meta_data
+
+def get_header(data_file, mode = 'data'):
+
+    """
+        Extracts the header of a data file.
+    """
+
+    hlist, meta_data = read_header(data_file)
 
     # Returns the list of header names.
     if mode == 'data':
-        return hlist
+        return list(hlist)
     if mode == 'model' or mode == 'modeltest':
         modelfile_skippedcols = 7
         return hlist[modelfile_skippedcols:]
@@ -90,9 +114,8 @@ def get_values(data_file, column_index, mode='data', model_extras=False):
     # If the mode is set to a model file, pick out the first uncommented line...in MIST .cmd files this line holds
     # metadata; this block grabs the meta data and separates it from the other data lines.
     if mode == 'model' or mode == 'modeltest':
-        # metadata  exists on the sixth line in MIST model files.
-        meta_data = re.compile('[+-]?\d+\.\d+|[+-]?\d+\.\d+\[eE][+-]?\d+').findall(lines[5])
-        #data_lines = data_lines[1:]
+        # metadata exists on the sixth line in MIST model files; it is parsed along with the header:
+        hlist, meta_data = read_header(data_file)
     
     # Look through lines and pick values from the desired column:
     data_column = []
@@ -142,7 +165,183 @@ def get_values(data_file, column_index, mode='data', model_extras=False):
         # Or else if just returning the magnitudes:
         else:
             return np.array(data_column)
-    
+
+# ==========================================================================================================================
+
+def read_modeltable(model_file, usecols = None, agecut = None, agemax = None, massrange = None):
+
+    """
+      Reads a MIST .iso.cmd model file in a single pass. Every complete data line is tokenized at once
+    into a 2-D float64 array (rows are model stars, columns follow the file's header). Returns this
+    table, the full list of column names, and the metadata ([Yinit, Zinit, [Fe/H], [a/Fe], v/vcrit]).
+
+      The selection is applied while reading, so that rows and columns which are not needed are never
+    converted or stored:
+
+        usecols: indices of the columns to keep (in the given order); all columns are kept by default.
+        agecut, agemax: keep only models with agecut <= log10 age <= agemax.
+        massrange: a (minimum, maximum) tuple; keep only models with initial masses in this range.
+    """
+
+    if not isinstance(usecols, type(None)):
+        usecols = [int(col) for col in usecols]
+        pick = operator.itemgetter(*usecols)
+
+    lowage = -np.inf if agecut == None else agecut
+    highage = np.inf if agemax == None else agemax
+    lowmass, highmass = (-np.inf, np.inf) if massrange is None else massrange
+
+    meta_data = None
+    names = None
+    ncols = None
+    tokens = []
+
+    # Whether or not the current isochrone block passes the age cuts is decided once per age:
+    blockage = None
+    keepblock = True
+
+    f = open(model_file)
+
+    for i, line in enumerate(f):
+
+        # metadata exists on the sixth line in MIST model files:
+        if i == 5:
+            meta_data = np.array(line.split('#')[-1].split(), dtype=np.float64)
+
+        # Comment lines hold the headers of each isochrone block; the first of these that directly
+        # precedes data holds the column names:
+        if '#' in line:
+            if ncols == None:
+                names = line.split('#')[1].split()
+            continue
+
+        # Ages and masses are the 2nd and 3rd columns of MIST model files; look at these first
+        # so that unwanted lines are not split any further:
+        head = line.split(None, 3)
+
+        # Skip the blank lines between isochrone blocks and incomplete lines:
+        if len(head) < 4:
+            continue
+
+        if head[1] != blockage:
+            blockage = head[1]
+            keepblock = lowage <= float(blockage) <= highage
+
+        if not keepblock or not lowmass <= float(head[2]) <= highmass:
+            continue
+
+        l = line.split()
+
+        # The number of columns is set by the header, or by the first data line if the header is absent:
+        if ncols == None:
+            ncols = len(names) if names else len(l)
+
+        # Incomplete lines are skipped:
+        if len(l) != ncols:
+            continue
+
+        if isinstance(usecols, type(None)):
+            tokens.extend(l)
+        else:
+            tokens.extend(pick(l) if len(usecols) > 1 else (l[usecols[0]],))
+
+    f.close()
+
+    nkept = ncols if isinstance(usecols, type(None)) else len(usecols)
+
+    # If no lines were kept:
+    if nkept == None:
+        return np.empty((0, 0)), names, meta_data
+
+    # Convert all values at once rather than line by line:
+    table = np.array(tokens, dtype=np.float64).reshape(-1, nkept)
+
+    return table, names, meta_data
+
+def get_modelvalues(model_file, column_indices, agecut = None, agemax = None, massrange = None):
+
+    """
+      Loads several columns of a model file (e.g. magnitudes) along with the ages, masses and metadata
+    of the model stars from a single read of the file. Returns an array of shape (# of models, # of
+    columns), followed by the ages, masses and metadata. Age and mass cuts are applied during the read
+    (see read_modeltable()).
+    """
+
+    # Ages and masses are the 2nd and 3rd columns of MIST model files:
+    usecols = [1, 2] + list(column_indices)
+    table, names, meta_data = read_modeltable(model_file, usecols, agecut, agemax, massrange)
+
+    return table[:, 2:], table[:, 0], table[:, 1], meta_data
+
+# ==========================================================================================================================
+
+def filter_datachunk(chunk, nbands, maglims, uncertlims):
+
+    # Converts the selected values of a chunk of data lines and keeps the rows that pass the cuts:
+    values = np.array(chunk, dtype=np.float64).reshape(-1, 2*nbands)
+    magnitudes = values[:, :nbands]
+    uncertainties = values[:, nbands:]
+
+    keep = np.all(np.isfinite(values), axis=1)
+    if maglims is not None:
+        keep &= np.all((magnitudes >= maglims[0]) & (magnitudes <= maglims[1]), axis=1)
+    if uncertlims is not None:
+        keep &= np.all((uncertainties >= uncertlims[0]) & (uncertainties <= uncertlims[1]), axis=1)
+
+    return values[keep]
+
+def stream_datacolumns(data_file, mag_columns, uncert_columns, maglims = None, uncertlims = None, chunksize = 100000):
+
+    """
+      Reads magnitude and uncertainty columns from a (possibly very large) data table in chunks of 
+    chunksize lines. Magnitude and uncertainty cuts are applied to each chunk as it is read, so memory 
+    use is bounded by the chunk size and the number of stars kept rather than by the size of the file.
+
+        maglims, uncertlims: (lower, upper) limits; a star is kept only if all of its magnitudes
+        (uncertainties) lie within these limits. Stars with non-finite values are dropped.
+
+      Returns two arrays of shape (# of stars kept, # of bands): the magnitudes and their uncertainties.
+    Columns are numbered as in get_values(): only decimal numbers (e.g. 5.123, not names or integer IDs)
+    are counted, so the same column indices pick the same values.
+    """
+
+    nbands = len(mag_columns)
+    columns = [int(col) for col in mag_columns] + [int(col) for col in uncert_columns]
+    pick = operator.itemgetter(*columns)
+    ncols = max(columns) + 1
+
+    find_values = re.compile(r'[+-]?\d+\.\d+').findall
+
+    kept = []
+    chunk = []
+
+    f = open(data_file)
+
+    for line in f:
+
+        # Skip comments:
+        if '#' in line:
+            continue
+
+        l = find_values(line)
+
+        # Skip blank and incomplete lines:
+        if len(l) < ncols:
+            continue
+
+        chunk.append(pick(l))
+
+        if len(chunk) == chunksize:
+            kept.append(filter_datachunk(chunk, nbands, maglims, uncertlims))
+            chunk = []
+
+    f.close()
+
+    kept.append(filter_datachunk(chunk, nbands, maglims, uncertlims))
+    values = np.concatenate(kept)
+
+    return values[:, :nbands], values[:, nbands:]
+
 # ==========================================================================================================================
 
 def assign_data(cmd_datafile, mode = 'data', given_column = None, returncols = False, returnNames = False, 
@@ -153,7 +352,7 @@ def assign_data(cmd_datafile, mode = 'data', given_column = None, returncols = F
     """
     modelfile_skippedcols = 7
     
-    if given_column != None:
+    if given_column is not None:
         col1 = given_column
         hlist = get_header(cmd_datafile, mode)
         # get_header() skips the first 6 columns (b/c they are not magnitudes), so need to offset
@@ -183,7 +382,7 @@ def assign_data(cmd_datafile, mode = 'data', given_column = None, returncols = F
     # A given column will have already had this offset applied, so no need to do it again,
     # i.e. don't do this if a column is given; this message should not show on subsequent
     # set creations if using all_modelcmdsets().
-    if mode == 'model' and given_column == None or mode == 'modeltest'and given_column == None:
+    if mode == 'model' and given_column is None or mode == 'modeltest'and given_column is None:
         print('Applying index offset...')
         col1 += modelfile_skippedcols
 
@@ -102,3 +102,53 @@ def find_closestFeHs(FeH, FeH_array, returnIndices = True):
         return richFeH, poorFeH, richFeH_index, poorFeH_index
     else:
         return richFeH, poorFeH
+
+# Array versions of the finding functions above; these take any number of query values at once:
+
+def find_brackets(values, grid):
+
+    """
+      Brackets each of the given values within grid, which must be in ascending order without repeats
+    (e.g. the [Fe/H]s of a model run, the ages of a cmdset's isochrones or the masses of an isochrone).
+    Returns, for every value:
+
+        index   --  the index of the grid node at or below the value; the value lies between grid[index]
+                    and grid[index + 1]
+        weight  --  the value's fractional position between those two nodes, in [0, 1]
+        inside  --  whether the value lies within the grid (end points included)
+
+      Values on a node get that node as index and a weight of 0, except for the last node, which is
+    reached from the one below with a weight of 1. Values outside of the grid are clipped to its nearest
+    end point, so index and weight always point within the grid; inside marks which ones to trust.
+    """
+
+    values = np.asarray(values, dtype=float)
+    grid = np.asarray(grid, dtype=float)
+    nnodes = len(grid)
+
+    inside = (values >= grid[0]) & (values <= grid[-1])
+
+    if nnodes == 1:
+        return np.zeros(values.shape, dtype=np.intp), np.zeros(values.shape), inside
+
+    # (np.minimum/np.maximum rather than np.clip, which has a large overhead on small arrays.)
+    index = np.minimum(np.maximum(np.searchsorted(grid, values, side='right') - 1, 0), nnodes - 2)
+    lower = grid[index]
+    weight = np.minimum(np.maximum((values - lower) / (grid[index + 1] - lower), 0.0), 1.0)
+
+    return index, weight, inside
+
+def interp_brackets(index, weight, table):
+
+    """
+      Linearly interpolates table (whose first axis runs over the grid nodes) at the brackets found by
+    find_brackets(). Any further axes of table (e.g. bands) are carried through, so the result has shape
+    index.shape + table.shape[1:].
+    """
+
+    table = np.asarray(table)
+    weight = np.reshape(weight, np.shape(weight) + (1,)*(table.ndim - 1))
+    
+    upper = np.minimum(index + 1, len(table) - 1)
+
+    return table[index] + weight * (table[upper] - table[index])
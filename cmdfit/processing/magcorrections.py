@@ -30,6 +30,20 @@ def ABtoVega(magnitude_array, band_column, silent = False):
 
     return magnitude_array
 
+# Linear fluxes (relative to a zero magnitude star) and back; fluxes of unresolved stars add:
+def magtoflux(magnitudes):
+
+    return 10**(-0.4 * np.asarray(magnitudes))
+
+def fluxtomag(fluxes):
+
+    return -2.5 * np.log10(fluxes)
+
+def combine_mags(mag1, mag2):
+
+    # The magnitude of two unresolved stars (e.g. the components of a binary):
+    return fluxtomag(magtoflux(mag1) + magtoflux(mag2))
+
 #def get_distanceModulus():
 
  #   dmod_name = ''
@@ -0,0 +1,187 @@
+import numpy as np
+import hashlib
+import json
+import glob
+import os
+
+# The directory holding cached model files. Caching is off unless a directory is given, with
+# set_cache_dir() or else by setting $CMDFIT_CACHE_DIR.
+cache_dir = None
+
+# ==========================================================================================================================
+
+def set_cache_dir(path):
+
+    """
+      Sets the directory in which parsed model files are cached; None turns caching off (unless
+    $CMDFIT_CACHE_DIR is set).
+    """
+
+    global cache_dir
+    cache_dir = path
+
+def get_cache_dir():
+
+    """
+      Returns the directory in which parsed model files are cached, or None if caching is off.
+    """
+
+    if cache_dir != None:
+        return cache_dir
+
+    return os.environ.get('CMDFIT_CACHE_DIR') or None
+
+# ==========================================================================================================================
+
+def file_signature(model_file):
+
+    """
+      Returns the absolute path, size and modification time of a model file; the cache is keyed on these.
+    """
+
+    stat = os.stat(model_file)
+
+    return [os.path.abspath(model_file), stat.st_size, stat.st_mtime_ns]
+
+def cache_key(model_file, columns, **selection):
+
+    """
+      Makes the name of a cache entry from the file's signature, the selected columns, and any other
+    selection arguments used while reading the file (those left as None do not change the key).
+    """
+
+    selection = sorted([(name, value) for name, value in selection.items() if value != None])
+    key = file_signature(model_file) + [[int(col) for col in columns], selection]
+
+    return hashlib.sha1(json.dumps(key).encode()).hexdigest()
+
+# ==========================================================================================================================
+
+def load(model_file, columns, **selection):
+
+    """
+      Looks for a cached copy of the given columns of a model file. If found, returns the magnitudes, ages,
+    masses and metadata (as get_modelvalues() would), read from the cache's binary file. Returns None if
+    there is no valid cache entry, or if caching is off.
+    """
+
+    directory = get_cache_dir()
+    if directory == None:
+        return None
+
+    entry = os.path.join(directory, cache_key(model_file, columns, **selection))
+
+    try:
+        table = np.load(entry + '.npy')
+        f = open(entry + '.json')
+        info = json.load(f)
+        f.close()
+    except (IOError, OSError, ValueError):
+        return None
+
+    # Columns are stored as age, mass, then the magnitudes:
+    return table[:, 2:], table[:, 0], table[:, 1], np.array(info['metadata'])
+
+def store(model_file, columns, magnitudes, ages, masses, metadata, **selection):
+
+    """
+      Writes the given columns of a model file to the cache as a .npy file (with a small .json file
+    describing its source). Returns the entry's path, or None if caching is off.
+    """
+
+    directory = get_cache_dir()
+    if directory == None:
+        return None
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    entry = os.path.join(directory, cache_key(model_file, columns, **selection))
+    path, size, mtime = file_signature(model_file)
+
+    info = {'model_file': path, 'size': size, 'mtime': mtime,
+            'columns': [int(col) for col in columns], 'metadata': [float(x) for x in metadata]}
+
+    table = np.column_stack((ages, masses, magnitudes))
+
+    # Write to temporary files first so that concurrent readers never see a partial entry:
+    tmp = entry + '.{:d}.tmp'.format(os.getpid())
+    f = open(tmp, 'wb')
+    np.save(f, table)
+    f.close()
+    os.replace(tmp, entry + '.npy')
+
+    f = open(tmp, 'w')
+    json.dump(info, f)
+    f.close()
+    os.replace(tmp, entry + '.json')
+
+    return entry
+
+# ==========================================================================================================================
+
+def entries():
+
+    """
+      Returns (path of entry, info) for every entry in the cache.
+    """
+
+    if get_cache_dir() == None:
+        return []
+
+    found = []
+    for info_file in glob.glob(os.path.join(get_cache_dir(), '*.json')):
+        try:
+            f = open(info_file)
+            info = json.load(f)
+            f.close()
+        except (IOError, OSError, ValueError):
+            info = None
+
+        found.append((info_file[:-len('.json')], info))
+
+    return found
+
+def remove_entry(entry):
+
+    for ext in ('.npy', '.json'):
+        if os.path.exists(entry + ext):
+            os.remove(entry + ext)
+
+def invalidate(model_file = None):
+
+    """
+      Removes the cache entries made from the given model file, or every entry if no file is given.
+    Returns the number of entries removed.
+    """
+
+    if model_file != None:
+        model_file = os.path.abspath(model_file)
+
+    removed = 0
+    for entry, info in entries():
+        if model_file == None or info == None or info['model_file'] == model_file:
+            remove_entry(entry)
+            removed += 1
+
+    return removed
+
+def cleanup():
+
+    """
+      Removes stale cache entries, i.e. those whose model file no longer exists or has changed since it was
+    cached. Returns the number of entries removed.
+    """
+
+    removed = 0
+    for entry, info in entries():
+        try:
+            stale = info == None or file_signature(info['model_file'])[1:] != [info['size'], info['mtime']]
+        except OSError:
+            stale = True
+
+        if stale:
+            remove_entry(entry)
+            removed += 1
+
+    return removed
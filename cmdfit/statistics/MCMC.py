@@ -1,12 +1,13 @@
 import numpy as np
-import emcee
-import matplotlib.pyplot as plt
-import seaborn as sns
+import pandas as pd
+import time
 from . import priors
 from . import likelihood
+from . import diagnostics
 from cmdfit import isochrone as iso
+from cmdfit import data
 
-def lnposterior(theta, data_cmdset, allmodel_cmdsets, FeH_list, FeH_range, age_range, mode = 'all', magindex=None):
+def lnposterior(theta, data_cmdset, allmodel_cmdsets, FeH_list, FeH_range, age_range, mode = 'all', magindex=None, nodecache=None):
 
     """
       The posterior distribution function; this is built from the priors on log10 age, metallicity, initial
@@ -65,7 +66,7 @@ def lnposterior(theta, data_cmdset, allmodel_cmdsets, FeH_list, FeH_range, age_r
     # Calculate the priors on metallicity and age:
     lnp = priors.lnprior(theta, FeH_range, age_range)
     # Calculate the log-likelihood:
-    lnlikelihood = likelihood.allband_lnLikelihood(theta, data_cmdset, allmodel_cmdsets, FeH_list, mode, magindex)
+    lnlikelihood = likelihood.allband_lnLikelihood(theta, data_cmdset, allmodel_cmdsets, FeH_list, mode, magindex, nodecache)
 
     # If the sampler picked values out of the valid ranges, assign zero probability
     # for this paritcular sampling:
@@ -76,8 +77,57 @@ def lnposterior(theta, data_cmdset, allmodel_cmdsets, FeH_list, FeH_range, age_r
     # on primary and secondary initial masses; it also handles the priors of those parameters:
     return lnp + lnlikelihood
 
-def getsamples(data_cmdset, allmodel_cmdsets, FeH_list, mode = 'all', magindex=None, ndim = 3, nwalkers=10, nsteps=300):
-    
+def walkers_lnposterior(thetas, data_cmdset, allmodel_cmdsets, FeH_list, FeH_range, age_range, mode = 'all', magindex=None, nodecache=None):
+
+    """
+      lnposterior() for all walkers at once, for emcee's vectorize mode: thetas is an array of shape (walkers,
+    parameters) and an array of the log-posterior of each walker is returned. The priors and likelihood are
+    evaluated for all walkers in the same array expressions (see priors.walkers_lnprior() and 
+    likelihood.walkers_lnLikelihood()), so the cost of a step is in NumPy rather than in one Python call
+    per walker.
+    """
+
+    thetas = np.atleast_2d(thetas)
+
+    # Calculate the priors on metallicity and age:
+    lnp = priors.walkers_lnprior(thetas, FeH_range, age_range)
+
+    lnposteriors = np.full(len(thetas), -np.inf)
+
+    # Only walkers within the valid ranges are compared with the data:
+    valid = np.isfinite(lnp)
+    if np.any(valid):
+        lnposteriors[valid] = lnp[valid] + likelihood.walkers_lnLikelihood(thetas[valid], data_cmdset, allmodel_cmdsets, FeH_list, mode, magindex, nodecache)
+
+    return lnposteriors
+
+def getsamples(data_cmdset, allmodel_cmdsets, FeH_list, mode = 'all', magindex=None, ndim = 3, nwalkers=10, nsteps=300, vectorize = False,
+               nodecache = None, workers = None, chain_dir = None, resume = False, chunksize = 100, convergence = None,
+               map_init = False):
+
+    """
+      Runs emcee's EnsembleSampler on the posterior (see lnposterior()). If vectorize is True, the sampler
+    evaluates all walkers of a step in one call of walkers_lnposterior() instead of one call per walker.
+    In mode 'all', a NodeCache (see statistics.nodecache) given as nodecache is used for the likelihood.
+    With workers > 1, the walkers are evaluated by a pool of that many processes (see run_sampler()).
+
+      If chain_dir is given, the chain is streamed to that directory in chunks of chunksize steps, with a
+    checkpoint after each (see statistics.chainstore). With resume = True, a run stopped part of the way
+    through continues from its last checkpoint until it has nsteps steps in all.
+
+      With convergence (a dict of thresholds), sampling stops as soon as the chain has converged, within
+    nsteps steps; the steps taken are returned as nsteps, and the diagnostics are kept as sampler.diagnostics
+    (see run_sampler()).
+
+      With map_init = True, the walkers start in a small ball around the highest mode of the posterior
+    found by a multi-start optimizer within the model grid (see map_walkers()) rather than around the
+    default guesses; what it found, and the posterior evaluations it took, are kept as sampler.mapinit.
+    """
+
+    # The likelihood looks up model magnitudes through a ModelGrid; pack a list of model cmdsets into one:
+    if not isinstance(allmodel_cmdsets, data.ModelGrid):
+        allmodel_cmdsets = data.ModelGrid.fromcmdsets(allmodel_cmdsets)
+
     #print('FORMING [Fe/H] RANGE...')
     # Determine the boundaries of the metallicity range:  
     FeH_range = ( np.amin(np.array(FeH_list)), np.amax(np.array(FeH_list)) )
@@ -89,7 +139,8 @@ def getsamples(data_cmdset, allmodel_cmdsets, FeH_list, mode = 'all', magindex=N
     #oldestiso = iso.isochrone(allmodel_cmdsets[0], 10.0)
     
     mass_range = ( np.amin(allmodel_cmdsets[0].initmasses.values), np.amax(allmodel_cmdsets[0].initmasses.values)  )
-    
+
+
     if mode == 'all':
         # emcee sampler parameters:
         ndim = 2
@@ -102,13 +153,24 @@ def getsamples(data_cmdset, allmodel_cmdsets, FeH_list, mode = 'all', magindex=N
         # Set up the walkers in a Gaussian ball around the initial positions:
         initial_walker_positions = make_walkerpos(nwalkers, ndim, initial_positions, age_range, mass_range, FeH_range, allmodel_cmdsets)
 
-        # Assign the sampler object using parameters from above:
-        sampler = emcee.EnsembleSampler(nwalkers, ndim, lnposterior, args=(data_cmdset, allmodel_cmdsets, FeH_list, FeH_range, age_range))
-  
-        # Run the sampler for the specified number of steps:
-        print('\nRunning MCMC...\n')
-        sampler.run_mcmc(initial_walker_positions, nsteps)
-        print('DONE\n')
+        args = (data_cmdset, allmodel_cmdsets, FeH_list, FeH_range, age_range, mode, None, nodecache)
+
+        # ...or around the posterior's mode:
+        mapinit = None
+        if map_init:
+            mapinit = map_walkers(nwalkers, [FeH_range, age_range], args, initial_positions)
+            if mapinit != None:
+                initial_walker_positions = mapinit.pop('positions')
+
+        # Make the sampler and run it for the specified number of steps:
+        sampler = run_sampler(nwalkers, ndim, initial_walker_positions, nsteps, args, vectorize, workers,
+                              make_chainstore(chain_dir, resume, chunksize), convergence)
+        sampler.mapinit = mapinit
+        nsteps = sampler.iteration
+
+        if nodecache != None:
+            print('Node cache: {:d} hits, {:d} misses ({:.1%} hit rate), {:.1f} MB'.format(nodecache.hits, nodecache.misses,
+                                                                                         nodecache.hitrate(), nodecache.nbytes / 2.0**20))
   
         return sampler, nwalkers, nsteps
 
@@ -146,21 +208,355 @@ def getsamples(data_cmdset, allmodel_cmdsets, FeH_list, mode = 'all', magindex=N
             # Set up the walkers in a Gaussian ball around the initial positions:
             initial_walker_positions = make_walkerpos(nwalkers, ndim, initial_positions, age_range, mass_range, FeH_range, allmodel_cmdsets[0])
 
-        # Assign the sampler object using parameters from above:
-        sampler = emcee.EnsembleSampler(nwalkers, ndim, lnposterior, args=(data_cmdset, allmodel_cmdsets, FeH_list, FeH_range, age_range, mode, magindex))
-        
         # Thinking about taking param values here and using them to form field star mass priors....                
 
-        # Run the sampler for the specified number of steps:
-        print('\nRunning MCMC...\n')
-        sampler.run_mcmc(initial_walker_positions, nsteps)
-        print('DONE\n')
+        args = (data_cmdset, allmodel_cmdsets, FeH_list, FeH_range, age_range, mode, magindex, None)
+
+        # Or start the walkers around the posterior's mode; [Fe/H], age, primary mass, secondary mass (no more
+        # than the largest primary) and Pfield are searched within:
+        mapinit = None
+        if map_init:
+            bounds = [FeH_range, age_range, mass_range, (0.0, mass_range[1]), (0.0, 1.0)][:ndim]
+            mapinit = map_walkers(nwalkers, bounds, args, initial_positions)
+            if mapinit != None:
+                initial_walker_positions = mapinit.pop('positions')
+
+        # Make the sampler and run it for the specified number of steps:
+        sampler = run_sampler(nwalkers, ndim, initial_walker_positions, nsteps, args, vectorize, workers,
+                              make_chainstore(chain_dir, resume, chunksize), convergence)
+        sampler.mapinit = mapinit
+        nsteps = sampler.iteration
         
         if data_cmdset.kind == 'modeltest':
             return sampler, nwalkers, nsteps, model_params
         else:
             return sampler, nwalkers, nsteps
 
+def find_map(args, bounds, initial_positions = None, nstarts = 4, ncandidates = 64, maxfev = 400):
+
+    """
+      Looks for the highest mode of the posterior (the maximum a posteriori, or MAP, parameters) within
+    bounds, a (lower, upper) pair for each parameter. args are the arguments of lnposterior() that follow
+    theta. ncandidates random points within the bounds (and initial_positions, if given) are evaluated at
+    once with walkers_lnposterior(), and the Nelder-Mead simplex method (scipy.optimize.minimize(), kept
+    within the bounds) is run from the nstarts best of them, with up to maxfev posterior evaluations each.
+    The simplex only needs to compare posteriors, so it copes with the posterior's kinks between grid nodes
+    and with zero posterior outside of the models' ranges.
+
+      Returns the best parameters found, their log-posterior and the number of posterior evaluations taken
+    (candidates included); or None if scipy is not installed or no candidate has a finite posterior.
+    """
+
+    # scipy is optional; it is only loaded when the optimizer is used:
+    try:
+        from scipy import optimize
+    except ImportError:
+        print('WARNING: Finding the MAP needs scipy, which is not installed; the walkers start from the default positions.')
+        return None
+
+    bounds = np.asarray(bounds, dtype=float)
+    candidates = bounds[:, 0] + (bounds[:, 1] - bounds[:, 0]) * np.random.uniform(size=(ncandidates, len(bounds)))
+    if not isinstance(initial_positions, type(None)):
+        candidates = np.vstack((np.clip(initial_positions, bounds[:, 0], bounds[:, 1]), candidates))
+
+    lnposteriors = walkers_lnposterior(candidates, *args)
+    evaluations = [len(candidates)]
+
+    finite = np.isfinite(lnposteriors)
+    if not np.any(finite):
+        print('WARNING: No finite posterior found to start the optimizer from; the walkers start from the default positions.')
+        return None
+
+    # The best point evaluated is kept along the way, whatever the optimizer ends on:
+    best = [candidates[np.argmax(np.where(finite, lnposteriors, -np.inf))], np.max(lnposteriors[finite])]
+
+    def cost(theta):
+        evaluations[0] += 1
+        lnp = lnposterior(theta, *args)
+        if lnp > best[1]:
+            best[:] = [np.array(theta), lnp]
+        return -lnp
+
+    for start in candidates[np.argsort(-np.where(finite, lnposteriors, -np.inf))[:min(nstarts, np.sum(finite))]]:
+        optimize.minimize(cost, start, method='Nelder-Mead', bounds=bounds, options={'maxfev': maxfev, 'xatol': 1e-3, 'fatol': 1e-6})
+
+    return best[0], best[1], evaluations[0]
+
+def map_walkerpos(nwalkers, theta, bounds, args, scale = 1e-2):
+
+    """
+      A ball of walkers around theta: each parameter is scattered by scale times the width of its bounds,
+    within them. Walkers that land where the posterior is zero are drawn again, closer in. Returns the
+    walker positions and the number of posterior evaluations taken.
+    """
+
+    bounds = np.asarray(bounds, dtype=float)
+    widths = bounds[:, 1] - bounds[:, 0]
+
+    positions = np.tile(np.asarray(theta, dtype=float), (nwalkers, 1))
+    redraw = np.arange(nwalkers)
+    evaluations = 0
+    for attempt in range(10):
+        positions[redraw] = np.clip(theta + scale * widths * np.random.randn(len(redraw), len(theta)), bounds[:, 0], bounds[:, 1])
+
+        lnposteriors = walkers_lnposterior(positions[redraw], *args)
+        evaluations += len(redraw)
+
+        redraw = redraw[~np.isfinite(lnposteriors)]
+        if len(redraw) == 0:
+            break
+        scale /= 4
+
+    return positions, evaluations
+
+def map_walkers(nwalkers, bounds, args, initial_positions = None):
+
+    """
+      Starting positions for the walkers around the posterior's highest mode within bounds (see find_map()
+    and map_walkerpos()). Returns a dict of the walker positions, the MAP parameters and log-posterior, and
+    the posterior evaluations taken; or None if no mode was found.
+    """
+
+    found = find_map(args, bounds, initial_positions)
+    if found == None:
+        return None
+
+    theta, lnp, evaluations = found
+    positions, ballevaluations = map_walkerpos(nwalkers, theta, bounds, args)
+
+    print('\nMAP: {} (log-posterior {:.2f}), found in {:d} posterior evaluations'.format(np.round(theta, 3), lnp, evaluations))
+
+    return {'positions': positions, 'theta': theta.tolist(), 'lnposterior': float(lnp), 'evaluations': int(evaluations + ballevaluations)}
+
+def make_chainstore(chain_dir, resume = False, chunksize = 100):
+
+    # A ChainStore backend in chain_dir, or None to keep the chain in memory:
+    if chain_dir == None:
+        return None
+
+    from .chainstore import ChainStore
+
+    return ChainStore(chain_dir, chunksize=chunksize, resume=resume)
+
+def run_sampler(nwalkers, ndim, initial_walker_positions, nsteps, args, vectorize = False, workers = None, backend = None,
+                convergence = None, pool_limits = None):
+
+    """
+      Makes emcee's EnsembleSampler for the posterior and runs it for nsteps from the initial walker positions.
+    args are the arguments of lnposterior() that follow theta: (data_cmdset, allmodel_cmdsets, FeH_list, 
+    FeH_range, age_range, mode, magindex, nodecache).
+
+      With workers > 1, the posterior is evaluated by a SamplerPool (see statistics.parallel): the workers
+    start once, attach to a memory-mapped copy of the model grid and data, and are only sent the walkers'
+    parameters. Each worker then keeps its own node cache, of the size of the one given. The posterior is
+    first evaluated serially at the initial walker positions; if the walkers are too quick to be worth
+    sending to workers, or there are not enough CPUs, sampling stays serial (see parallel.pool_workers(), and
+    parallel.default_pool_limits for what pool_limits may change).
+
+      backend is an emcee backend for the chain, such as a ChainStore (see statistics.chainstore). If it
+    already holds steps (a resumed run), sampling continues from its last step, up to nsteps steps in all.
+
+      With convergence (a dict of thresholds, see diagnostics.default_convergence; {} for the defaults),
+    nsteps is the most steps taken: every check_every steps the chain's autocorrelation time, split R-hat
+    and effective sample size are worked out, and sampling stops once they meet the thresholds. Each check
+    goes over the whole chain, so once the chain is long the checks are spaced further apart (see
+    diagnostics.next_check()). The diagnostics of the final chain, with its burn-in and whether it
+    converged, are kept as sampler.diagnostics (see diagnostics.diagnose()). Returns the sampler.
+    """
+
+    # emcee is only loaded once sampling is requested:
+    import emcee
+
+    pool = None
+    if workers != None and workers > 1:
+        from .parallel import pool_workers
+
+        # One serial evaluation of the initial walkers tells whether they are worth sending to workers; a
+        # worker gets one walker at a time, or in vectorize mode one block of the walkers of a half-step:
+        task_seconds = None
+        if not isinstance(initial_walker_positions, type(None)):
+            start = time.perf_counter()
+            if vectorize:
+                walkers_lnposterior(np.atleast_2d(initial_walker_positions), *args)
+            else:
+                [lnposterior(theta, *args) for theta in initial_walker_positions]
+            task_seconds = (time.perf_counter() - start) / nwalkers
+            if vectorize:
+                task_seconds *= np.ceil(nwalkers / 2 / workers)
+
+        workers = pool_workers(workers, nwalkers // 2, task_seconds, 'block' if vectorize else 'walker', pool_limits)
+
+    if workers != None:
+        from .parallel import SamplerPool, pool_lnposterior
+
+        data_cmdset, allmodel_cmdsets, FeH_list, FeH_range, age_range, mode, magindex, nodecache = args
+        pool = SamplerPool(workers, data_cmdset, allmodel_cmdsets, FeH_list, FeH_range, age_range, mode, magindex,
+                           None if nodecache == None else nodecache.maxbytes)
+
+        if vectorize:
+            sampler = emcee.EnsembleSampler(nwalkers, ndim, pool.walkers_lnposterior, vectorize=True, backend=backend)
+        else:
+            sampler = emcee.EnsembleSampler(nwalkers, ndim, pool_lnposterior, pool=pool, backend=backend)
+
+    else:
+        # One call per walker, or one call for all walkers of a step:
+        posterior = walkers_lnposterior if vectorize else lnposterior
+        sampler = emcee.EnsembleSampler(nwalkers, ndim, posterior, args=args, vectorize=vectorize, backend=backend)
+
+    # A resumed chain continues from its last step (and random state):
+    done = sampler.iteration
+    if done > 0:
+        print('\nResuming MCMC at step {:d} of {:d}...\n'.format(done, nsteps))
+        initial_walker_positions = None
+    else:
+        print('\nRunning MCMC...\n')
+
+    stopped = False
+    checked = None
+    previous_tau = None
+    try:
+        if convergence == None:
+            if nsteps > done:
+                sampler.run_mcmc(initial_walker_positions, nsteps - done)
+
+        elif nsteps > done:
+            check_at = diagnostics.next_check(done, convergence)
+
+            for state in sampler.sample(initial_walker_positions, iterations=nsteps - done):
+                if sampler.iteration < check_at:
+                    continue
+                checked = sampler.iteration
+                check_at = diagnostics.next_check(checked, convergence)
+
+                diagnosed = diagnostics.diagnose(sampler.get_chain())
+                print('Step {:d}: tau = {}, R-hat = {}, ESS = {}'.format(sampler.iteration, np.round(diagnosed['tau'], 1),
+                                                                        np.round(diagnosed['rhat'], 3), np.round(diagnosed['ess'])))
+
+                if diagnostics.converged(diagnosed, previous_tau, convergence):
+                    print('Converged after {:d} steps.'.format(sampler.iteration))
+                    stopped = True
+                    break
+                previous_tau = diagnosed['tau']
+    finally:
+        if pool != None:
+            pool.close()
+        # Steps still buffered by a streaming backend are written out, even if sampling was stopped:
+        if hasattr(backend, 'flush'):
+            backend.flush()
+    print('DONE\n')
+
+    if convergence != None:
+        chain = sampler.get_chain()
+        sampler.diagnostics = diagnostics.diagnose(chain)
+
+        # A chain whose last check was of its final step keeps that check's verdict; steps taken since the
+        # last check are judged against it, and a chain never checked against its first half:
+        if stopped or checked == sampler.iteration:
+            sampler.diagnostics['converged'] = stopped
+        elif not isinstance(previous_tau, type(None)):
+            sampler.diagnostics['converged'] = diagnostics.converged(sampler.diagnostics, previous_tau, convergence)
+        else:
+            sampler.diagnostics['converged'] = diagnostics.chain_converged(chain, sampler.diagnostics, convergence)
+        if not sampler.diagnostics['converged']:
+            print('WARNING: The chain did not meet the convergence thresholds in {:d} steps.'.format(sampler.iteration))
+
+    return sampler
+
+def gridposterior(data_cmdset, allmodel_cmdsets, FeH_list, resolution = (101, 101), chunksize = 1024, workers = None, 
+                  nodecache = None, quantiles = (0.16, 0.50, 0.84), pool_limits = None):
+
+    """
+      Evaluates the posterior of the cluster fit (mode 'all', the two parameters [Fe/H] and log10 age) on
+    a mesh over the whole model grid, instead of sampling it with MCMC. The mesh points are the centers of
+    resolution = (number of [Fe/H]s, number of ages) equal cells spanning the models' ranges (a single
+    number is used for both). They are evaluated in chunks of chunksize points at once with
+    walkers_lnposterior(); with workers > 1 the chunks after the first are shared out to a SamplerPool (see
+    statistics.parallel), unless the first took too little time for that to pay (see parallel.pool_workers(),
+    with the pool_limits given).
+
+    Returns:
+
+        surface    --  the normalized posterior density on the mesh, as a DataFrame indexed by [Fe/H] with
+                       a column for each log10 age
+        marginals  --  a dict of the marginal density of '[Fe/H]' and of 'log10 Age', as Series indexed 
+                       by the parameter's mesh values
+        q          --  the quantiles of each parameter's marginal, as a DataFrame shaped like the one that
+                       param_samples.quantile() gives after an MCMC run
+
+    or None if the posterior is zero everywhere on the mesh.
+    """
+
+    # The likelihood looks up model magnitudes through a ModelGrid; pack a list of model cmdsets into one:
+    if not isinstance(allmodel_cmdsets, data.ModelGrid):
+        allmodel_cmdsets = data.ModelGrid.fromcmdsets(allmodel_cmdsets)
+
+    FeH_range = ( np.amin(np.array(FeH_list)), np.amax(np.array(FeH_list)) )
+    age_range = ( np.amin(allmodel_cmdsets[0].ages.values), np.amax(allmodel_cmdsets[0].ages.values))
+
+    nFeH, nage = (resolution, resolution) if np.ndim(resolution) == 0 else resolution
+
+    # Cell edges and centers:
+    FeH_edges = np.linspace(FeH_range[0], FeH_range[1], nFeH + 1)
+    age_edges = np.linspace(age_range[0], age_range[1], nage + 1)
+    FeHs = 0.5 * (FeH_edges[:-1] + FeH_edges[1:])
+    ages = 0.5 * (age_edges[:-1] + age_edges[1:])
+
+    mesh = np.column_stack([values.ravel() for values in np.meshgrid(FeHs, ages, indexing='ij')])
+    chunks = [mesh[start:start + chunksize] for start in range(0, len(mesh), chunksize)]
+    args = (data_cmdset, allmodel_cmdsets, FeH_list, FeH_range, age_range, 'all', None, nodecache)
+
+    print('\nEvaluating the posterior on a {:d} x {:d} mesh...\n'.format(nFeH, nage))
+
+    # The first chunk is evaluated serially, which tells whether the rest are worth sending to workers:
+    start = time.perf_counter()
+    lnposteriors = [walkers_lnposterior(chunks[0], *args)]
+    chunk_seconds = time.perf_counter() - start
+
+    if workers != None and workers > 1 and len(chunks) > 1:
+        from .parallel import pool_workers
+        workers = pool_workers(workers, len(chunks) - 1, chunk_seconds, 'block', pool_limits)
+
+    if workers != None and workers > 1 and len(chunks) > 1:
+        from .parallel import SamplerPool, pool_walkers_lnposterior
+
+        with SamplerPool(workers, data_cmdset, allmodel_cmdsets, FeH_list, FeH_range, age_range, 'all', None,
+                         None if nodecache == None else nodecache.maxbytes) as pool:
+            lnposteriors += pool.map(pool_walkers_lnposterior, chunks[1:])
+    else:
+        lnposteriors += [walkers_lnposterior(chunk, *args) for chunk in chunks[1:]]
+    print('DONE\n')
+
+    lnposteriors = np.concatenate(lnposteriors).reshape(nFeH, nage)
+
+    if not np.any(np.isfinite(lnposteriors)):
+        print('ERROR: The posterior is zero everywhere on the mesh.')
+        return None
+
+    # Normalize, so that the density integrates to 1 over the mesh:
+    dFeH = FeH_edges[1] - FeH_edges[0]
+    dage = age_edges[1] - age_edges[0]
+    density = np.exp(lnposteriors - np.amax(lnposteriors))
+    density /= np.sum(density) * dFeH * dage
+
+    surface = pd.DataFrame(density, index=pd.Index(FeHs, name='[Fe/H]'), columns=pd.Index(ages, name='log10 Age'))
+    marginals = {'[Fe/H]': pd.Series(np.sum(density, axis=1) * dage, index=surface.index, name='[Fe/H]'),
+                 'log10 Age': pd.Series(np.sum(density, axis=0) * dFeH, index=surface.columns, name='log10 Age')}
+
+    q = pd.DataFrame({'[Fe/H]': gridquantiles(FeH_edges, marginals['[Fe/H]'].values, quantiles),
+                      'log10 Age': gridquantiles(age_edges, marginals['log10 Age'].values, quantiles)},
+                     index=list(quantiles), columns=['[Fe/H]', 'log10 Age'])
+
+    return surface, marginals, q
+
+def gridquantiles(edges, density, quantiles):
+
+    # Quantiles of a density that is constant within each cell between the given edges; the
+    # cumulative distribution is linear within each cell:
+    cdf = np.concatenate(([0.0], np.cumsum(density * np.diff(edges))))
+    cdf /= cdf[-1]
+
+    return np.interp(quantiles, cdf, edges)
+
 def make_walkerpos(nwalkers, ndim, initial_positions, age_range, mass_range, FeH_range, cmdset):
 
     initial_walker_positions = []
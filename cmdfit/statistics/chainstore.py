@@ -0,0 +1,170 @@
+import numpy as np
+import os
+import glob
+import json
+from emcee.backends import Backend
+
+class ChainStore(Backend):
+
+    """
+      A backend for emcee's EnsembleSampler that streams the chain to a directory as it is sampled, so that
+    memory use does not grow with the number of steps, and a run that is stopped can be resumed.
+
+      Steps are kept in a buffer of chunksize steps. When it is full (and when the sampler stops, see
+    flush()), the buffered positions and log-posteriors are appended to the directory as one chunk of .npy
+    files, and a checkpoint of the last walker positions, the acceptance counts and the sampler's random
+    state is written. Chunks and checkpoints are written to temporary files first and then moved into place,
+    so the directory always holds a chain that ends at its checkpoint.
+
+      With resume = True, a store that has a checkpoint is reopened where it stopped: its iteration is
+    the checkpoint's, and EnsembleSampler continues from the last walker positions and random state there.
+    Otherwise the directory's chain is removed when the sampler starts (reset()).
+    """
+
+    def __init__(self, path, chunksize = 100, resume = False):
+
+        super().__init__()
+
+        self.path = path
+        self.chunksize = int(chunksize)
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        if resume and os.path.isfile(self.checkpointfile()):
+            self.load()
+
+    def checkpointfile(self):
+        return os.path.join(self.path, 'checkpoint.npz')
+
+    def chunkfiles(self, name):
+
+        # The chunks in order (temporary files left by a run stopped mid-write do not match):
+        return sorted(glob.glob(os.path.join(self.path, name + '_' + '[0-9]'*5 + '.npy')))
+
+    def reset(self, nwalkers, ndim):
+
+        """
+          Starts a new, empty chain of nwalkers walkers in ndim dimensions; any chain in the directory is removed.
+        """
+
+        for file in self.chunkfiles('chain') + self.chunkfiles('log_prob') + [self.checkpointfile()]:
+            if os.path.isfile(file):
+                os.remove(file)
+
+        self.nwalkers = int(nwalkers)
+        self.ndim = int(ndim)
+        self.iteration = 0
+        self.accepted = np.zeros(self.nwalkers, dtype=self.dtype)
+        self.random_state = None
+        self.blobs = None
+
+        self.chunklengths = []
+        self.chain = np.empty((self.chunksize, self.nwalkers, self.ndim), dtype=self.dtype)
+        self.log_prob = np.empty((self.chunksize, self.nwalkers), dtype=self.dtype)
+        self.nbuffered = 0
+
+        with open(os.path.join(self.path, 'store.json'), 'w') as f:
+            json.dump({'nwalkers': self.nwalkers, 'ndim': self.ndim, 'chunksize': self.chunksize}, f)
+
+        self.initialized = True
+
+    def load(self):
+
+        # Reopens the chain at its checkpoint; chunks written after it (by a run stopped in between) are dropped:
+        with open(os.path.join(self.path, 'store.json')) as f:
+            layout = json.load(f)
+        checkpoint = np.load(self.checkpointfile(), allow_pickle=False)
+
+        self.nwalkers = layout['nwalkers']
+        self.ndim = layout['ndim']
+        self.iteration = int(checkpoint['iteration'])
+        self.accepted = checkpoint['accepted']
+        self.random_state = (str(checkpoint['rng_name']), checkpoint['rng_keys'], int(checkpoint['rng_pos']),
+                             int(checkpoint['rng_has_gauss']), float(checkpoint['rng_cached_gaussian']))
+        self.blobs = None
+
+        nchunks = int(checkpoint['nchunks'])
+        for name in ('chain', 'log_prob'):
+            for file in self.chunkfiles(name)[nchunks:]:
+                os.remove(file)
+
+        self.chunklengths = [len(np.load(file, mmap_mode='r')) for file in self.chunkfiles('log_prob')]
+        self.chain = np.empty((self.chunksize, self.nwalkers, self.ndim), dtype=self.dtype)
+        self.log_prob = np.empty((self.chunksize, self.nwalkers), dtype=self.dtype)
+        self.nbuffered = 0
+
+        self.initialized = True
+
+    def has_blobs(self):
+        return False
+
+    def grow(self, ngrow, blobs):
+
+        # Steps go to the buffer and then to disk, so there is no storage to grow ahead of sampling:
+        if blobs is not None:
+            raise ValueError('ChainStore does not store blobs')
+
+    def save_step(self, state, accepted):
+
+        self._check(state, accepted)
+
+        self.chain[self.nbuffered] = state.coords
+        self.log_prob[self.nbuffered] = state.log_prob
+        self.nbuffered += 1
+
+        self.accepted += accepted
+        self.random_state = state.random_state
+        self.iteration += 1
+
+        if self.nbuffered == self.chunksize:
+            self.flush()
+
+    def flush(self):
+
+        """
+          Appends the buffered steps to the directory as a chunk, and checkpoints the sampler's state after them.
+        """
+
+        if not self.initialized or self.nbuffered == 0:
+            return
+
+        index = len(self.chunklengths)
+        last = self.nbuffered - 1
+        for name, buffer in (('chain', self.chain), ('log_prob', self.log_prob)):
+            file = os.path.join(self.path, '{}_{:05d}.npy'.format(name, index))
+            np.save(file + '.tmp.npy', buffer[:self.nbuffered])
+            os.replace(file + '.tmp.npy', file)
+
+        self.chunklengths.append(self.nbuffered)
+        self.nbuffered = 0
+
+        name, keys, pos, has_gauss, cached_gaussian = self.random_state
+        np.savez(self.checkpointfile() + '.tmp.npz', iteration=self.iteration, nchunks=len(self.chunklengths), accepted=self.accepted,
+                 coords=self.chain[last], log_prob=self.log_prob[last],
+                 rng_name=name, rng_keys=keys, rng_pos=pos, rng_has_gauss=has_gauss, rng_cached_gaussian=cached_gaussian)
+        os.replace(self.checkpointfile() + '.tmp.npz', self.checkpointfile())
+
+    def get_value(self, name, flat = False, thin = 1, discard = 0):
+
+        if self.iteration <= 0:
+            raise AttributeError("you must run the sampler with 'store == True' before accessing the results")
+
+        if name == 'blobs':
+            return None
+
+        # The steps asked for are read chunk by chunk from disk (memory-mapped), then from the buffer:
+        steps = np.arange(discard + thin - 1, self.iteration, thin)
+        chunks = [np.load(file, mmap_mode='r') for file in self.chunkfiles(name)] + [getattr(self, name)[:self.nbuffered]]
+        starts = np.cumsum([0] + [len(chunk) for chunk in chunks])
+
+        shape = (self.nwalkers, self.ndim) if name == 'chain' else (self.nwalkers,)
+        v = np.empty((len(steps),) + shape, dtype=self.dtype)
+        for i, chunk in enumerate(chunks):
+            inchunk = (steps >= starts[i]) & (steps < starts[i + 1])
+            v[inchunk] = chunk[steps[inchunk] - starts[i]]
+
+        if flat:
+            return v.reshape((-1,) + shape[1:])
+
+        return v
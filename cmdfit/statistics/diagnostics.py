@@ -0,0 +1,171 @@
+import numpy as np
+
+# Default thresholds for deciding that a chain has converged (see converged()):
+default_convergence = {'check_every': 100,   # steps between checks...
+                       'check_growth': 0.25, # ...or this fraction of the chain's length, once that is more
+                       'tau_factor': 50,     # the chain must be at least this many autocorrelation times long...
+                       'tau_rtol': 0.01,     # ...with the autocorrelation time changed by less than this since the last check
+                       'rhat': 1.01,         # largest split R-hat allowed
+                       'ess': 400}           # smallest effective sample size (after burn-in) needed
+
+# ==========================================================================================================================
+
+def autocorr_function(chain):
+
+    """
+      The normalized autocorrelation function of each parameter of a (steps, walkers, parameters) chain,
+    worked out per walker with an FFT and averaged over the walkers; of shape (steps, parameters).
+    """
+
+    nsteps = chain.shape[0]
+    x = chain - np.mean(chain, axis=0)
+
+    # Zero-padding to twice the length (rounded up to a power of 2) avoids the FFT's wrap-around:
+    n = 2**int(np.ceil(np.log2(2 * nsteps)))
+    f = np.fft.rfft(x, n=n, axis=0)
+    acf = np.fft.irfft(f * np.conjugate(f), n=n, axis=0)[:nsteps]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        acf = acf / acf[0]
+
+    return np.mean(acf, axis=1)
+
+def integrated_time(chain, c = 5):
+
+    """
+      The integrated autocorrelation time of each parameter of a (steps, walkers, parameters) chain, in
+    steps. The sum over the autocorrelation function is cut off with Sokal's automatic window: at the
+    first lag M with M >= c * tau(M). A parameter that does not move (e.g. stuck walkers) has an infinite
+    autocorrelation time.
+    """
+
+    acf = autocorr_function(chain)
+    taus = 2.0 * np.cumsum(acf, axis=0) - 1.0
+
+    lags = np.arange(len(taus))[:, np.newaxis]
+    window = lags >= c * taus
+    M = np.where(np.any(window, axis=0), np.argmax(window, axis=0), len(taus) - 1)
+
+    tau = taus[M, np.arange(taus.shape[1])]
+
+    return np.where(np.isfinite(tau), tau, np.inf)
+
+def split_rhat(chain):
+
+    """
+      The split R-hat (Gelman-Rubin) statistic of each parameter of a (steps, walkers, parameters) chain:
+    each walker's chain is split in two halves, and the variance between the halves' means is compared
+    with the variance within them. Values near 1 mean that the halves agree.
+    """
+
+    n = chain.shape[0] // 2
+    if n < 2:
+        return np.full(chain.shape[2], np.inf)
+
+    halves = np.concatenate((chain[:n], chain[n:2*n]), axis=1)
+
+    W = np.mean(np.var(halves, axis=0, ddof=1), axis=0)
+    B = n * np.var(np.mean(halves, axis=0), axis=0, ddof=1)
+    var_plus = (n - 1.0) / n * W + B / n
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rhat = np.sqrt(var_plus / W)
+
+    return np.where(np.isfinite(rhat), rhat, np.inf)
+
+def effective_samples(chain, tau):
+
+    """
+      The effective sample size of each parameter: the number of samples in the chain over its
+    autocorrelation time.
+    """
+
+    return chain.shape[0] * chain.shape[1] / np.asarray(tau)
+
+def burnin_steps(tau, nsteps, factor = 2.0):
+
+    """
+      The number of steps discarded as burn-in for a chain of nsteps steps with the given autocorrelation
+    times: factor times the largest of them, but no more than half the chain.
+    """
+
+    tau = np.max(tau)
+    if not np.isfinite(tau):
+        return nsteps // 2
+
+    return int(min(np.ceil(factor * tau), nsteps // 2))
+
+# ==========================================================================================================================
+
+def diagnose(chain):
+
+    """
+      The convergence diagnostics of a (steps, walkers, parameters) chain, as a dict: the number of steps,
+    the autocorrelation time of each parameter, the burn-in it implies (see burnin_steps()), and the split
+    R-hat and effective sample size of each parameter after the burn-in.
+    """
+
+    nsteps = chain.shape[0]
+    tau = integrated_time(chain)
+    burnin = burnin_steps(tau, nsteps)
+
+    kept = chain[burnin:]
+    kept_tau = integrated_time(kept)
+
+    return {'steps': int(nsteps), 'tau': tau.tolist(), 'burnin': burnin, 'rhat': split_rhat(kept).tolist(),
+            'ess': effective_samples(kept, kept_tau).tolist()}
+
+def next_check(steps, thresholds = None):
+
+    """
+      The step at which a chain of the given number of steps is next checked for convergence: after
+    check_every more steps, or once the chain is long, after about check_growth times its length (rounded
+    down to a multiple of check_every). Each check works over the whole chain, so spacing the checks out
+    in proportion keeps their total cost proportional to the chain's length rather than to its square.
+    """
+
+    limits = dict(default_convergence)
+    if thresholds != None:
+        limits.update(thresholds)
+
+    check_every = limits['check_every']
+
+    return (steps // check_every) * check_every + check_every * max(1, int(steps * limits['check_growth'] / check_every))
+
+def converged(diagnostics, previous_tau = None, thresholds = None):
+
+    """
+      Whether the diagnostics (see diagnose()) meet the thresholds (see default_convergence, which fills in
+    any left out): a chain that is long compared with its autocorrelation time, an autocorrelation time
+    that has settled since the previous check (previous_tau), small split R-hats and enough effective samples.
+    """
+
+    limits = dict(default_convergence)
+    if thresholds != None:
+        limits.update(thresholds)
+
+    tau = np.array(diagnostics['tau'])
+    if not np.all(np.isfinite(tau)):
+        return False
+
+    if diagnostics['steps'] < limits['tau_factor'] * np.max(tau):
+        return False
+
+    if isinstance(previous_tau, type(None)) or np.any(np.abs(np.array(previous_tau) - tau) > limits['tau_rtol'] * tau):
+        return False
+
+    return bool(np.max(diagnostics['rhat']) < limits['rhat'] and np.min(diagnostics['ess']) >= limits['ess'])
+
+def chain_converged(chain, diagnosed = None, thresholds = None):
+
+    """
+      converged() for a whole (steps, walkers, parameters) chain that was not checked as it was sampled:
+    the autocorrelation time of the chain's first half stands in for that of a previous check, so the
+    autocorrelation time must have settled over the second half. diagnosed are the chain's diagnostics
+    (see diagnose()), if they have already been worked out.
+    """
+
+    if isinstance(diagnosed, type(None)):
+        diagnosed = diagnose(chain)
+
+    return converged(diagnosed, integrated_time(chain[:len(chain) // 2]), thresholds)
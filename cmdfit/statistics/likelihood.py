@@ -1,9 +1,5 @@
 import numpy as np
-import emcee
-from collections import Counter
 import cmdfit.processing.interp as interp
-import matplotlib.pyplot as plt
-import seaborn as sns
 from . import priors
 import cmdfit.data as data
 import cmdfit.isochrone as iso
@@ -123,45 +119,30 @@ def likelihood(star_theta, data_mag, phot_uncert, data_bandindex, allmodel_cmdse
     # Get a magnitude given the model parameters:
     model_mag = data.getcmdsetsmag(allmodel_cmdsets, age, initmass, FeH, FeH_list, data_bandindex, secondarymass = secondarymass)  
 
-    if not np.isfinite(model_mag):
-        if calc_log:
-            return -np.inf
-        else:
-            return 0.0
-
-    # Terms going into construction of the Gaussian term of the likelihood function (described in model.ipynb):
-    sigma = phot_uncert
-    const_factor = 1.0 / np.sqrt(2.0 * np.pi * sigma**2.0)
-    residual = data_mag - model_mag
-    exponent = -0.5 * (residual / sigma)**2.0
-
     # Uniform distribution from which magnitudes may be drawn in the case of a field star:
     data_mag_min, data_mag_max = data_mag_range
-    field_distribution = 1.0 / (data_mag_max - data_mag_min)
-    
-    # Likelihood functions for the ith data point compared to the ith model point in the single filter:
-    cluster_likelihood = (1 - Pfield) * const_factor * np.exp(exponent)
-    field_likelihood = Pfield * field_distribution
+    field_lndensity = -np.log(data_mag_max - data_mag_min)
+
+    # The cluster and field terms of the likelihood, combined in log space. A model magnitude that
+    # is not finite (e.g. a mass off the isochrone) leaves only the field term:
+    lnlikelihood = float(mixture_lnLikelihood(data_mag, phot_uncert, model_mag, Pfield, field_lndensity))
 
-    # Return the total likelihood function:
-    likelihood = cluster_likelihood + field_likelihood
-    
     if calc_log:
-        return np.log(likelihood)
+        return lnlikelihood
     else:
-        return likelihood
+        return np.exp(lnlikelihood)
 
 # Calculates the likelihood for all datapoints in a given band. This is what I need to run 
 def band_lnLikelihood(theta, band_magnitudes, band_uncertainties, bandindex, allmodel_cmdsets, FeH_list, mode = 'all', magindex = None):
 
     """
       This likelihood function is a part of the form of the likelihood used by van Dyk et al. 2009. This
-    function calls stardata_lnprobability() in order to calculate the log likelihood of all data points 
-    in the current color band. 
-      It runs an MCMC sampler in order to sample the mass parameter of each data point; it then determines 
-    the highest probability found by the sampler and takes this as the likelihood for star in the current 
-    color band. These likelihoods are combined to form a joint log-likelihood of all stars in the current 
-    band and this is returned as the final result.
+    function calculates the log likelihood of all data points in the current color band. 
+      In mode 'all', the mass of each data point is a nuisance parameter; it is marginalized over the
+    isochrone at the proposed age and metallicity (see mass_marginal_lnLikelihood()), which requires the
+    models as a ModelGrid. In mode 'single', stardata_lnprobability() is evaluated for the one data point
+    at the proposed masses. These likelihoods are combined to form a joint log-likelihood of all stars in
+    the current band and this is returned as the final result.
 
     INPUT:
     =====================================================================================================
@@ -188,10 +169,10 @@ def band_lnLikelihood(theta, band_magnitudes, band_uncertainties, bandindex, all
           An int signifying the current color band that we are operating within and from which to
         draw model generated magnitudes.
 
-        allmodel_cmdsets (cmdset, list):
+        allmodel_cmdsets (ModelGrid):
         +++++++++++++++++++++++++++++++++
-          A list holding the loaded model cmdset objects as its elements. These are passed so that appro-
-        priate model magnitudes may be looked up.
+          The loaded models, packed into a ModelGrid. These are passed so that appropriate model magnitudes
+        may be looked up.
 
         FeH_list (float, list):
         +++++++++++++++++++++++
@@ -205,8 +186,8 @@ def band_lnLikelihood(theta, band_magnitudes, band_uncertainties, bandindex, all
         return (float):
         +++++++++++++++++++
           The returned value represents the joint probability calculated for all data points in the current
-        band, as determined by the maximum probability found during MCMC sampling of mass, given the age
-        and metallicity supplied via the theta parameter.
+        band, with the mass of each marginalized (mode 'all'), given the age and metallicity supplied via
+        the theta parameter.
 
     """
     
@@ -223,87 +204,34 @@ def band_lnLikelihood(theta, band_magnitudes, band_uncertainties, bandindex, all
         FeH = theta[0]
         age = theta[1]
 
-        # Here the primary and secondary mass are sampled:
-        ndim = 1
-        nwalkers = 4
-        nsteps = 30
-  
-        # Make an isochrone of the proposed age:
-        if 8.0 < age < 10.0:
-            currentiso = iso.isochrone(allmodel_cmdsets[0], age, silent=True)
-            massbounds = (min(currentiso.initmasses.values), max(currentiso.initmasses.values))
-        # if the age proposition is out of range, return 0 probability:
-        else:
+        # The isochrone at the proposed [Fe/H] and age, interpolated by the model grid; if the age or
+        # metallicity is out of range, return 0 probability:
+        model = allmodel_cmdsets.isomodel(FeH, age)
+        if isinstance(model, type(None)) or len(model) < 2:
             return -np.inf
 
-        if ndim == 1:
-            init_positions = [1.0 + 1e-4*np.random.randn(ndim) for i in range(nwalkers)]
-
-        elif ndim == 2:
-            # For [primary mass, secondary mass]:
-            init_positions = [1.0, 0.4]
-            # Set up the walkers in a Gaussian ball around the initial positions:
-            init_positions = [init_positions + 1e-4*np.random.randn(ndim) for i in range(nwalkers)]
-        
-        for i in range(nwalkers):
-            if init_positions[i][0] > massbounds[1]:
-                init_positions[i][0] = massbounds[1]
-            if init_positions[i][0] < massbounds[0]:
-                init_positions[i][0] = massbounds[0]
-
-            if ndim >= 2:
-                if init_positionis[i][1] < massbounds[0]:
-                    init_positons[i][1] = massbounds[0]
-                if init_positions[i][1] > init_positions[0]:
-                    init_positions[i][1] = init_positions[0]
-
-        # Loop through and calculate the probabilities of each star, comparing each to 
-        # all masses on the current isochrone and finding the most likely:
-        lnLikelihood = []
-        for i in range(len(band_magnitudes)):
-
-            # Calculate the log likelihood for all stars in this band:
-            # For each star, I need to run MCMC to figure out the most likely mass sampling. 
-            # The lnprob returned by this sampling is the log likelihood for that star. 
-            # So replace likelihood() with a new function which is likelihood() * (mass priors) and do mcmc on that; get the lnprob from it.
-        
-            sampler = emcee.EnsembleSampler(nwalkers, ndim, stardata_lnprobability, 
-                                              args = (band_magnitudes[i], band_uncertainties[i], 
-                                                bandindex, allmodel_cmdsets, FeH_list, band_mag_range, FeH, age, mode))
-            
-            #print("RUNNING MCMC FOR STAR # {:d} OUT OF {:d} IN BAND {:d}...".format(i, len(band_magnitudes), bandindex))
-            sampler.run_mcmc(init_positions, nsteps)
-            # Gather sampled probabilities and cut out the burn in period. I took a look and it seems to be around 100...
-            lnprob = sampler.lnprobability[:,:]
-            lnprob = lnprob.reshape(-1)
-
-            # Now pick out the most common probability to find an approximation of the probability well the walkers fell into
-            probcounter = Counter(lnprob)
-            lnprob = probcounter.most_common(1)[0][0]
-       
-            lnLikelihood.append(lnprob)
-        
-        # lnLikelihood has all of the likelihood calculations for every magnitude in the current band. 
-        # Sum the loglikilihoods to get the full log-likelihood for the band:
-        full_lnLikelihood = np.sum(np.array(lnLikelihood))
+        # Each star's mass is marginalized over the models along the isochrone. The log likelihoods of 
+        # all stars in this band are summed to get the full log-likelihood for the band:
+        star_lnLikelihoods = mass_marginal_lnLikelihood(band_magnitudes, band_uncertainties, model[:, 0], model[:, 1 + bandindex])
+        full_lnLikelihood = np.sum(star_lnLikelihoods)
 
     elif mode == 'single':
  
         # In this mode, a fit is made to a single observed star using all models.
-        if len(theta == 3):
+        if len(theta) == 3:
             FeH = theta[0]
             age = theta[1]
             M1 = theta[2]
             Pfield = 0.0
             star_theta = (M1, Pfield)
-        elif len(theta >= 4):
+        elif len(theta) >= 4:
             FeH = theta[0]
             age = theta[1]
             M1 = theta[2]
             M2 = theta[3]
-            if len(theta == 4):
+            if len(theta) == 4:
                 Pfield = 0.0 
-            elif len(theta == 5):
+            elif len(theta) == 5:
                 Pfield = theta[4]
 
             star_theta = (M1, M2, Pfield)
@@ -325,13 +253,13 @@ def band_lnLikelihood(theta, band_magnitudes, band_uncertainties, bandindex, all
     return full_lnLikelihood
 
 # The joint likelihood from all bands:
-def allband_lnLikelihood(theta, data_cmdset, allmodel_cmdsets, FeH_list, mode='all', magindex = None):
+def allband_lnLikelihood(theta, data_cmdset, allmodel_cmdsets, FeH_list, mode='all', magindex = None, nodecache = None):
 
     """
-      This likelihood function is a part of the form of the likelihood used by van Dyk et al. 2009. This
-    function calls band_lnLikelihood() once for each color band in consideration. In this way is obtains
-    the likelihood for each color band; it then combines them to form the full joint log-likelihood of
-    all stars and their observed magnitudes in all color bands.
+      This likelihood function is a part of the form of the likelihood used by van Dyk et al. 2009. It 
+    interpolates the model photometry once for the proposed parameters, in all color bands, and compares
+    every star with it in all bands at once; a star has the same mass in every band. This gives the full
+    joint log-likelihood of all stars and their observed magnitudes in all color bands.
 
     INPUT:
     =====================================================================================================
@@ -347,11 +275,10 @@ def allband_lnLikelihood(theta, data_cmdset, allmodel_cmdsets, FeH_list, mode='a
           A cmdset object holding the data read in from a data table. This information corresponds to
         what has been observed.
 
-        allmodel_cmdsets (cmdset, list):
+        allmodel_cmdsets (ModelGrid):
         +++++++++++++++++++++++++++++++++
-          A list holding the loaded model cmdset objects as its elements. These are passed so that appro-
-        priate model magnitudes may be looked up. These cmdsets hold the information provided by the
-        models.
+          The loaded models, packed into a ModelGrid. These are passed so that appropriate model magnitudes
+        may be looked up.
 
         FeH_list (float, list):
         +++++++++++++++++++++++
@@ -365,25 +292,169 @@ def allband_lnLikelihood(theta, data_cmdset, allmodel_cmdsets, FeH_list, mode='a
         return (float):
         +++++++++++++++++++
           The returned value represents the joint log-probability calculated for all data points in all color
-        bands under consideration. This is the full log-likelihood of the data compared to the models.
+        bands under consideration. This is the full log-likelihood of the data compared to the models. In 
+        mode 'single' it also includes the prior on the star's masses.
+
+    OPTIONS:
+    ======================================================================================================
+
+        nodecache (NodeCache):
+        +++++++++++++++++++
+          Default: None
+
+          In mode 'all', a statistics.nodecache.NodeCache for the models; the likelihood is then interpolated
+        from the likelihoods cached at the grid nodes around theta (see NodeCache).
 
     """
 
-    # For how ever many bands input, sum the log-likelihoods of all bands to get the joint likelihood of all input observations compared to models.
-    band_lnLikelihoods = []
+    # All observed magnitudes and their uncertainties, as (stars x bands) arrays:
+    magnitudes, uncertainties = data_cmdset.getbands()
 
-    for i in range(data_cmdset.numbands):
+    FeH = theta[0]
+    age = theta[1]
 
-        # Make a band -- i.e. an array with the observed magnitudes in column 1 and their uncertainties in column 2:
-        band = data_cmdset.makeBand(i)
-        # Calculate the log-likelihood for the current band and store it in an array:
-        band_lnLikelihoods.append( band_lnLikelihood(theta, band[0], band[1], i, allmodel_cmdsets, FeH_list, mode, magindex)  )
-    
-    # Having calculated a likelihood for each band, sum the log-likelihoods to obtain 
-    # the full joint log-likelihood (which accounts for all bands and their magnitudes):
-    fulljoint_lnLikelihood = np.sum(np.array(band_lnLikelihoods))
+    if mode == 'all':
+
+        # With a node cache, the likelihood is interpolated from the grid nodes around theta:
+        if nodecache != None:
+            return nodecache.lnLikelihood(FeH, age, data_cmdset)
+
+        # The isochrone at the proposed [Fe/H] and age is interpolated once, in all bands; if the age or
+        # metallicity is out of range, return 0 probability:
+        model = allmodel_cmdsets.isomodel(FeH, age)
+        if isinstance(model, type(None)) or len(model) < 2:
+            return -np.inf
+
+        # Each star has one mass in all bands; it is marginalized over the isochrone with all bands at once:
+        star_lnLikelihoods = mass_marginal_lnLikelihood(magnitudes, uncertainties, model[:, 0], model[:, 1:1 + data_cmdset.numbands])
+
+        return np.sum(star_lnLikelihoods)
+
+    elif mode == 'single':
+
+        # The masses (and membership) proposed for the one star being fit:
+        star_theta = single_startheta(theta)
+
+        lnp = priors.star_lnprior(star_theta, mode='single')
+        if not np.isfinite(lnp):
+            return -np.inf
+
+        # The model photometry of the star (or unresolved binary) in all bands:
+        secondarymass = star_theta[1] if len(star_theta) == 3 else None
+        model_mags = allmodel_cmdsets.getmags(FeH, age, star_theta[0], secondarymass, bands=np.arange(data_cmdset.numbands))[0]
+
+        # The star's mass prior enters once; its cluster/field likelihoods in each band are combined:
+        Pfield = star_theta[-1]
+        band_lnLikelihoods = mixture_lnLikelihood(magnitudes[magindex], uncertainties[magindex], model_mags, Pfield,
+                                                  data_cmdset.getfieldlndensity())
+
+        return lnp + np.sum(band_lnLikelihoods)
+
+    else:
+        # Placeholder error message...
+        return 'ERROR: mode must be \'single\' or \'all\'.'
+
+def single_startheta(theta):
+
+    # Splits the star's parameters out of theta = (FeH, age, M1[, M2[, Pfield]]) as the
+    # (M1, Pfield) or (M1, M2, Pfield) tuples that priors.star_lnprior() expects:
+    if len(theta) == 3:
+        return (theta[2], 0.0)
+    elif len(theta) == 4:
+        return (theta[2], theta[3], 0.0)
+    else:
+        return (theta[2], theta[3], theta[4])
+
+# Number of (walker, star, model) elements that walkers_lnLikelihood() works on at once in mode 'all',
+# counting the models added by refine_nodes():
+walkers_blockelements = 2**18
+
+# Largest step in magnitude between neighbouring models that mass_marginal_lnLikelihood() integrates over,
+# as a fraction of the smallest sigma in each band (see refine_nodes()):
+marginal_node_spacing = 0.5
+
+def walkers_lnLikelihood(thetas, data_cmdset, allmodel_cmdsets, FeH_list, mode = 'all', magindex = None, nodecache = None):
+
+    """
+      allband_lnLikelihood() for many parameter sets at once, e.g. the positions of all of emcee's walkers
+    in a step. thetas is an array of shape (walkers, parameters); each row is a theta as allband_lnLikelihood()
+    takes it. The isochrones of all walkers are interpolated together and every walker is compared with the
+    data in the same array expressions, so there is no Python loop over walkers.
+
+    Returns an array holding the log-likelihood of each walker (with the star's mass prior in mode 'single').
+    """
+
+    thetas = np.atleast_2d(np.asarray(thetas, dtype=float))
+    magnitudes, uncertainties = data_cmdset.getbands()
+    numbands = data_cmdset.numbands
+
+    FeHs = thetas[:, 0]
+    ages = thetas[:, 1]
+
+    if mode == 'all':
+
+        # With a node cache, each walker's likelihood comes from the cached grid nodes around it:
+        if nodecache != None:
+            return np.array([nodecache.lnLikelihood(FeH, age, data_cmdset) for FeH, age in zip(FeHs, ages)])
 
-    return fulljoint_lnLikelihood
+        # Every walker's isochrone, padded with NaN to the same number of models (but no more than the
+        # longest of them needs):
+        models = allmodel_cmdsets.isomodels(FeHs, ages)
+        nmodels = np.sum(np.isfinite(models[:, :, 0]), axis=1)
+        models = models[:, :max(np.amax(nmodels), 1)]
+
+        # The number of models each walker's isochrone is refined to before it is integrated over (see
+        # mass_marginal_lnLikelihood()):
+        max_steps = marginal_node_spacing * np.min(uncertainties.reshape(len(magnitudes), -1), axis=0)
+        nrefined = np.sum(refine_splits(models[:, :, 1:1 + numbands], max_steps), axis=1) + 1
+
+        # The walkers are marginalized over in blocks, so that the (walkers, refined models, stars) array
+        # of each block stays small enough to be worked on in cache. A block takes walkers for as long as
+        # that many of them, with the most refined models among them, fit:
+        lnL = np.empty(len(thetas))
+        start = 0
+        while start < len(thetas):
+            elements = np.arange(1, len(thetas) - start + 1) * np.maximum.accumulate(nrefined[start:]) * len(magnitudes)
+            stop = start + max(1, np.sum(elements <= walkers_blockelements))
+
+            block = models[start:stop]
+            star_lnLikelihoods = mass_marginal_lnLikelihood(magnitudes, uncertainties, block[:, :, 0], block[:, :, 1:1 + numbands])
+            lnL[start:stop] = np.sum(star_lnLikelihoods, axis=1)
+            start = stop
+
+        # Walkers outside of the grid, or with too few models to integrate over, get 0 probability:
+        lnL[nmodels < 2] = -np.inf
+
+        return lnL
+
+    elif mode == 'single':
+
+        # The proposed masses (and membership) of the one star being fit, a row per walker:
+        ndim = thetas.shape[1]
+        Pfields = thetas[:, 4] if ndim == 5 else np.zeros(len(thetas))
+        if ndim == 3:
+            star_thetas = np.column_stack((thetas[:, 2], Pfields))
+            secondarymasses = None
+        else:
+            star_thetas = np.column_stack((thetas[:, 2], thetas[:, 3], Pfields))
+            secondarymasses = thetas[:, 3]
+
+        lnp = priors.walkers_star_lnprior(star_thetas)
+
+        model_mags = allmodel_cmdsets.getmags_each(FeHs, ages, thetas[:, 2], secondarymasses, bands=np.arange(numbands))
+
+        band_lnLikelihoods = mixture_lnLikelihood(magnitudes[magindex], uncertainties[magindex], model_mags, Pfields,
+                                                  data_cmdset.getfieldlndensity())
+        lnL = lnp + np.sum(band_lnLikelihoods, axis=1)
+
+        # Walkers whose masses are out of their prior's range:
+        lnL[~np.isfinite(lnp)] = -np.inf
+
+        return lnL
+
+    else:
+        # Placeholder error message...
+        return 'ERROR: mode must be \'single\' or \'all\'.'
 
 def stardata_lnprobability(star_theta, star_magnitude, star_sigma, bandindex, allmodel_cmdsets, FeH_list, band_mag_range, FeH, age, mode = 'single'):
 
@@ -465,3 +536,193 @@ def stardata_lnprobability(star_theta, star_magnitude, star_sigma, bandindex, al
 
     return lnp + likelihood(star_theta, star_magnitude, star_sigma, bandindex, allmodel_cmdsets, 
                               FeH_list, band_mag_range, FeH, age, calc_log=True, mode=mode)
+
+def mixture_lnLikelihood(magnitudes, sigmas, model_magnitudes, Pfield, field_lndensity):
+
+    """
+      The log of the cluster/field mixture likelihood of observed magnitudes (van Dyk et al. 2009):
+
+        L = (1 - Pfield) * N(magnitude | model magnitude, sigma) + Pfield * field density
+
+    The two terms are worked out and combined in log space (log(exp(a) + exp(b)) by np.logaddexp()), so a
+    star many sigma off its model magnitude keeps a finite log likelihood from the field term rather than
+    underflowing to zero. A model magnitude that is not finite has no cluster term.
+
+      magnitudes, sigmas and model_magnitudes broadcast against each other, with bands along the last axis
+    (e.g. (stars, bands), or (walkers, bands) for one star proposed by many walkers). Pfield is a number, 
+    or an array of one membership probability per star (or walker) along the leading axis. field_lndensity 
+    is the log of the field star density in each band, e.g. from cmdset.getfieldlndensity().
+
+    Returns an array of the log likelihood of each magnitude.
+    """
+
+    magnitudes = np.asarray(magnitudes, dtype=float)
+    model_magnitudes = np.asarray(model_magnitudes, dtype=float)
+    Pfield = np.asarray(Pfield, dtype=float)
+    if Pfield.ndim > 0:
+        Pfield = Pfield[..., np.newaxis]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        lncluster = (np.log1p(-Pfield) - 0.5 * ((magnitudes - model_magnitudes) / sigmas)**2.0 
+                     - np.log(np.sqrt(2.0 * np.pi) * sigmas))
+        lnfield = np.log(Pfield) + field_lndensity
+
+    lncluster = np.where(np.isfinite(model_magnitudes), lncluster, -np.inf)
+
+    return np.logaddexp(lncluster, lnfield)
+
+def refine_splits(node_magnitudes, max_steps, max_split = 64):
+
+    """
+      The number of parts that refine_nodes() splits each interval between neighbouring models of a stack
+    of isochrones into (node_magnitudes of shape (isochrones, nodes, bands)), as an array of shape
+    (isochrones, nodes - 1): enough that neighbouring models differ by no more than max_steps (one value per
+    band) in magnitude, and at most max_split. Each isochrone is refined to np.sum(splits, axis=1) + 1 models.
+    """
+
+    # Padding models (NaN) need no splitting; a zero max_steps needs as much as is allowed:
+    with np.errstate(divide='ignore', invalid='ignore'):
+        steps = np.abs(np.diff(node_magnitudes, axis=1)) / max_steps
+    steps[np.isnan(steps)] = 0.0
+
+    return np.ceil(np.clip(np.max(steps, axis=2), 1.0, max_split)).astype(int)
+
+def refine_nodes(node_masses, node_magnitudes, max_steps, max_split = 64):
+
+    """
+      Splits the intervals between the models of a stack of isochrones (node_masses of shape (isochrones,
+    nodes), node_magnitudes of shape (isochrones, nodes, bands)) so that neighbouring models differ by no
+    more than max_steps (one value per band) in magnitude (see refine_splits()). New models are placed
+    evenly in mass, with their magnitudes interpolated linearly as in ModelGrid.getmags(). Each isochrone
+    is refined on its own, so a sparse isochrone does not add models to the others; the refined stack is
+    padded at the end with NaN to the longest of them.
+    """
+
+    if node_masses.shape[1] < 2:
+        return node_masses, node_magnitudes
+
+    splits = refine_splits(node_magnitudes, max_steps, max_split)
+    if np.all(splits == 1):
+        return node_masses, node_magnitudes
+
+    nisochrones, nintervals = splits.shape
+    added = np.sum(splits, axis=1)
+
+    # Each new model's isochrone, the left model of its interval, how far along the interval it is, and
+    # its place in the refined isochrone:
+    flat = splits.ravel()
+    isochrone = np.repeat(np.arange(nisochrones), added)
+    left = np.repeat(np.tile(np.arange(nintervals), nisochrones), flat)
+    fraction = (np.arange(len(left)) - np.repeat(np.cumsum(flat) - flat, flat)) / np.repeat(flat, flat)
+    place = np.arange(len(left)) - np.repeat(np.cumsum(added) - added, added)
+
+    # A model at the start of its interval is copied as it is, so that the last model of an isochrone
+    # padded with NaN is kept:
+    at_left = (fraction == 0)[:, np.newaxis]
+    masses = np.full((nisochrones, np.amax(added) + 1), np.nan)
+    magnitudes = np.full(masses.shape + node_magnitudes.shape[2:], np.nan)
+    lower_masses, upper_masses = node_masses[isochrone, left], node_masses[isochrone, left + 1]
+    lower_mags, upper_mags = node_magnitudes[isochrone, left], node_magnitudes[isochrone, left + 1]
+    masses[isochrone, place] = np.where(at_left[:, 0], lower_masses, lower_masses + fraction * (upper_masses - lower_masses))
+    magnitudes[isochrone, place] = np.where(at_left, lower_mags, lower_mags + fraction[:, np.newaxis] * (upper_mags - lower_mags))
+
+    masses[np.arange(nisochrones), added] = node_masses[:, -1]
+    magnitudes[np.arange(nisochrones), added] = node_magnitudes[:, -1]
+
+    return masses, magnitudes
+
+def mass_marginal_lnLikelihood(star_magnitudes, star_sigmas, node_masses, node_magnitudes, node_spacing = marginal_node_spacing):
+
+    """
+      The log likelihood of each of the given stars with its initial mass marginalized over an isochrone:
+
+        L_i = integral over m of primary_mass_prior(m) * N(star_magnitudes_i | model magnitude(m), star_sigmas_i) dm
+
+    The integral is done by the trapezoid rule in mass along the isochrone, taken to be linear between its
+    models (node_masses, in order of increasing mass, and their node_magnitudes), for all stars at once;
+    stars are taken to be cluster members. The trapezoid rule is only accurate where a star's Gaussian
+    spans several nodes, so intervals whose models differ by more than node_spacing times the smallest sigma
+    in a band are first split (see refine_nodes()); every star shares the nodes, so the most precise star
+    sets their spacing. Intervals are split at most 64 times: where neighbouring models differ by more than
+    64 * node_spacing sigma, the integral is approximate.
+
+      Magnitudes may be given in one band (star_magnitudes and star_sigmas of shape (stars,), node_magnitudes
+    of shape (nodes,)) or in several (shapes (stars, bands) and (nodes, bands)); with several bands, N is the
+    product of the Gaussians in each band, so that each star has one mass in all of them.
+
+      node_masses may also be a stack of isochrones, of shape (isochrones, nodes), with node_magnitudes of
+    shape (isochrones, nodes[, bands]); an isochrone with fewer nodes than the others is padded at the end
+    with NaN (as from ModelGrid.isomodels()). The stars are then marginalized over every isochrone at once,
+    with each isochrone's nodes refined on their own.
+
+    Returns an array holding the log likelihood of each star (of shape (isochrones, stars) for a stack).
+    """
+
+    star_magnitudes = np.asarray(star_magnitudes, dtype=float)
+    star_sigmas = np.asarray(star_sigmas, dtype=float)
+    nstars = len(star_magnitudes)
+
+    stacked = np.ndim(node_masses) == 2
+    node_masses = np.atleast_2d(node_masses)
+    nisochrones, nnodes = node_masses.shape
+
+    star_magnitudes = star_magnitudes.reshape(nstars, -1)
+    star_sigmas = star_sigmas.reshape(nstars, -1)
+    node_magnitudes = np.asarray(node_magnitudes, dtype=float).reshape(nisochrones, nnodes, -1)
+
+    # Nodes close enough together in magnitude that no star's Gaussian falls between them:
+    node_masses, node_magnitudes = refine_nodes(node_masses, node_magnitudes, node_spacing * np.min(star_sigmas, axis=0))
+    nnodes = node_masses.shape[1]
+
+    # Trapezoid weights of the nodes, combined with the prior on mass at each node; padding nodes get 
+    # no weight:
+    missing = ~np.isfinite(node_masses)
+    dmass = np.diff(node_masses, axis=1)
+    dmass[~np.isfinite(dmass)] = 0.0
+    weights = np.zeros(node_masses.shape)
+    weights[:, :-1] += 0.5 * dmass
+    weights[:, 1:] += 0.5 * dmass
+    with np.errstate(divide='ignore', invalid='ignore'):
+        lnweights = np.log(weights) + priors.primary_mass_lnprior(node_masses)
+    lnweights[missing] = -np.inf
+    node_magnitudes = np.where(missing[:, :, np.newaxis], 0.0, node_magnitudes)
+
+    # Gaussian log likelihood of every star against every node, summed over bands. The chi-square is
+    # expanded so that the node-star cross terms are single matrix products, over the nodes of all
+    # isochrones at once; the (isochrones, nodes, stars) array is built up in place. Magnitudes are first
+    # taken relative to the stars' mean in each band, so that the expanded terms stay small and their
+    # difference does not lose its precision to cancellation:
+    center = np.mean(star_magnitudes, axis=0)
+    star_magnitudes = star_magnitudes - center
+    node_magnitudes = node_magnitudes - center
+    inverse_variance = 1.0 / star_sigmas**2.0
+    nodes = node_magnitudes.reshape(nisochrones * nnodes, -1)
+    lnnormal = np.dot(nodes, (star_magnitudes * inverse_variance).T)
+    lnnormal -= 0.5 * np.dot(nodes**2.0, inverse_variance.T)
+    lnnormal -= 0.5 * np.sum(star_magnitudes**2.0 * inverse_variance, axis=1) + np.sum(np.log(np.sqrt(2.0 * np.pi) * star_sigmas), axis=1)
+    lnnormal = lnnormal.reshape(nisochrones, nnodes, nstars)
+    lnnormal += lnweights[:, :, np.newaxis]
+
+    lnL = logsumexp(lnnormal, axis=1)
+
+    return lnL if stacked else lnL[0]
+
+def logsumexp(a, axis = None):
+
+    # log(sum(exp(a))) along an axis, without overflow or underflow; rows that are all -inf give -inf.
+    # Terms more than 700 e-folds below the largest (including -inf ones) cannot change the sum; they
+    # are raised to that floor so that exp() stays off its (much slower) underflow path, and then left
+    # out of the sum:
+    a_max = np.amax(a, axis=axis, keepdims=True)
+    finite = np.isfinite(a_max)
+    a_max = np.where(finite, a_max, 0.0)
+
+    shifted = np.maximum(a - a_max, -700.0)
+    terms = np.exp(shifted, out=shifted)
+    terms[terms <= np.exp(-700.0)] = 0.0
+
+    with np.errstate(divide='ignore'):
+        result = np.log(np.sum(terms, axis=axis, keepdims=True)) + a_max
+    result[~finite] = -np.inf
+
+    return np.squeeze(result, axis=axis) if axis != None else result.reshape(())
@@ -0,0 +1,146 @@
+import numpy as np
+from collections import OrderedDict
+from cmdfit.processing import interp
+from . import likelihood
+
+class NodeCache(object):
+
+    """
+      A cache of the cluster fit's likelihood at the nodes of a ModelGrid, for fitall()'s mode 'all'. For each
+    ([Fe/H], age) node that the sampler's walkers come near, it keeps the node's isochrone (the initial mass
+    and magnitudes of its models) and the log likelihood of every observed star with its mass marginalized
+    along that isochrone (see likelihood.mass_marginal_lnLikelihood()).
+
+      Between nodes, each star's likelihood is interpolated bilinearly from the (up to) four nodes around
+    the proposed [Fe/H] and age, so a posterior evaluation only needs nodes that are already cached, rather
+    than a new isochrone and a new marginalization over all stars. This is exact at the nodes; between
+    them it interpolates the likelihood rather than the isochrone, which is a fair approximation when the
+    grid is fine compared with the width of the posterior.
+
+      The cache is bounded by maxbytes and evicts the least recently used nodes first. Its hits, misses,
+    evictions and memory in use are kept as counters (see stats()).
+    """
+
+    def __init__(self, grid, maxbytes = 64 * 2**20):
+
+        self.grid = grid
+        self.maxbytes = maxbytes
+
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # The star likelihoods are only valid for the data they were worked out for:
+        self._dataframe = None
+
+    def clear(self):
+
+        """
+          Empties the cache; the counters are kept.
+        """
+
+        self.entries.clear()
+        self.nbytes = 0
+
+    def get(self, key, make):
+
+        # Looks up an entry, making and storing it with make() if it is not cached:
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+        self.misses += 1
+        value = make()
+
+        self.entries[key] = value
+        self.nbytes += value.nbytes
+
+        # Evict the least recently used entries until the cache fits (the newest entry is always kept):
+        while self.nbytes > self.maxbytes and len(self.entries) > 1:
+            oldkey, oldvalue = self.entries.popitem(last=False)
+            self.nbytes -= oldvalue.nbytes
+            self.evictions += 1
+
+        return value
+
+    def nodemodel(self, FeH_index, age_index):
+
+        """
+          Returns the isochrone at a node of the grid as an array of the initial mass and magnitudes (and
+        fluxes) of its models, in order of EEP.
+        """
+
+        def make():
+            models = self.grid.eepgrid()[FeH_index, age_index]
+            return np.array(models[np.isfinite(models[:, 0])], dtype=float)
+
+        return self.get(('model', FeH_index, age_index), make)
+
+    def nodelnLikelihoods(self, FeH_index, age_index, data_cmdset):
+
+        """
+          Returns the log likelihood of each star of data_cmdset, in all bands, with its mass marginalized
+        along the isochrone at a node of the grid.
+        """
+
+        # New data make the star likelihoods stale:
+        if self._dataframe is not data_cmdset.magnitudes:
+            for key in [key for key in self.entries if key[0] == 'lnL']:
+                self.nbytes -= self.entries.pop(key).nbytes
+            self._dataframe = data_cmdset.magnitudes
+
+        def make():
+            magnitudes, uncertainties = data_cmdset.getbands()
+            model = self.nodemodel(FeH_index, age_index)
+
+            if len(model) < 2:
+                return np.full(len(magnitudes), -np.inf)
+
+            return likelihood.mass_marginal_lnLikelihood(magnitudes, uncertainties, model[:, 0], model[:, 1:1 + data_cmdset.numbands])
+
+        return self.get(('lnL', FeH_index, age_index), make)
+
+    def lnLikelihood(self, FeH, age, data_cmdset):
+
+        """
+          The full log likelihood of all stars at the given [Fe/H] and age, from the cached nodes around it.
+        Returns -inf outside of the grid.
+        """
+
+        FeH_index, FeH_weight, FeH_inside = interp.find_brackets(FeH, self.grid.FeHs)
+        age_index, age_weight, age_inside = interp.find_brackets(age, self.grid.ages)
+
+        if not (FeH_inside and age_inside):
+            return -np.inf
+
+        # Each star's likelihood is the weighted sum of its likelihoods at the nodes (with weight) around
+        # the proposed values; this is done in log space:
+        lnweights = []
+        node_lnLikelihoods = []
+        for i, FeH_w in ((FeH_index, 1.0 - FeH_weight), (FeH_index + 1, FeH_weight)):
+            for j, age_w in ((age_index, 1.0 - age_weight), (age_index + 1, age_weight)):
+                if FeH_w * age_w > 0:
+                    lnweights.append(np.log(FeH_w * age_w))
+                    node_lnLikelihoods.append(self.nodelnLikelihoods(int(i), int(j), data_cmdset))
+
+        star_lnLikelihoods = likelihood.logsumexp(np.array(node_lnLikelihoods) + np.array(lnweights)[:, np.newaxis], axis=0)
+
+        return np.sum(star_lnLikelihoods)
+
+    def hitrate(self):
+
+        lookups = self.hits + self.misses
+
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self):
+
+        """
+          Returns the cache's counters: hits, misses, hit rate, evictions, entries held and bytes in use.
+        """
+
+        return {'hits': self.hits, 'misses': self.misses, 'hitrate': self.hitrate(), 'evictions': self.evictions,
+                'entries': len(self.entries), 'nbytes': self.nbytes}
@@ -0,0 +1,169 @@
+import numpy as np
+import os
+import shutil
+import tempfile
+from cmdfit import data
+from . import MCMC
+from .nodecache import NodeCache
+
+# The model grid, data and posterior settings of a worker process; set once, when the worker starts (see attach()):
+worker = {}
+
+# Limits on the worker processes that pool_workers() allows. The overheads are the time it takes a SamplerPool
+# to hand out one task and collect its result, on top of the work itself, as measured by
+# benchmarks/bench_scaling.py on a mock cluster of 10 and 200 stars: 0.4 to 1.1 ms per walker evaluated on
+# its own (0.75 to 3 ms of work), and 3.5 to 7 ms per block of 16 walkers (emcee's vectorize mode, or a
+# chunk of a mesh; 12 to 95 ms of work). With w workers, a task has to take more than w / (w - 1) times as
+# long as its overhead for the pool to pay. Functions that start pools take a dict of the limits to change
+# as pool_limits:
+default_pool_limits = {'cpus': None,             # most workers started (None for the number of CPUs)
+                       'walker_overhead': 1e-3,  # seconds per walker evaluated on its own...
+                       'block_overhead': 5e-3}   # ...and per block of walkers
+
+# ==========================================================================================================================
+
+def cpu_count():
+    return os.cpu_count() or 1
+
+def pool_workers(workers, ntasks = None, task_seconds = None, kind = 'walker', limits = None):
+
+    """
+      The number of worker processes worth starting when workers are asked for: no more than there are CPUs,
+    or tasks (ntasks) shared out at a time. Returns None, for evaluating serially, if that leaves fewer than
+    two workers, or if a task (which took task_seconds when evaluated serially) is too quick to make up for
+    handing it to a worker. kind is 'walker' or 'block'; limits are the limits to change from
+    default_pool_limits (e.g. {'cpus': 8} to allow 8 workers on any machine, or overheads of 0 to use the
+    pool however quick the tasks are).
+    """
+
+    limits = dict(default_pool_limits, **({} if limits == None else limits))
+    cpus = cpu_count() if limits['cpus'] == None else limits['cpus']
+    overhead = limits[kind + '_overhead']
+
+    if workers == None or workers < 2:
+        return None
+
+    usable = min(workers, cpus)
+    if ntasks != None:
+        usable = min(usable, ntasks)
+
+    if usable < 2:
+        print('WARNING: {:d} worker processes were asked for, but there are {:d} CPU(s) for {} tasks at a time; '
+              'evaluating serially.'.format(workers, cpus, ntasks if ntasks != None else 'any'))
+        return None
+
+    if task_seconds != None and task_seconds * (usable - 1) / usable < overhead:
+        print('WARNING: A task takes {:.2g} ms, too little to make up for handing it to a worker process ({:.2g} ms); '
+              'evaluating serially.'.format(1e3 * task_seconds, 1e3 * overhead))
+        return None
+
+    return usable
+
+# ==========================================================================================================================
+
+def attach(grid_path, data_path, bandnames, FeH_list, FeH_range, age_range, mode, magindex, nodecache_bytes):
+
+    """
+      Starts a worker process: memory-maps the model grid and data arrays that the parent process wrote out,
+    and keeps them with the posterior's settings, so that tasks only need to pass the walkers' parameters.
+    """
+
+    grid = data.ModelGrid.load(grid_path)
+    magnitudes = np.load(os.path.join(data_path, 'magnitudes.npy'), mmap_mode='r')
+    uncertainties = np.load(os.path.join(data_path, 'uncertainties.npy'), mmap_mode='r')
+
+    worker['grid'] = grid
+    worker['data'] = data.cmdset.fromdataarrays(magnitudes, uncertainties, bandnames)
+    worker['args'] = (FeH_list, FeH_range, age_range, mode, magindex)
+    worker['nodecache'] = None if nodecache_bytes == None else NodeCache(grid, maxbytes=nodecache_bytes)
+
+def pool_lnposterior(theta):
+
+    # MCMC.lnposterior() for one walker, on the worker's grid and data:
+    FeH_list, FeH_range, age_range, mode, magindex = worker['args']
+
+    return MCMC.lnposterior(theta, worker['data'], worker['grid'], FeH_list, FeH_range, age_range, mode, magindex, worker['nodecache'])
+
+def pool_walkers_lnposterior(thetas):
+
+    # MCMC.walkers_lnposterior() for a block of walkers (or mesh points), on the worker's grid and data:
+    FeH_list, FeH_range, age_range, mode, magindex = worker['args']
+
+    return MCMC.walkers_lnposterior(thetas, worker['data'], worker['grid'], FeH_list, FeH_range, age_range, mode, magindex, worker['nodecache'])
+
+def pool_fitstar(task):
+
+    # batch.fitstar() for one star of the worker's data, on its grid; task is (star index, fit settings):
+    from cmdfit import batch
+
+    star_index, settings = task
+
+    return batch.fitstar(star_index, worker['data'], worker['grid'], settings)
+
+# ==========================================================================================================================
+
+class SamplerPool(object):
+
+    """
+      A pool of worker processes that evaluate the posterior. The observed magnitudes are written to a
+    temporary directory, and the model grid (with its dense EEP grid) is saved once per program (see
+    ModelGrid.share()); every worker memory-maps them when it starts. The workers then share one read-only
+    copy, and only walkers' parameters and log-posteriors pass between processes. A grid that was loaded
+    from disk with its EEP grid is attached to directly.
+
+      The pool's map() is what emcee's EnsembleSampler(pool=...) calls, with pool_lnposterior as the function.
+    For emcee's vectorize mode, walkers_lnposterior() splits the walkers of a step between the workers.
+    Whole fits of single stars are shared out with imap_unordered() and pool_fitstar (see batch.fitstars()).
+    Use it in a with block, or call close() when done, so that the workers and temporary files are removed.
+    """
+
+    def __init__(self, workers, data_cmdset, allmodel_cmdsets, FeH_list, FeH_range, age_range, mode = 'all', magindex = None,
+                 nodecache_bytes = None):
+
+        # Imported here so that the statistics modules do not load multiprocessing unless a pool is used:
+        import multiprocessing
+
+        self.workers = workers
+        self.tmp_dir = tempfile.mkdtemp(prefix='cmdfit_pool_')
+
+        grid_path = allmodel_cmdsets.share()
+
+        magnitudes, uncertainties = data_cmdset.getbands()
+        np.save(os.path.join(self.tmp_dir, 'magnitudes.npy'), magnitudes)
+        np.save(os.path.join(self.tmp_dir, 'uncertainties.npy'), uncertainties)
+
+        bandnames = [str(name) for name in data_cmdset.magnitudes.columns[:data_cmdset.numbands]]
+        self.pool = multiprocessing.Pool(workers, initializer=attach,
+                                         initargs=(grid_path, self.tmp_dir, bandnames, np.asarray(FeH_list), FeH_range, age_range,
+                                                   mode, magindex, nodecache_bytes))
+
+    def map(self, func, iterable):
+
+        return self.pool.map(func, iterable)
+
+    def imap_unordered(self, func, iterable, chunksize = 1):
+
+        # Results as they are done; idle workers take the next chunksize tasks, so uneven tasks balance out:
+        return self.pool.imap_unordered(func, iterable, chunksize)
+
+    def walkers_lnposterior(self, thetas):
+
+        """
+          The log-posteriors of all walkers, with the walkers split into one block per worker.
+        """
+
+        blocks = np.array_split(np.atleast_2d(thetas), self.workers)
+
+        return np.concatenate(self.pool.map(pool_walkers_lnposterior, blocks))
+
+    def close(self):
+
+        self.pool.close()
+        self.pool.join()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
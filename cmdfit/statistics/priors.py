@@ -166,6 +166,43 @@ def star_lnprior(star_theta, mode = 'single'):
 
     return -np.inf
 
+def walkers_lnprior(thetas, FeH_range, age_range):
+
+    """
+      lnprior() for many parameter sets at once: thetas is an array of shape (walkers, parameters) with 
+    [Fe/H] and log10 age in its first two columns. Returns an array of the log-prior of each walker.
+    """
+
+    thetas = np.atleast_2d(thetas)
+    metallicities = thetas[:, 0]
+    ages = thetas[:, 1]
+
+    inrange = (age_range[0] < ages) & (ages < age_range[1])
+
+    return np.where(inrange, FeH_lnprior(metallicities), -np.inf)
+
+def walkers_star_lnprior(star_thetas):
+
+    """
+      star_lnprior() (in mode 'single') for many stars at once: star_thetas is an array of shape (walkers, 2)
+    holding the primary mass and Pfield, or (walkers, 3) holding the primary mass, secondary mass and Pfield.
+    Returns an array of the log-prior of each walker.
+    """
+
+    star_thetas = np.atleast_2d(star_thetas)
+    primary_masses = star_thetas[:, 0]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        lnp = primary_mass_lnprior(primary_masses)
+
+    if star_thetas.shape[1] == 3:
+        secondary_masses = star_thetas[:, 1]
+        Pfields = star_thetas[:, 2]
+        inrange = (0.0 <= secondary_masses) & (secondary_masses <= primary_masses) & (0.0 <= Pfields) & (Pfields <= 1.0)
+        lnp = np.where(inrange, lnp, -np.inf)
+
+    return np.where(np.isnan(lnp), -np.inf, lnp)
+
 def FeH_lnprior(metallicity, calc_log = True):
 
     # Gaussian metallicity prior w/ std. dev. of +/- 0.1 dex, 
@@ -0,0 +1,116 @@
+import os
+import numpy as np
+
+# Writes small, synthetic model files laid out like the MIST v0.31 .iso.cmd files that the
+# package reads (the real model files are too large to keep in the repository). Magnitudes
+# are smooth functions of initial mass, log10 age and [Fe/H] so that interpolation results
+# can be checked against the generating function.
+
+bandnames = ['Bessell_U', 'Bessell_B', 'Bessell_V', 'Bessell_R', 'Bessell_I', '2MASS_J', '2MASS_H', '2MASS_Ks']
+colnames = ['EEP', 'log10_isochrone_age_yr', 'initial_mass', 'star_mass', 'log_Teff', 'log_g', 'log_L'] + bandnames + ['phase']
+
+def mock_mass(eep, age):
+
+    # Initial mass increases monotonically with EEP; older isochrones end at lower masses.
+    maxmass = 8.0 - 6.0 * (age - 7.5) / 2.5
+    return 0.3 + (maxmass - 0.3) * ((eep - 200.0) / 600.0)**1.5
+
+def mock_mag(mass, age, FeH, band):
+
+    # A smooth, monotonic magnitude law; every band is offset from the previous one.
+    return 4.0 - 5.0 * np.log10(mass) + 0.3 * (age - 8.0) + 0.5 * FeH + 0.2 * band
+
+def write_mockmodel(model_file, FeH, ages=None, eeps=None, incomplete_line=True):
+
+    """
+      Writes a synthetic MIST-like .iso.cmd file with the given [Fe/H] to model_file.
+    """
+
+    if ages is None:
+        ages = np.round(np.arange(7.5, 10.0 + 1e-6, 0.1), 2)
+    if eeps is None:
+        eeps = np.arange(200, 801)
+
+    lines = ['# MIST version number  = 0.31',
+             '# MESA revision number =     7503',
+             '# photometric system = UBVRIplus',
+             '# --------------------------------------------------------------------------------------',
+             '#      Yinit        Zinit   [Fe/H]   [a/Fe]  v/vcrit',
+             '#     0.2703   1.6862E-02   {:6.2f}     0.00     0.40'.format(FeH),
+             '# number of isochrones = {:4d}'.format(len(ages)),
+             '# --------------------------------------------------------------------------------------']
+
+    for age in ages:
+        # Older isochrones lose their most massive (highest EEP) stars:
+        age_eeps = eeps[: len(eeps) - int(20 * (age - ages[0]))]
+        masses = mock_mass(age_eeps, age)
+
+        lines.append('# number of EEPs, cols = {:6d} {:5d}'.format(len(age_eeps), len(colnames)))
+        lines.append('#' + ''.join('{:>24d}'.format(i + 1) for i in range(len(colnames))))
+        lines.append('#' + ''.join('{:>24s}'.format(name) for name in colnames))
+
+        for eep, mass in zip(age_eeps, masses):
+            values = [age, mass, 0.99 * mass, 3.8, 4.4, np.log10(mass)]
+            values += [mock_mag(mass, age, FeH, b) for b in range(len(bandnames))]
+            values += [0.0]
+            lines.append('{:>25d}'.format(int(eep)) + ''.join('{:24.16E}'.format(v) for v in values))
+
+        # Mimic the occasional truncated line found in MIST files:
+        if incomplete_line:
+            lines.append('{:>25d}'.format(int(age_eeps[-1]) + 1) + '{:24.16E}'.format(age))
+
+        lines.append('')
+        lines.append('')
+
+    f = open(model_file, 'w')
+    f.write('\n'.join(lines) + '\n')
+    f.close()
+
+    return model_file
+
+def write_mockrun(run_dir, FeHs = (-0.10, 0.00, 0.15), **kwargs):
+
+    """
+      Writes one synthetic model file per [Fe/H] into run_dir and returns their paths.
+    """
+
+    if not os.path.isdir(run_dir):
+        os.makedirs(run_dir)
+
+    model_files = []
+    for FeH in FeHs:
+        name = 'MIST_v0.31_feh_{:s}{:.2f}_afe_p0.0_vvcrit0.4_mock_full.iso.cmd'.format('m' if FeH < 0 else 'p', abs(FeH))
+        model_files.append(write_mockmodel(os.path.join(run_dir, name), FeH, **kwargs))
+
+    return model_files
+
+def load_mockgrid(run_dir, usecol = (12, 13)):
+
+    """
+      Loads a synthetic model run written by write_mockrun() as a ModelGrid in the given columns.
+    """
+
+    from cmdfit import data
+
+    return data.all_modelcmdsets(8.0, usecol=usecol, cache=False, model_dir=run_dir, asgrid=True)
+
+def mock_cluster(grid, nstars = 10, massrange = (0.6, 1.4), FeH = 0.05, age = 8.55, sigma = 0.05):
+
+    """
+      Returns a data cmdset of nstars cluster stars at the given [Fe/H] and age of a ModelGrid, evenly spaced
+    in mass over massrange, with their magnitudes offset by 0.02 from the models and uncertainties of sigma.
+    """
+
+    from cmdfit import data
+
+    magnitudes = grid.getmags(FeH, age, np.linspace(massrange[0], massrange[1], nstars)) + 0.02
+
+    return data.cmdset.fromdataarrays(magnitudes, np.full(magnitudes.shape, sigma), grid.bandnames)
+
+def posterior_args(data_cmdset, grid, mode = 'all', magindex = None):
+
+    """
+      The arguments after theta of MCMC.lnposterior() for the given data and grid, over the grid's ranges.
+    """
+
+    return (data_cmdset, grid, grid.FeHs, (grid.FeHs[0], grid.FeHs[-1]), (grid.ages[0], grid.ages[-1]), mode, magindex, None)
@@ -1,15 +1,50 @@
-from unittest import TestCase
+from unittest import TestCase, mock
 import os
+import shutil
+import tempfile
 import numpy as np
 import pandas as pd
 import cmdfit.processing.columnread as cread
 from cmdfit import data as data
 import cmdfit.processing.magcorrections as magcorr
+import cmdfit.processing.modelcache as modelcache
+import cmdfit.processing.interp as interp
 from cmdfit import isochrone as isochrone
 from cmdfit import isointerpmag
+import pickle
+import subprocess
+import sys
 import emcee
 from cmdfit import fitsingle
 from cmdfit import fitall
+from cmdfit import batch
+from cmdfit.statistics import likelihood, priors, MCMC, diagnostics, parallel
+from cmdfit.statistics.nodecache import NodeCache
+from cmdfit.tests import mockmodels
+
+# The mock model run (see mockmodels.write_mockrun()) is written once for the module, the first time a
+# test needs it:
+mockrun = {'dir': None}
+
+def tearDownModule():
+    if mockrun['dir'] != None:
+        shutil.rmtree(mockrun['dir'])
+
+# Tests on the mock model grid. Each class loads its own grid from the module's mock run and shares it
+# between its tests; each test gets its own temporary directory for anything it writes:
+class MockGridTestCase(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        if mockrun['dir'] == None:
+            mockrun['dir'] = tempfile.mkdtemp()
+            mockmodels.write_mockrun(os.path.join(mockrun['dir'], 'run'))
+        cls.grid = mockmodels.load_mockgrid(os.path.join(mockrun['dir'], 'run'))
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
 
 # Tests that headers are being read correctly:
 class TestIO(TestCase):
@@ -23,6 +58,863 @@ class TestIO(TestCase):
         
         self.assertEqual(test_data[3], 'Vperp')
 
+    def test_headercache(self):
+        tmp_dir = tempfile.mkdtemp()
+        model_file = mockmodels.write_mockmodel(os.path.join(tmp_dir, 'mock.iso.cmd'), -0.10)
+
+        hlist, metadata = cread.read_header(model_file)
+        self.assertEqual(hlist, mockmodels.colnames)
+        self.assertEqual(metadata[2], -0.10)
+        self.assertEqual(cread.get_header(model_file, 'model'), mockmodels.colnames[7:])
+
+        # The second read comes from the cache:
+        self.assertEqual(cread.read_header(model_file)[0] is hlist, True)
+
+        # ...unless the file changes:
+        os.utime(model_file, ns=(0, 0))
+        self.assertEqual(cread.read_header(model_file)[0] is hlist, False)
+
+        shutil.rmtree(tmp_dir)
+
+# Tests that the single-pass model reader agrees with the column-at-a-time reader:
+class TestModelRead(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.model_file = mockmodels.write_mockmodel(os.path.join(self.tmp_dir, 'mock.iso.cmd'), 0.15)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_modelread(self):
+        table, names, metadata = cread.read_modeltable(self.model_file)
+
+        self.assertEqual(names, mockmodels.colnames)
+        self.assertEqual(table.shape[1], len(mockmodels.colnames))
+        self.assertEqual(metadata[2], 0.15)
+
+        # J and H magnitudes, ages and masses from one read:
+        mags, ages, masses, metadata = cread.get_modelvalues(self.model_file, (12, 13))
+        Jmags, Jages, Jmasses, Jmetadata = cread.get_values(self.model_file, 12, mode='model', model_extras=True)
+        Hmags = cread.get_values(self.model_file, 13, mode='model')
+
+        self.assertEqual(np.array_equal(mags[:, 0], Jmags), True)
+        self.assertEqual(np.array_equal(mags[:, 1], Hmags), True)
+        self.assertEqual(np.array_equal(ages, Jages), True)
+        self.assertEqual(np.array_equal(masses, Jmasses), True)
+
+    def test_modelselection(self):
+        table, names, metadata = cread.read_modeltable(self.model_file)
+
+        # Cuts applied while reading match cuts applied to the full table:
+        keep = (table[:, 1] >= 8.0) & (table[:, 1] <= 9.0) & (table[:, 2] >= 0.5) & (table[:, 2] <= 2.0)
+        selected, names, metadata = cread.read_modeltable(self.model_file, usecols=(13, 1), agecut=8.0, agemax=9.0, massrange=(0.5, 2.0))
+
+        self.assertEqual(np.array_equal(selected, table[keep][:, [13, 1]]), True)
+
+        model = data.cmdset('model', 8.0, self.model_file, (12, 13), cache=False, agemax=9.0, massrange=(0.5, 2.0))
+        self.assertEqual(np.array_equal(model.magnitudes.values[:, 1], table[keep][:, 13] + 3.33), True)
+        self.assertEqual(len(model.eeps), np.sum(keep))
+
+        # The mass range may be given as an array:
+        arrayrange = data.cmdset('model', 8.0, self.model_file, (12, 13), cache=False, agemax=9.0, massrange=np.array([0.5, 2.0]))
+        self.assertEqual(np.array_equal(arrayrange.magnitudes.values, model.magnitudes.values), True)
+
+# Tests that parsed model files are cached and invalidated:
+class TestModelCache(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.model_file = mockmodels.write_mockmodel(os.path.join(self.tmp_dir, 'mock.iso.cmd'), 0.15)
+        modelcache.set_cache_dir(os.path.join(self.tmp_dir, 'cache'))
+
+    def tearDown(self):
+        modelcache.set_cache_dir(None)
+        shutil.rmtree(self.tmp_dir)
+
+    def test_modelcache(self):
+        indices = (12, 13)
+
+        parsed = data.cmdset('model', data_file = self.model_file, usecol = indices)
+        self.assertEqual(len(modelcache.entries()), 1)
+        self.assertEqual(isinstance(modelcache.load(self.model_file, (0,) + indices)[0], np.ndarray), True)
+
+        cached = data.cmdset('model', data_file = self.model_file, usecol = indices)
+        self.assertEqual(np.array_equal(parsed.fullframe.values, cached.fullframe.values), True)
+        self.assertEqual(parsed.FeH, cached.FeH)
+
+        # Changing the model file orphans its old entry:
+        os.utime(self.model_file, ns=(0, 0))
+        self.assertEqual(modelcache.load(self.model_file, (0,) + indices), None)
+        self.assertEqual(modelcache.cleanup(), 1)
+
+        data.cmdset('model', data_file = self.model_file, usecol = indices)
+        self.assertEqual(modelcache.invalidate(self.model_file), 1)
+        self.assertEqual(len(modelcache.entries()), 0)
+
+        # Without a cache directory, nothing is cached:
+        environ_dir = os.environ.pop('CMDFIT_CACHE_DIR', None)
+        modelcache.set_cache_dir(None)
+        data.cmdset('model', data_file = self.model_file, usecol = indices)
+        self.assertEqual(modelcache.get_cache_dir(), None)
+        self.assertEqual(modelcache.load(self.model_file, (0,) + indices), None)
+        self.assertEqual(os.listdir(os.path.join(self.tmp_dir, 'cache')), [])
+        if environ_dir != None:
+            os.environ['CMDFIT_CACHE_DIR'] = environ_dir
+
+# Tests packing model cmdsets into a ModelGrid:
+class TestModelGrid(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.model_files = mockmodels.write_mockrun(os.path.join(self.tmp_dir, 'run'), FeHs = (0.15, -0.10, 0.00))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_modelgrid(self):
+        model_cmdsets = [data.cmdset('model', 8.0, model_file, (12, 13), cache=False) for model_file in self.model_files]
+        grid = data.ModelGrid.fromcmdsets(model_cmdsets)
+
+        self.assertEqual(list(grid.FeHs), [-0.10, 0.00, 0.15])
+        self.assertEqual(grid.table.shape[0], sum([len(model.ages) for model in model_cmdsets]))
+
+        # The per-metallicity cmdsets are views of the grid that match the originals:
+        richest = grid[2]
+        self.assertEqual(richest.FeH, model_cmdsets[0].FeH)
+        self.assertEqual(np.array_equal(richest.magnitudes.values, model_cmdsets[0].magnitudes.values), True)
+        self.assertEqual(np.shares_memory(richest.magnitudes.values, grid.table), True)
+
+        rows = grid.rows(1, 3)
+        self.assertEqual(np.all(rows[:, 1] == grid.ages[3]), True)
+        self.assertEqual(np.all(np.diff(rows[:, 0]) == 1), True)
+
+        # Saved grids are memory-mapped when loaded, and pickle by path only:
+        loaded = data.ModelGrid.load(grid.save(os.path.join(self.tmp_dir, 'grid')))
+        self.assertEqual(isinstance(loaded.table, np.memmap), True)
+        self.assertEqual(np.array_equal(loaded.table, grid.table), True)
+        self.assertEqual(len(pickle.dumps(loaded)) < 1000, True)
+        self.assertEqual(np.array_equal(pickle.loads(pickle.dumps(loaded)).offsets, grid.offsets), True)
+
+        # The dense EEP grid is single precision, its size is known before it is made, and one too large
+        # for eepgrid_maxbytes is not made:
+        large = data.ModelGrid.fromcmdsets(model_cmdsets)
+        with mock.patch.object(data, 'eepgrid_maxbytes', large.eepgrid_bytes() - 1):
+            self.assertRaises(MemoryError, large.eepgrid)
+        dense = grid.eepgrid()
+        self.assertEqual(dense.dtype, np.float32)
+        self.assertEqual(dense.nbytes, grid.eepgrid_bytes())
+        self.assertEqual(grid.isomodel(0.0, grid.ages[3]).dtype, np.float64)
+
+        # ...and the grid is saved for worker processes once, however many pools are started:
+        with mock.patch.object(data.ModelGrid, 'save', side_effect=data.ModelGrid.save, autospec=True) as saved:
+            shared = grid.share()
+            self.assertEqual(grid.share(), shared)
+        self.assertEqual(saved.call_count, 1)
+        self.assertEqual(data.ModelGrid.load(shared).eepgrid().dtype, np.float32)
+        self.assertEqual(data.ModelGrid.load(shared).share(), shared)
+
+# Tests bracketing many values at once, including at and beyond the ends of the grid:
+class TestBrackets(TestCase):
+    def test_brackets(self):
+        grid = np.array([-0.10, 0.00, 0.15])
+        index, weight, inside = interp.find_brackets([-0.2, -0.10, -0.05, 0.00, 0.1, 0.15, 0.3], grid)
+
+        self.assertEqual(list(index), [0, 0, 0, 1, 1, 1, 1])
+        self.assertEqual(np.allclose(weight, [0.0, 0.0, 0.5, 0.0, 2.0/3.0, 1.0, 1.0]), True)
+        self.assertEqual(list(inside), [False, True, True, True, True, True, False])
+
+        # Scalars work too, and agree with the scalar finder between nodes:
+        index, weight, inside = interp.find_brackets(0.05, grid)
+        richFeH, poorFeH, richFeH_index, poorFeH_index = interp.find_closestFeHs(0.05, grid)
+        self.assertEqual((index, index + 1), (poorFeH_index, richFeH_index))
+
+        # Interpolation carries any further axes through:
+        table = np.column_stack((grid, 10*grid))
+        values = np.linspace(-0.10, 0.15, 11)
+        index, weight, inside = interp.find_brackets(values, grid)
+        result = interp.interp_brackets(index, weight, table)
+        self.assertEqual(result.shape, (11, 2))
+        self.assertEqual(np.allclose(result[:, 1], 10*values), True)
+
+# Tests that isochrones found through a model cmdset's age index match a search of every row:
+class TestIsoIndex(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.model_file = mockmodels.write_mockmodel(os.path.join(self.tmp_dir, 'mock.iso.cmd'), 0.15)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_isoindex(self):
+        modelset = data.cmdset('model', 8.0, self.model_file, (12, 13), cache=False)
+        age_array = modelset.ages.values
+
+        self.assertEqual(np.array_equal(modelset.isoages, np.unique(age_array)), True)
+        for age, (start, stop) in zip(modelset.isoages, modelset.isooffsets):
+            self.assertEqual(np.array_equal(np.where(age_array == age)[0], np.arange(start, stop)), True)
+
+        # Ages between isochrones give the younger one; the isochrone is a view of the cmdset:
+        for age, found_age in [(8.5, 8.5), (8.55, 8.5), (modelset.isoages[-1], modelset.isoages[-1])]:
+            isoch = isochrone(modelset, age, silent=True)
+            rows = np.where(age_array == found_age)[0]
+            self.assertEqual(isoch.age, found_age)
+            self.assertEqual(np.array_equal(isoch.magnitudes.values, modelset.magnitudes.values[rows]), True)
+            self.assertEqual(np.array_equal(isoch.initmasses.values, modelset.initmasses.values[rows]), True)
+            self.assertEqual(np.shares_memory(isoch.mag_array, modelset.magnitudes.values), True)
+
+        # Magnitudes of many masses in all bands at once agree with the single lookups; masses
+        # outside of the isochrone get infinite magnitudes:
+        isoch = isochrone(modelset, 8.5, silent=True)
+        masses = np.array([isoch.mass_array[0] - 0.1, isoch.mass_array[0], 0.77, 1.0, isoch.mass_array[3], isoch.mass_array[-1] + 0.1])
+        mags = isoch.getmags(masses)
+        self.assertEqual(mags.shape, (6, 2))
+        self.assertEqual(np.isinf(mags[[0, 5]]).all(), True)
+        self.assertEqual(np.allclose(mags[4], isoch.mag_array[3]), True)
+        for band in range(2):
+            expected = np.interp(masses[1:5], isoch.mass_array, isoch.mag_array[:, band])
+            self.assertEqual(np.allclose(mags[1:5, band], expected), True)
+            self.assertEqual(isoch.isogetmag(1.0, band), mags[3, band])
+        self.assertEqual(np.array_equal(isoch.getmags(masses, bands=[1]), mags[:, [1]]), True)
+
+        # Grid cmdsets reuse the grid's offsets:
+        gridset = data.ModelGrid.fromcmdsets([modelset])[0]
+        self.assertEqual(np.array_equal(gridset.isoages, modelset.isoages), True)
+        self.assertEqual(np.array_equal(gridset.isooffsets, modelset.isooffsets), True)
+
+# Tests interpolating model magnitudes in [Fe/H], age and mass through a ModelGrid:
+class TestGridInterp(MockGridTestCase):
+    def test_gridinterp(self):
+        grid = self.grid
+        masses = np.array([0.2, 0.8, 1.0, 1.7, 50.0])
+
+        # On a model isochrone, the grid agrees with the isochrone's own lookup:
+        isoch = isochrone(grid[1], 8.5, silent=True)
+        mags = grid.getmags(0.00, 8.5, masses)
+        self.assertEqual(mags.shape, (5, 2))
+        self.assertEqual(np.allclose(mags, isoch.getmags(masses)), True)
+        self.assertEqual(np.isinf(mags[[0, 4]]).all(), True)
+
+        # Between metallicities (the mock models' masses do not depend on [Fe/H]), magnitudes are 
+        # interpolated linearly:
+        between = grid.getmags(0.075, 8.5, masses[1:4])
+        self.assertEqual(np.allclose(between, 0.5*(grid.getmags(0.00, 8.5, masses[1:4]) + grid.getmags(0.15, 8.5, masses[1:4]))), True)
+
+        # Between ages, the interpolated isochrone follows the generating function closely:
+        expected = np.array([[mockmodels.mock_mag(m, 8.55, 0.075, b) for b in (5, 6)] for m in masses[1:4]]) + 3.33
+        self.assertEqual(np.allclose(grid.getmags(0.075, 8.55, masses[1:4]), expected, atol=0.01), True)
+
+        # Single bands, and values outside of the grid:
+        self.assertEqual(np.array_equal(grid.getmags(0.00, 8.5, masses, bands=1), mags[:, [1]]), True)
+        self.assertEqual(np.isinf(grid.getmags(0.30, 8.5, [1.0])).all(), True)
+        self.assertEqual(np.isinf(grid.getmags(0.00, 10.5, [1.0])).all(), True)
+
+        # getcmdsetsmag() goes through the grid:
+        self.assertEqual(data.getcmdsetsmag(grid, 8.55, 1.0, 0.075, grid.FeHs, 1), grid.getmags(0.075, 8.55, [1.0])[0, 1])
+
+# Tests the photometry of unresolved binaries made from the grid's fluxes:
+class TestBinaryFluxes(MockGridTestCase):
+    def test_binaryfluxes(self):
+        grid = self.grid
+        single = grid.getmags(0.00, 8.5, [1.0])
+
+        # A binary of equal stars is twice as bright; one with a secondary outside of the isochrone is invalid:
+        binary = grid.getmags(0.00, 8.5, [1.0, 1.0], secondary_masses=[1.0, 0.05], bands=1)
+        self.assertEqual(np.allclose(binary[0, 0], single[0, 1] - 2.5*np.log10(2.0)), True)
+        self.assertEqual(np.isinf(binary[1, 0]), True)
+
+        # Binaries from fluxes agree with combining the interpolated magnitudes, for many stars at
+        # several mass ratios at once:
+        primaries = np.array([[0.9], [1.2], [1.5]])
+        secondaries = primaries * np.array([0.5, 0.7, 0.9, 1.0])
+        binaries = grid.getmags(0.075, 8.55, primaries, secondaries)
+        self.assertEqual(binaries.shape, (3, 4, 2))
+
+        masses = np.array([0.2, 0.8, 1.0, 1.7, 50.0])
+        magonly = data.ModelGrid(grid.FeHs, grid.ages, grid.offsets, grid.table, grid.bandnames, grid.usedcolumns, fluxes=False)
+        self.assertEqual(np.allclose(binaries, magonly.getmags(0.075, 8.55, primaries, secondaries), atol=5e-3), True)
+        self.assertEqual(np.allclose(magonly.getmags(0.075, 8.55, masses), grid.getmags(0.075, 8.55, masses)), True)
+
+# Tests marginalizing the stars' masses along interpolated isochrones:
+class TestMassMarginal(MockGridTestCase):
+    def test_massmarginal(self):
+        grid = self.grid
+
+        # Marginalizing the stars' masses along the isochrone agrees with a fine numerical integral:
+        model = grid.isomodel(0.075, 8.55)
+        star_mags = np.array([7.0, 8.0, 9.5, 25.0])
+        star_sigmas = np.array([0.1, 0.1, 0.2, 0.1])
+        lnL = likelihood.mass_marginal_lnLikelihood(star_mags, star_sigmas, model[:, 0], model[:, 1])
+
+        fine_masses = np.linspace(model[0, 0], model[-1, 0], 200001)
+        fine_mags = grid.getmags(0.075, 8.55, fine_masses, bands=0)[:, 0]
+        integrand = priors.primary_mass_lnprior(fine_masses) - 0.5*((star_mags[:, np.newaxis] - fine_mags) / star_sigmas[:, np.newaxis])**2
+        expected = np.log(np.trapezoid(np.exp(integrand), fine_masses, axis=1) / (np.sqrt(2*np.pi) * star_sigmas))
+        self.assertEqual(np.allclose(lnL[:3], expected[:3], atol=1e-3), True)
+        self.assertEqual(np.isfinite(lnL[3]), True)
+        self.assertEqual(lnL[3] < -1000, True)
+
+        # ...and the band likelihood built from it is deterministic:
+        theta = np.array([0.075, 8.55])
+        band_lnL = likelihood.band_lnLikelihood(theta, star_mags[:3], star_sigmas[:3], 0, grid, grid.FeHs)
+        self.assertEqual(band_lnL, likelihood.band_lnLikelihood(theta, star_mags[:3], star_sigmas[:3], 0, grid, grid.FeHs))
+        self.assertEqual(np.allclose(band_lnL, np.sum(expected[:3]), atol=1e-2), True)
+        self.assertEqual(likelihood.band_lnLikelihood(np.array([0.075, 11.0]), star_mags, star_sigmas, 0, grid, grid.FeHs), -np.inf)
+
+        # A stack of isochrones (padded with NaN, from isomodels()) gives each isochrone's own marginal:
+        FeHs, ages = np.array([0.075, 0.0, 0.3]), np.array([8.55, 9.42, 8.55])
+        models = grid.isomodels(FeHs, ages)
+        stacked = likelihood.mass_marginal_lnLikelihood(star_mags, star_sigmas, models[:, :, 0], models[:, :, 1])
+        self.assertEqual(stacked.shape, (3, 4))
+        for k in range(2):
+            model = grid.isomodel(FeHs[k], ages[k])
+            self.assertEqual(np.allclose(models[k, :len(model)], model), True)
+            self.assertEqual(np.allclose(stacked[k], likelihood.mass_marginal_lnLikelihood(star_mags, star_sigmas, model[:, 0], model[:, 1])), True)
+        self.assertEqual(np.all(stacked[2] == -np.inf), True)
+
+        # On an isochrone with coarse nodes (steps of 0.1 mag) and stars with small sigmas (0.01 mag), the
+        # nodes are refined so that the result agrees with a finely resampled isochrone, which it would not
+        # without refinement:
+        node_masses = np.linspace(0.8, 1.2, 9)
+        node_mags = 8.0 - 5.0 * (node_masses - 0.8)
+        star_mags = np.array([7.47, 7.13, 6.52])
+        star_sigmas = np.array([0.01, 0.01, 0.02])
+        lnL = likelihood.mass_marginal_lnLikelihood(star_mags, star_sigmas, node_masses, node_mags)
+
+        fine_masses = np.linspace(0.8, 1.2, 400001)
+        fine_mags = np.interp(fine_masses, node_masses, node_mags)
+        integrand = priors.primary_mass_lnprior(fine_masses) - 0.5*((star_mags[:, np.newaxis] - fine_mags) / star_sigmas[:, np.newaxis])**2
+        expected = np.log(np.trapezoid(np.exp(integrand), fine_masses, axis=1) / (np.sqrt(2*np.pi) * star_sigmas))
+        self.assertEqual(np.allclose(lnL, expected, atol=1e-3), True)
+
+        unrefined = likelihood.mass_marginal_lnLikelihood(star_mags, star_sigmas, node_masses, node_mags, node_spacing=np.inf)
+        self.assertEqual(np.all(np.abs(unrefined - expected) > 1.0), True)
+
+        # Each isochrone of a stack is refined on its own: a finely spaced isochrone gains no models from a
+        # coarse one beside it, and one padded with NaN keeps its last model:
+        fine_masses = np.concatenate((np.linspace(0.8, 1.0, 5), [np.nan] * 4))
+        stack_masses = np.vstack((node_masses, fine_masses))
+        stack_mags = np.vstack((node_mags, 8.0 - 0.05 * (fine_masses - 0.8)))[:, :, np.newaxis]
+        refined_masses, refined_mags = likelihood.refine_nodes(stack_masses, stack_mags, np.array([0.03]))
+        self.assertEqual(list(np.sum(np.isfinite(refined_masses), axis=1)), [1 + 8*9, 5])
+        self.assertEqual(np.array_equal(refined_masses[1, :5], fine_masses[:5]), True)
+        self.assertEqual(list(np.sum(likelihood.refine_splits(stack_mags, np.array([0.03])), axis=1) + 1),
+                         [refined_masses.shape[1], 9])
+
+        stacked = likelihood.mass_marginal_lnLikelihood(star_mags, star_sigmas, stack_masses, stack_mags[:, :, 0])
+        for k in range(2):
+            alone = likelihood.mass_marginal_lnLikelihood(star_mags, star_sigmas, stack_masses[k, :9 - 4*k], stack_mags[k, :9 - 4*k, 0])
+            self.assertEqual(np.allclose(stacked[k], alone), True)
+
+# Tests the likelihood of all bands at once, with one mass per star:
+class TestAllbandLikelihood(MockGridTestCase):
+    def test_allbandlikelihood(self):
+        grid = self.grid
+        model = grid.isomodel(0.075, 8.55)
+        star_mags = np.column_stack(([7.0, 8.0, 9.5], [7.2, 8.2, 9.7]))
+        star_sigmas = np.column_stack(([0.1, 0.1, 0.2], [0.1, 0.1, 0.2]))
+
+        # Each star has one mass in both bands, so its likelihood is the integral of the product of the
+        # bands' Gaussians:
+        lnL = likelihood.mass_marginal_lnLikelihood(star_mags, star_sigmas, model[:, 0], model[:, 1:3])
+        fine_masses = np.linspace(model[0, 0], model[-1, 0], 200001)
+        fine_mags = grid.getmags(0.075, 8.55, fine_masses)
+        integrand = priors.primary_mass_lnprior(fine_masses) - 0.5*np.sum(((star_mags[:, np.newaxis, :] - fine_mags) / star_sigmas[:, np.newaxis, :])**2, axis=2)
+        expected = np.log(np.trapezoid(np.exp(integrand), fine_masses, axis=1) / np.prod(np.sqrt(2*np.pi) * star_sigmas, axis=1))
+        self.assertEqual(np.allclose(lnL, expected, atol=1e-3), True)
+
+        theta = np.array([0.075, 8.55])
+        data_cmdset = data.cmdset.__new__(data.cmdset)
+        data_cmdset.numbands = 2
+        data_cmdset.magnitudes = pd.DataFrame(star_mags)
+        data_cmdset.uncertainties = pd.DataFrame(star_sigmas)
+        self.assertEqual(np.allclose(likelihood.allband_lnLikelihood(theta, data_cmdset, grid, grid.FeHs), np.sum(expected), atol=1e-2), True)
+        self.assertEqual(likelihood.allband_lnLikelihood(np.array([0.075, 11.0]), data_cmdset, grid, grid.FeHs), -np.inf)
+
+        # ...and for a single star, the star's mass prior enters once, with its likelihood in each band:
+        single_theta = np.array([0.075, 8.55, 1.0])
+        model_mags = grid.getmags(0.075, 8.55, [1.0])[0]
+        expected_single = (priors.star_lnprior((1.0, 0.0), mode='single')
+                           + np.sum(-0.5*((star_mags[1] - model_mags) / star_sigmas[1])**2 - np.log(np.sqrt(2*np.pi) * star_sigmas[1])))
+        single_lnL = likelihood.allband_lnLikelihood(single_theta, data_cmdset, grid, grid.FeHs, mode='single', magindex=1)
+        self.assertEqual(np.allclose(single_lnL, expected_single), True)
+
+    def test_smallsigmas(self):
+        # Faint stars with small sigmas agree with the chi-square worked out directly, ((m - mu) / sigma)**2,
+        # to well within the precision that expanding it would lose to cancellation:
+        node_masses = np.linspace(0.8, 1.2, 2001)
+        node_mags = np.column_stack((18.0 - (node_masses - 0.8), 17.5 - 0.8*(node_masses - 0.8)))
+        star_masses = np.array([0.85, 0.93, 1.02, 1.17])
+        star_mags = np.column_stack([np.interp(star_masses, node_masses, node_mags[:, b]) for b in range(2)]) + 0.0005
+        star_sigmas = np.full(star_mags.shape, 0.001)
+        lnL = likelihood.mass_marginal_lnLikelihood(star_mags, star_sigmas, node_masses, node_mags)
+
+        chi2 = np.sum(((star_mags[:, np.newaxis, :] - node_mags) / star_sigmas[:, np.newaxis, :])**2, axis=2)
+        integrand = priors.primary_mass_lnprior(node_masses) - 0.5*chi2
+        expected = np.log(np.trapezoid(np.exp(integrand), node_masses, axis=1) / np.prod(np.sqrt(2*np.pi) * star_sigmas, axis=1))
+        self.assertEqual(np.allclose(lnL, expected, rtol=0, atol=1e-10), True)
+
+# Tests that the posterior of all walkers at once agrees with one walker at a time:
+class TestWalkersPosterior(MockGridTestCase):
+    def test_walkersposterior(self):
+        grid = self.grid
+        data_cmdset = data.cmdset.__new__(data.cmdset)
+        data_cmdset.numbands = 2
+        data_cmdset.magnitudes = pd.DataFrame(np.column_stack(([7.0, 8.0, 9.5], [7.2, 8.2, 9.7])))
+        data_cmdset.uncertainties = pd.DataFrame(np.column_stack(([0.1, 0.1, 0.2], [0.1, 0.1, 0.2])))
+
+        # All walkers at once give the same posteriors as one walker at a time, for stars and binaries in 
+        # and out of range:
+        thetas = np.array([[0.075, 8.55, 1.0, 0.5, 0.1], [0.0, 8.5, 1.2, 1.2, 0.0], [0.1, 8.6, 0.9, 1.1, 0.5],
+                           [0.075, 8.55, 50.0, 0.5, 0.1], [0.075, 10.9, 1.0, 0.5, 0.1], [0.3, 8.55, 1.0, 0.5, 0.1]])
+        ranges = ((grid.FeHs[0], grid.FeHs[-1]), (grid.ages[0], grid.ages[-1]))
+        self.assertEqual(np.allclose(grid.getmags_each(thetas[:, 0], thetas[:, 1], thetas[:, 2], thetas[:, 3]), 
+                                     [grid.getmags(theta[0], theta[1], theta[2], theta[3])[0] for theta in thetas]), True)
+        for mode, ndim in (('all', 2), ('single', 3), ('single', 4), ('single', 5)):
+            looped = [MCMC.lnposterior(theta, data_cmdset, grid, grid.FeHs, ranges[0], ranges[1], mode, 1) for theta in thetas[:, :ndim]]
+            vectorized = MCMC.walkers_lnposterior(thetas[:, :ndim], data_cmdset, grid, grid.FeHs, ranges[0], ranges[1], mode, 1)
+            self.assertEqual(np.allclose(vectorized, looped), True)
+
+        # The walkers are marginalized in blocks that keep to the element budget with the refined models
+        # counted, and the blocking does not change the result:
+        blocks = []
+        marginal = likelihood.mass_marginal_lnLikelihood
+        def recording_marginal(star_mags, star_sigmas, node_masses, node_mags):
+            splits = likelihood.refine_splits(node_mags, likelihood.marginal_node_spacing * np.min(star_sigmas, axis=0))
+            blocks.append((len(node_masses), np.amax(np.sum(splits, axis=1) + 1) * len(node_masses) * len(star_mags)))
+            return marginal(star_mags, star_sigmas, node_masses, node_mags)
+
+        budget = 4000
+        whole = likelihood.walkers_lnLikelihood(thetas[:, :2], data_cmdset, grid, grid.FeHs)
+        with mock.patch.object(likelihood, 'walkers_blockelements', budget):
+            with mock.patch.object(likelihood, 'mass_marginal_lnLikelihood', recording_marginal):
+                blocked = likelihood.walkers_lnLikelihood(thetas[:, :2], data_cmdset, grid, grid.FeHs)
+        self.assertEqual(np.array_equal(blocked, whole), True)
+        self.assertEqual(sum(nwalkers for nwalkers, elements in blocks), len(thetas))
+        self.assertEqual(all(nwalkers == 1 or elements <= budget for nwalkers, elements in blocks), True)
+        self.assertEqual(len(blocks) > 1, True)
+
+    def test_logsumexp(self):
+        # -inf terms add nothing, rows of -inf give -inf, and terms far below the largest do not underflow it:
+        a = np.array([[-np.inf, 0.0, -np.inf], [-np.inf, -np.inf, -np.inf], [-1000.0, -1001.0, -2000.0], [1.0, 2.0, 3.0]])
+        lnsum = likelihood.logsumexp(a, axis=1)
+        self.assertEqual(lnsum[0], 0.0)
+        self.assertEqual(lnsum[1], -np.inf)
+        self.assertEqual(np.allclose(lnsum[2], -1000.0 + np.log1p(np.exp(-1.0))), True)
+        self.assertEqual(np.allclose(lnsum[3], np.log(np.sum(np.exp(a[3])))), True)
+        self.assertEqual(likelihood.logsumexp(np.array([-np.inf, 0.0])), 0.0)
+        self.assertEqual(np.allclose(likelihood.logsumexp(a[2:], axis=0), np.log(np.exp(a[3]) + np.exp(a[2]))), True)
+
+# Tests caching the cluster likelihood at the nodes of the grid:
+class TestNodeCache(MockGridTestCase):
+    def test_nodecache(self):
+        grid = self.grid
+        data_cmdset = mockmodels.mock_cluster(grid, 20)
+
+        cache = NodeCache(grid)
+
+        # At a grid node, the cached likelihood is the likelihood; between nodes, it is interpolated from them:
+        for theta in (np.array([0.0, 8.5]), np.array([0.05, 8.55])):
+            exact = likelihood.allband_lnLikelihood(theta, data_cmdset, grid, grid.FeHs)
+            cached = likelihood.allband_lnLikelihood(theta, data_cmdset, grid, grid.FeHs, nodecache=cache)
+            self.assertEqual(np.allclose(cached, exact, atol=0.1 if theta[0] == 0.05 else 1e-9), True)
+        self.assertEqual(cache.lnLikelihood(0.3, 8.5, data_cmdset), -np.inf)
+
+        # Between nodes the cached likelihood is an approximation, which stays close to the likelihood of
+        # the interpolated isochrones on the mock grid:
+        for FeH, age in ((0.02, 8.52), (0.07, 8.58), (0.05, 8.75), (-0.05, 8.55), (0.1, 9.05)):
+            exact = likelihood.allband_lnLikelihood(np.array([FeH, age]), data_cmdset, grid, grid.FeHs)
+            difference = abs(cache.lnLikelihood(FeH, age, data_cmdset) - exact)
+            self.assertEqual(1e-4 < difference < 0.05, True)
+
+        # Nearby evaluations only use cached nodes:
+        hits, misses = cache.hits, cache.misses
+        cache.lnLikelihood(0.04, 8.52, data_cmdset)
+        self.assertEqual((cache.hits, cache.misses), (hits + 4, misses))
+        self.assertEqual(cache.hitrate(), cache.hits / (cache.hits + cache.misses))
+        self.assertEqual(cache.stats()['nbytes'], sum([value.nbytes for value in cache.entries.values()]))
+
+        # New data replace the cached star likelihoods:
+        data_cmdset.magnitudes = data_cmdset.magnitudes + 0.01
+        self.assertEqual(cache.lnLikelihood(0.0, 8.5, data_cmdset), likelihood.allband_lnLikelihood(np.array([0.0, 8.5]), data_cmdset, grid, grid.FeHs))
+
+        # A small cache evicts its least recently used nodes:
+        small = NodeCache(grid, maxbytes=3 * cache.nodemodel(1, 5).nbytes)
+        small.lnLikelihood(0.05, 8.55, data_cmdset)
+        self.assertEqual(small.evictions > 0, True)
+        self.assertEqual(small.nbytes <= small.maxbytes, True)
+        self.assertEqual(small.lnLikelihood(0.05, 8.55, data_cmdset), cache.lnLikelihood(0.05, 8.55, data_cmdset))
+
+# Tests the gridded posterior of the cluster fit:
+class TestGridPosterior(MockGridTestCase):
+    def test_gridposterior(self):
+        grid = self.grid
+        data_cmdset = mockmodels.mock_cluster(grid)
+
+        surface, marginals, q = MCMC.gridposterior(data_cmdset, grid, grid.FeHs, resolution=(5, 8), chunksize=7)
+
+        # The mesh is the centers of equal cells over the grid, and the surface is normalized on it:
+        self.assertEqual(surface.shape, (5, 8))
+        self.assertEqual(np.allclose(surface.index, np.linspace(-0.1, 0.15, 11)[1::2]), True)
+        dFeH, dage = 0.05, (grid.ages[-1] - grid.ages[0]) / 8
+        self.assertEqual(np.allclose(np.sum(surface.values) * dFeH * dage, 1.0), True)
+        self.assertEqual(np.allclose(np.sum(marginals['log10 Age'].values) * dage, 1.0), True)
+
+        # ...in proportion to the posterior:
+        FeH, age = surface.index[1], surface.columns[2]
+        args = mockmodels.posterior_args(data_cmdset, grid)
+        ratio = np.exp(MCMC.lnposterior(np.array([FeH, age]), *args) - MCMC.lnposterior(np.array([surface.index[3], age]), *args))
+        self.assertEqual(np.allclose(surface.loc[FeH, age] / surface.iloc[3, 2], ratio), True)
+
+        # Quantiles come out like those of MCMC samples:
+        samples = pd.DataFrame({'[Fe/H]': [0.0, 0.1], 'log10 Age': [8.5, 8.6]})
+        self.assertEqual(list(q.index), list(samples.quantile([0.16, 0.50, 0.84], axis=0).index))
+        self.assertEqual(list(q.columns), list(samples.columns))
+        self.assertEqual(np.all(np.diff(q.values, axis=0) > 0), True)
+        self.assertEqual(np.allclose(MCMC.gridquantiles(np.array([0.0, 1.0, 2.0]), np.array([0.5, 0.5]), [0.25, 0.5]), [0.5, 1.0]), True)
+
+# Tests evaluating walkers in worker processes attached to a saved grid:
+class TestSamplerPool(MockGridTestCase):
+    def test_samplerpool(self):
+        from cmdfit.statistics.parallel import SamplerPool, pool_lnposterior
+
+        grid = self.grid
+        data_cmdset = mockmodels.mock_cluster(grid)
+        args = mockmodels.posterior_args(data_cmdset, grid)
+
+        # A grid saved with its EEP grid is memory-mapped back in, and interpolates the same:
+        path = grid.save(os.path.join(self.tmp_dir, 'saved'), eepgrid=True)
+        loaded = data.ModelGrid.load(path)
+        self.assertEqual(isinstance(loaded._eepgrid, np.memmap), True)
+        self.assertEqual(np.allclose(loaded.getmags(0.075, 8.55, [0.9, 1.2]), grid.getmags(0.075, 8.55, [0.9, 1.2])), True)
+
+        # Workers attached to the shared grid and data give the same posteriors as the parent process:
+        thetas = np.column_stack((np.linspace(-0.05, 0.1, 6), np.linspace(8.45, 8.75, 6)))
+        expected = [MCMC.lnposterior(theta, *args) for theta in thetas]
+        with SamplerPool(2, *args[:5]) as pool:
+            self.assertEqual(np.allclose(pool.map(pool_lnposterior, thetas), expected), True)
+            self.assertEqual(np.allclose(pool.walkers_lnposterior(thetas), expected), True)
+
+        # ...and so does a sampler run with them (on a machine with CPUs to spare, and however quick the walkers):
+        starts = thetas + 0.01*np.random.RandomState(0).randn(6, 2)
+        np.random.seed(1)
+        serial = MCMC.run_sampler(6, 2, starts, 3, args)
+        np.random.seed(1)
+        pooled = MCMC.run_sampler(6, 2, starts, 3, args, workers=2, pool_limits={'cpus': 4, 'walker_overhead': 0.0})
+        self.assertEqual(np.allclose(serial.get_chain(), pooled.get_chain()), True)
+
+    def test_poolworkers(self):
+        # A pool is no larger than the CPUs or the tasks, and not used at all when it cannot pay:
+        limits = {'cpus': 4}
+        overheads = parallel.default_pool_limits
+        self.assertEqual(parallel.pool_workers(8, limits=limits), 4)
+        self.assertEqual(parallel.pool_workers(8, ntasks=3, limits=limits), 3)
+        self.assertEqual(parallel.pool_workers(8, ntasks=1, limits=limits), None)
+        self.assertEqual(parallel.pool_workers(None, limits=limits), None)
+        self.assertEqual(parallel.pool_workers(2, task_seconds=10 * overheads['walker_overhead'], limits=limits), 2)
+        self.assertEqual(parallel.pool_workers(2, task_seconds=1.5 * overheads['walker_overhead'], limits=limits), None)
+        self.assertEqual(parallel.pool_workers(4, task_seconds=overheads['block_overhead'] / 2, kind='block', limits=limits), None)
+        self.assertEqual(parallel.pool_workers(4, task_seconds=1.0, limits={'cpus': 1}), None)
+
+        # The limits are the caller's to change, and by default the CPUs are the machine's:
+        self.assertEqual(parallel.pool_workers(2, task_seconds=1e-5, limits={'cpus': 4, 'walker_overhead': 0.0}), 2)
+        with mock.patch.object(parallel, 'cpu_count', return_value=1):
+            self.assertEqual(parallel.pool_workers(4, task_seconds=1.0), None)
+
+# Tests streaming chains to disk and resuming them:
+class TestChainStore(MockGridTestCase):
+    def test_chainstore(self):
+        from cmdfit.statistics.chainstore import ChainStore
+
+        grid = self.grid
+        data_cmdset = mockmodels.mock_cluster(grid)
+        args = mockmodels.posterior_args(data_cmdset, grid)
+        starts = np.array([[0.05, 8.55]]) + 0.01*np.random.RandomState(0).randn(6, 2)
+
+        np.random.seed(2)
+        inmemory = MCMC.run_sampler(6, 2, starts, 25, args)
+
+        # Streamed to disk in chunks, the chain is the same; only the last part-chunk is held in memory:
+        chain_dir = os.path.join(self.tmp_dir, 'chain')
+        np.random.seed(2)
+        streamed = MCMC.run_sampler(6, 2, starts, 25, args, backend=ChainStore(chain_dir, chunksize=10))
+        self.assertEqual(len(streamed.backend.chunkfiles('chain')), 3)
+        self.assertEqual(streamed.backend.chain.shape, (10, 6, 2))
+        self.assertEqual(np.array_equal(streamed.get_chain(), inmemory.get_chain()), True)
+        self.assertEqual(np.array_equal(streamed.get_log_prob(flat=True, discard=5, thin=3), inmemory.get_log_prob(flat=True, discard=5, thin=3)), True)
+        self.assertEqual(np.array_equal(streamed.acceptance_fraction, inmemory.acceptance_fraction), True)
+
+        # A run stopped after 12 steps, with a chunk written after its last checkpoint, resumes from the
+        # checkpoint to the same chain:
+        np.random.seed(2)
+        MCMC.run_sampler(6, 2, starts, 12, args, backend=ChainStore(chain_dir, chunksize=10))
+        np.save(os.path.join(chain_dir, 'chain_00002.npy'), np.zeros((3, 6, 2)))
+        np.random.seed(99)
+        resumed = MCMC.run_sampler(6, 2, None, 25, args, backend=ChainStore(chain_dir, chunksize=10, resume=True))
+        self.assertEqual(np.array_equal(resumed.get_chain(), inmemory.get_chain()), True)
+
+        # Without resume, the chain in the directory starts over:
+        np.random.seed(2)
+        restarted = MCMC.run_sampler(6, 2, starts, 4, args, backend=ChainStore(chain_dir, chunksize=10))
+        self.assertEqual(len(restarted.get_chain()), 4)
+
+# Tests stopping the sampler once its chain has converged:
+class TestConvergence(MockGridTestCase):
+    def test_convergence(self):
+        grid = self.grid
+        data_cmdset = mockmodels.mock_cluster(grid)
+        args = mockmodels.posterior_args(data_cmdset, grid)
+        starts = np.array([[0.05, 8.55]]) + 0.01*np.random.RandomState(0).randn(8, 2)
+
+        # Sampling stops at the first check where the chain meets the thresholds, well before nsteps:
+        thresholds = {'check_every': 50, 'tau_factor': 10, 'tau_rtol': 0.2, 'ess': 100, 'rhat': 1.1}
+        np.random.seed(3)
+        sampler = MCMC.run_sampler(8, 2, starts, 2000, args, vectorize=True, convergence=thresholds)
+        self.assertEqual(sampler.iteration < 2000 and sampler.iteration % 50 == 0, True)
+        self.assertEqual(sampler.diagnostics['converged'], True)
+        self.assertEqual(sampler.diagnostics['burnin'], int(np.ceil(2 * max(sampler.diagnostics['tau']))))
+        self.assertEqual(max(sampler.diagnostics['rhat']) < 1.1, True)
+
+        # ...and runs to nsteps when they cannot be met:
+        np.random.seed(3)
+        sampler = MCMC.run_sampler(8, 2, starts, 100, args, vectorize=True, convergence={'check_every': 50, 'ess': 1e9})
+        self.assertEqual(sampler.iteration, 100)
+        self.assertEqual(sampler.diagnostics['converged'], False)
+
+        # A chain whose autocorrelation time never settles is not converged, whether its last check was of
+        # the final step or steps were taken after it (R-hat and ESS alone are not enough):
+        unsettled = {'check_every': 50, 'tau_factor': 0, 'tau_rtol': 0.0, 'ess': 0, 'rhat': 10.0}
+        for nsteps in (100, 120):
+            np.random.seed(3)
+            sampler = MCMC.run_sampler(8, 2, starts, nsteps, args, vectorize=True, convergence=unsettled)
+            self.assertEqual(sampler.iteration, nsteps)
+            self.assertEqual(sampler.diagnostics['converged'], False)
+
+        # Checks are spaced out in proportion once the chain is long, so they cost O(nsteps) in all:
+        self.assertEqual([diagnostics.next_check(steps, {'check_every': 50}) for steps in (0, 120, 200, 400, 600)],
+                         [50, 150, 250, 500, 750])
+        diagnose = diagnostics.diagnose
+        with mock.patch.object(diagnostics, 'diagnose', side_effect=diagnose) as counted:
+            np.random.seed(3)
+            sampler = MCMC.run_sampler(8, 2, starts, 1000, args, vectorize=True, convergence={'check_every': 50, 'ess': 1e9})
+        self.assertEqual(sampler.iteration, 1000)
+        self.assertEqual(counted.call_count, 12 + 1)
+
+# Tests fitting each star of a catalog on its own:
+class TestFitStars(MockGridTestCase):
+    def test_fitstars(self):
+        grid = self.grid
+        data_cmdset = mockmodels.mock_cluster(grid, 4, (0.8, 1.2))
+
+        # One row per star, in order, whichever process fitted it and in whatever order they finished:
+        results_file = os.path.join(self.tmp_dir, 'stars.csv')
+        settings = dict(ndim=3, nwalkers=8, nsteps=20, seed=1)
+        serial = batch.fitstars(data_cmdset, grid, stars=[3, 0, 2], **settings)
+        pooled = batch.fitstars(data_cmdset, grid, stars=[3, 0, 2], workers=2, chunksize=1, results_file=results_file,
+                                pool_limits={'cpus': 4}, **settings)
+
+        self.assertEqual(list(serial['star']), [0, 2, 3])
+        self.assertEqual(list(serial.columns[:4]), ['star', '[Fe/H] 0.16', '[Fe/H] 0.50', '[Fe/H] 0.84'])
+        self.assertEqual(serial.drop(columns='fit_time').equals(pooled.drop(columns='fit_time')), True)
+        self.assertEqual(np.allclose(pd.read_csv(results_file)['Primary Mass 0.50'], pooled['Primary Mass 0.50']), True)
+
+        # ...and each row is the star's own fit:
+        row = batch.fitstar(2, data_cmdset, grid, dict(settings, burnin=0.5, convergence=None, map_init=False, vectorize=False,
+                                                       chain_dir=None, resume=False))
+        self.assertEqual(row['Primary Mass 0.50'], serial['Primary Mass 0.50'][1])
+        self.assertEqual(row['steps'], 20)
+
+        # With a chain_dir, each star's chain goes to its own subdirectory, and a resumed run continues them:
+        chain_dir = os.path.join(self.tmp_dir, 'chains')
+        streamed = batch.fitstars(data_cmdset, grid, stars=[3, 0, 2], vectorize=True, chain_dir=chain_dir, **settings)
+        self.assertEqual(sorted(os.listdir(chain_dir)), ['star_00000', 'star_00002', 'star_00003'])
+        resumed = batch.fitstars(data_cmdset, grid, stars=[3, 0, 2], vectorize=True, chain_dir=chain_dir, resume=True,
+                                 **dict(settings, nsteps=30))
+        self.assertEqual(list(streamed['steps']), [20, 20, 20])
+        self.assertEqual(list(resumed['steps']), [30, 30, 30])
+
+        # Without a seed, the stars fitted first by each worker do not share their random numbers (one star
+        # fitted twice comes out differently):
+        unseeded = batch.fitstars(data_cmdset, grid, stars=[1, 1], workers=2, chunksize=1, pool_limits={'cpus': 4},
+                                  **dict(settings, seed=None))
+        self.assertEqual(unseeded['Primary Mass 0.50'][0] != unseeded['Primary Mass 0.50'][1], True)
+
+# Tests starting the walkers around the posterior's mode:
+class TestMapInit(MockGridTestCase):
+    def test_mapinit(self):
+        grid = self.grid
+        data_cmdset = mockmodels.mock_cluster(grid)
+        args = mockmodels.posterior_args(data_cmdset, grid)
+        bounds = [args[3], args[4]]
+
+        # The optimizer finds a mode at least as high as any point of a mesh over the grid:
+        np.random.seed(4)
+        theta, lnp, evaluations = MCMC.find_map(args, bounds, initial_positions=[0.15, 8.6])
+        FeHs, ages = np.meshgrid(np.linspace(-0.095, 0.145, 13), np.linspace(8.05, 9.95, 39))
+        mesh = MCMC.walkers_lnposterior(np.column_stack((FeHs.ravel(), ages.ravel())), *args)
+        self.assertEqual(lnp >= np.max(mesh) - 1e-3, True)
+        self.assertEqual(np.allclose(lnp, MCMC.lnposterior(theta, *args)), True)
+        self.assertEqual(evaluations > 65, True)
+
+        # The walkers start in a small ball around it, all with a finite posterior:
+        positions, ballevaluations = MCMC.map_walkerpos(10, theta, bounds, args)
+        self.assertEqual(positions.shape, (10, 2))
+        self.assertEqual(np.all(np.isfinite(MCMC.walkers_lnposterior(positions, *args))), True)
+        self.assertEqual(np.all(np.abs(positions - theta) < 0.1 * np.array([0.25, 2.0])), True)
+
+        np.random.seed(4)
+        sampler, nwalkers, nsteps = MCMC.getsamples(data_cmdset, grid, grid.FeHs, mode='single', magindex=3, ndim=4, nwalkers=10, nsteps=5,
+                                                    map_init=True)
+        self.assertEqual(len(sampler.mapinit['theta']), 4)
+        self.assertEqual(sampler.mapinit['theta'][3] <= sampler.mapinit['theta'][2], True)
+        self.assertEqual(np.all(np.isfinite(sampler.get_log_prob())), True)
+
+# Tests the convergence diagnostics on chains with known properties:
+class TestDiagnostics(TestCase):
+    def test_diagnostics(self):
+        # AR(1) walkers with coefficient 0.9 have an autocorrelation time of 1.9 / 0.1 = 19 steps:
+        rng = np.random.RandomState(0)
+        chain = np.zeros((4000, 16, 2))
+        for t in range(1, len(chain)):
+            chain[t] = 0.9*chain[t - 1] + rng.randn(16, 2)
+
+        tau = diagnostics.integrated_time(chain)
+        self.assertEqual(np.allclose(tau, 19.0, rtol=0.15), True)
+        self.assertEqual(np.allclose(tau, emcee.autocorr.integrated_time(chain, quiet=True)), True)
+        self.assertEqual(np.allclose(diagnostics.effective_samples(chain, tau), 4000 * 16 / tau), True)
+        self.assertEqual(np.all(diagnostics.split_rhat(chain) < 1.01), True)
+
+        # A drift makes the two halves of each walker's chain disagree:
+        drifting = chain + np.linspace(0, 5, 4000)[:, np.newaxis, np.newaxis]
+        self.assertEqual(np.all(diagnostics.split_rhat(drifting) > 1.05), True)
+
+        # The burn-in is twice the longest autocorrelation time, and a stuck chain never converges:
+        diagnosed = diagnostics.diagnose(chain)
+        self.assertEqual(diagnosed['burnin'], int(np.ceil(2 * max(tau))))
+        self.assertEqual(diagnostics.converged(diagnosed, diagnosed['tau']), True)
+        self.assertEqual(diagnostics.converged(diagnosed, None), False)
+        self.assertEqual(diagnostics.converged(diagnostics.diagnose(np.ones((100, 4, 2))), [1.0, 1.0]), False)
+
+        # A chain that was not checked as it was sampled is judged against the autocorrelation time of its
+        # first half:
+        self.assertEqual(diagnostics.chain_converged(chain, thresholds={'tau_rtol': 0.2}), True)
+        self.assertEqual(diagnostics.chain_converged(chain[:400], thresholds={'tau_rtol': 0.2}), False)
+
+# Tests the log-space cluster/field mixture likelihood:
+class TestMixture(TestCase):
+    def test_mixture(self):
+        magnitudes = np.array([[5.0, 4.5], [6.0, 5.6], [9.0, 4.0]])
+        sigmas = np.array([[0.05, 0.05], [0.1, 0.1], [0.02, 0.02]])
+        model_magnitudes = np.array([[5.02, 4.49], [5.9, 5.6], [5.0, np.inf]])
+        Pfield = np.array([0.1, 0.0, 0.3])
+        field_lndensity = -np.log([4.0, 3.0])
+
+        lnL = likelihood.mixture_lnLikelihood(magnitudes, sigmas, model_magnitudes, Pfield, field_lndensity)
+        self.assertEqual(lnL.shape, (3, 2))
+
+        # Agrees with the mixture in linear space where that does not underflow:
+        linear = ((1 - Pfield[:2, np.newaxis]) * np.exp(-0.5*((magnitudes[:2] - model_magnitudes[:2]) / sigmas[:2])**2) / (np.sqrt(2*np.pi) * sigmas[:2])
+                  + Pfield[:2, np.newaxis] * np.exp(field_lndensity))
+        self.assertEqual(np.allclose(lnL[:2], np.log(linear)), True)
+
+        # A star 200 sigma off the isochrone, or with no model magnitude, is left with the field term; as
+        # a member, its log likelihood stays finite rather than underflowing:
+        self.assertEqual(np.allclose(lnL[2], np.log(0.3) + field_lndensity), True)
+        self.assertEqual(np.allclose(likelihood.mixture_lnLikelihood(9.0, 0.02, 5.0, 0.0, field_lndensity[0]), 
+                                     -0.5*200.0**2 - np.log(np.sqrt(2*np.pi) * 0.02)), True)
+        self.assertEqual(likelihood.mixture_lnLikelihood(9.0, 0.02, np.inf, 0.0, field_lndensity[0]), -np.inf)
+
+        # The field density is worked out once, and again when the data change:
+        data_cmdset = data.cmdset.__new__(data.cmdset)
+        data_cmdset.numbands = 2
+        data_cmdset.magnitudes = pd.DataFrame(magnitudes)
+        data_cmdset.uncertainties = pd.DataFrame(sigmas)
+        density = data_cmdset.getfieldlndensity()
+        self.assertEqual(np.allclose(density, -np.log([4.0, 1.6])), True)
+        self.assertEqual(data_cmdset.getfieldlndensity() is density, True)
+        data_cmdset.datacutmags(4.0, 8.0)
+        self.assertEqual(np.allclose(data_cmdset.getfieldlndensity(), -np.log([1.0, 1.1])), True)
+
+# Tests loading a run directory of model files with a pool of worker processes:
+class TestParallelLoad(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.run_dir = os.path.join(self.tmp_dir, 'run')
+        mockmodels.write_mockrun(self.run_dir, FeHs = (0.15, -0.10, 0.00))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_parallelload(self):
+        serial = data.all_modelcmdsets(8.0, usecol=(12, 13), cache=False, model_dir=self.run_dir)
+        parallel = data.all_modelcmdsets(8.0, usecol=(12, 13), cache=False, model_dir=self.run_dir, workers=3)
+
+        self.assertEqual([model.FeH for model in parallel], [-0.10, 0.00, 0.15])
+        self.assertEqual([model.FeH for model in serial], [model.FeH for model in parallel])
+        for smodel, pmodel in zip(serial, parallel):
+            self.assertEqual(np.array_equal(smodel.fullframe.values, pmodel.fullframe.values), True)
+
+        self.assertEqual(data.check_modelcolumns(parallel), True)
+        parallel[1].usedcolumns = np.array([12, 14])
+        self.assertEqual(data.check_modelcolumns(parallel), False)
+
+# Tests that batch run specs are checked and completed with defaults:
+class TestBatchSpec(TestCase):
+    def test_batchspec(self):
+        tmp_dir = tempfile.mkdtemp()
+        spec_file = os.path.join(tmp_dir, 'spec.json')
+        f = open(spec_file, 'w')
+        f.write('{"data_file": "stars.txt", "data_columns": [5, 6, 7, 8], "model_dir": "/models", "model_columns": [12, 13]}')
+        f.close()
+
+        spec = batch.load_spec(spec_file)
+        self.assertEqual(spec['data_file'], os.path.join(tmp_dir, 'stars.txt'))
+        self.assertEqual(spec['model_dir'], '/models')
+        self.assertEqual(spec['nsteps'], batch.default_spec['nsteps'])
+
+        # Missing or unknown settings and mismatched columns are rejected:
+        self.assertEqual(batch.make_spec({'data_file': 'stars.txt'}), None)
+        self.assertEqual(batch.make_spec(dict(spec, nwalker=10)), None)
+        self.assertEqual(batch.make_spec(dict(spec, model_columns=[12])), None)
+        self.assertEqual(batch.make_spec(dict(spec, burnin='half')), None)
+        self.assertEqual(batch.make_spec(dict(spec, burnin='auto'))['burnin'], 'auto')
+        self.assertEqual(batch.make_spec(dict(spec, mode='stars', nodecache_mb=64)), None)
+        self.assertEqual(batch.make_spec(dict(spec, mode='all', nodecache_mb=64))['nodecache_mb'], 64)
+
+        # A chain that was not monitored is only converged if its autocorrelation time has settled between
+        # its first half and the whole (here it moves by 4%, but R-hat and ESS are fine):
+        rng = np.random.RandomState(0)
+        chain = np.zeros((4000, 16, 2))
+        for t in range(1, len(chain)):
+            chain[t] = 0.9*chain[t - 1] + rng.randn(16, 2)
+        diagnosed = batch.chain_diagnostics(mock.Mock(get_chain=lambda: chain), None)
+        self.assertEqual(diagnosed['converged'], False)
+        self.assertEqual(diagnostics.converged(diagnosed, diagnosed['tau'], {'tau_rtol': 0.01}), True)
+
+        self.assertEqual(batch.burnin_steps(100, 300), 100)
+        self.assertEqual(batch.burnin_steps(0.5, 300), 150)
+
+        chain = np.arange(2*4*3, dtype=float).reshape(2, 4, 3)
+        param_samples = batch.make_paramsamples(chain, 1)
+        self.assertEqual(list(param_samples.columns), ['[Fe/H]', 'log10 Age', 'Primary Mass'])
+        self.assertEqual(len(param_samples), 6)
+
+        shutil.rmtree(tmp_dir)
+
+# Tests that the fitting core imports quickly and without plotting or sampling libraries
+# (see the import time budget in README.md):
+class TestImports(TestCase):
+    def test_imports(self):
+        budget = 1.5
+        script = ('import sys, time; start = time.perf_counter(); import cmdfit.statistics.likelihood; '
+                  'print(time.perf_counter() - start); print(\' \'.join(sys.modules))')
+        output = subprocess.check_output([sys.executable, '-c', script]).decode().split('\n')
+
+        elapsed = float(output[0])
+        modules = output[1].split()
+
+        for heavy in ('matplotlib', 'seaborn', 'corner', 'emcee'):
+            self.assertEqual(heavy in modules, False)
+
+        self.assertEqual(elapsed < budget, True)
+
 # Tests that magnitude corrections will be applied correctly (this tests the AB to Vega correction and applies a distance modulus of 3.33 corresponding
 # to roughly what is believed for this cluster):
 class TestABCorrections(TestCase):
@@ -60,6 +952,43 @@ class Testcmdset(TestCase):
         Jband = dataset.makeBand(0)
  
         self.assertEqual(Jband[0][0], dataset.magnitudes.values[0][0])
+
+    def test_streamcuts(self):
+        data_file = data.getdefault_datafile()
+        indices = (5, 6, 7, 8)
+
+        # Cuts applied while streaming in small chunks match cuts applied after loading:
+        streamed = data.cmdset('data', data_file = data_file, usecol = indices, maglim = (4, 7), uncertlim = (0, 0.03), chunksize = 50)
+        
+        Jmags = cread.get_values(data_file, 5)
+        Jerrs = cread.get_values(data_file, 6)
+        Hmags = cread.get_values(data_file, 7)
+        Herrs = cread.get_values(data_file, 8)
+        keep = (Jmags >= 4) & (Jmags <= 7) & (Hmags >= 4) & (Hmags <= 7) & (Jerrs <= 0.03) & (Herrs <= 0.03)
+
+        self.assertEqual(np.array_equal(streamed.magnitudes.values[:, 1], Hmags[keep]), True)
+        self.assertEqual(np.array_equal(streamed.uncertainties.values[:, 0], Jerrs[keep]), True)
+
+        dataset = data.cmdset('data', data_file = data_file, usecol = indices)
+        dataset.datacutmags(4, 7)
+        dataset.cutuncert(0, 0.03)
+        self.assertEqual(np.array_equal(dataset.magnitudes.values, streamed.magnitudes.values), True)
+
+        # Columns are numbered by their decimal values, as get_values() numbers them, so names and integer
+        # IDs are skipped; limits may be arrays:
+        tmp_dir = tempfile.mkdtemp()
+        catalog = os.path.join(tmp_dir, 'catalog.txt')
+        f = open(catalog, 'w')
+        f.write('# name id J Jerr H Herr\n')
+        f.write('HIP1234 17 5.123 0.021 4.876 0.019\n')
+        f.write('HIP2345 18 -0.250 0.030 7.950 0.080\n')
+        f.write('HD33254 19 6.400 0.010 6.100 0.012\n')
+        f.close()
+
+        mags, uncerts = cread.stream_datacolumns(catalog, [0, 2], [1, 3], maglims=np.array([4.0, 7.0]), uncertlims=(0, 0.05))
+        self.assertEqual(np.array_equal(mags, [[5.123, 4.876], [6.4, 6.1]]), True)
+        self.assertEqual(np.array_equal(uncerts[:, 1], cread.get_values(catalog, 3)[[0, 2]]), True)
+        shutil.rmtree(tmp_dir)
          
 # '          ' in 'model' mode. Also tests isochrones:
 class TestIso(TestCase):